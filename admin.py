@@ -1,10 +1,15 @@
 from django.contrib import admin
-from .models import Ingredient, Brew, BrewIngredient, Blend, BlendIngredient, Recipe, RecipeBlend
+from .models import Ingredient, IngredientAlias, Brew, BrewIngredient, Blend, BlendIngredient, ImportJob, PriceRecord, Recipe, RecipeBlend, StockEntry, StockLevel
 
 admin.site.register(Ingredient)
+admin.site.register(IngredientAlias)
 admin.site.register(Brew)
 admin.site.register(BrewIngredient)
 admin.site.register(Blend)
 admin.site.register(BlendIngredient)
 admin.site.register(Recipe)
-admin.site.register(RecipeBlend)
\ No newline at end of file
+admin.site.register(RecipeBlend)
+admin.site.register(ImportJob)
+admin.site.register(PriceRecord)
+admin.site.register(StockEntry)
+admin.site.register(StockLevel)
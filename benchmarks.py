@@ -0,0 +1,302 @@
+import io
+import json
+import random
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from .exporters import stream_recipe_csv
+from .factories import blend_rows, make_blends, make_ingredients, make_recipes
+from .importers import import_recipe_csv
+from .jobs import run_import_job
+from .matching import IngredientIndex
+from .models import Blend, BlendIngredient, ImportJob, Ingredient, Recipe
+from .rollup import BlendRollup
+from .similarity import BlendIndex
+
+
+Catalogue = namedtuple("Catalogue", "ingredient_ids blend_ids recipe_ids blend_ingredients")
+Scenario = namedtuple("Scenario", "name run query_budget seconds_budget", defaults=(None,))
+BenchmarkResult = namedtuple(
+    "BenchmarkResult", "name seconds queries query_budget seconds_budget", defaults=(None,)
+)
+
+# Catalogue sizes for the benchmark command. "large" is the size the
+# optimisations are aimed at, "small" runs in seconds.
+SCALES = {
+    "tiny": dict(ingredients=50, blends=40, rows_per_blend=5, recipes=2, blends_per_recipe=5),
+    "small": dict(ingredients=1000, blends=2000, rows_per_blend=10, recipes=20, blends_per_recipe=20),
+    "large": dict(ingredients=10000, blends=50000, rows_per_blend=20, recipes=200, blends_per_recipe=50),
+}
+
+# A scenario regresses when it is this much slower than the saved baseline
+REGRESSION_THRESHOLD = 0.25
+
+BATCH_SIZE = 5000
+
+# Fuzzy lookups are made for every unknown name of an import, so each of
+# them has to stay under this many seconds
+MATCH_SECONDS = 0.001
+
+_words = (
+    "black", "green", "white", "oolong", "rooibos", "nettle", "tulsi", "ginger", "licorice",
+    "cinnamon", "hibiscus", "mint", "chamomile", "lemongrass", "dandelion", "rose", "orange",
+    "clove", "cardamom", "fennel", "lavender", "sage", "thyme", "yarrow", "burdock",
+)
+
+
+def generate_catalogue(seed=0, ingredients=1000, blends=2000, rows_per_blend=10,
+                       nested_share=0.05, recipes=20, blends_per_recipe=20):
+    """Fill the database with a random but repeatable catalogue.
+
+    Every blend gets ``rows_per_blend`` distinct ingredients. About
+    ``nested_share`` of the blends also nest an earlier blend, stored the
+    way Blend.add_blend stores it, so nesting is never circular. Rows are
+    written with the test factories' bulk inserts, ``BATCH_SIZE`` at a time.
+    """
+    rng = random.Random(seed)
+    rows_per_blend = min(rows_per_blend, ingredients)
+
+    ingredient_ids = [
+        ingredient.pk
+        for ingredient in make_ingredients(
+            ("{} {} {}".format(rng.choice(_words), rng.choice(_words), i) for i in range(ingredients)),
+            batch_size=BATCH_SIZE,
+        )
+    ]
+    blend_ids = [
+        blend.pk
+        for blend in make_blends(
+            [("{} blend {}".format(rng.choice(_words), i), ()) for i in range(blends)], batch_size=BATCH_SIZE
+        )
+    ]
+
+    # Only the first blends can be nested, so only their rows are kept
+    nestable = {}
+    nestable_count = max(1, blends // 10)
+    batch = []
+    total_rows = 0
+    for index, blend_id in enumerate(blend_ids):
+        rows = [
+            (ingredient_id, Decimal(rng.randint(100, 100000)) / 100, Decimal(rng.randint(1, 50000)) / 10000, "g")
+            for ingredient_id in rng.sample(ingredient_ids, rows_per_blend)
+        ]
+        if index < nestable_count:
+            nestable[blend_id] = rows
+        batch.extend(blend_rows(blend_id, rows))
+
+        if index and rng.random() < nested_share:
+            child_id = blend_ids[rng.randrange(min(index, nestable_count))]
+            child_rows = nestable[child_id]
+            child_total = sum(amount for _, amount, _, _ in child_rows)
+            nested_amount = Decimal(rng.randint(10, 500))
+            batch.extend(blend_rows(blend_id, (
+                (ingredient_id, (amount / child_total * nested_amount).quantize(Decimal("0.00001")), cost, unit, child_id)
+                for ingredient_id, amount, cost, unit in child_rows
+            )))
+
+        if len(batch) >= BATCH_SIZE:
+            BlendIngredient.objects.bulk_create(batch, ignore_conflicts=True)
+            total_rows += len(batch)
+            batch = []
+    BlendIngredient.objects.bulk_create(batch, ignore_conflicts=True)
+    total_rows += len(batch)
+
+    recipe_ids = [
+        recipe.pk
+        for recipe in make_recipes(
+            [
+                ("recipe {}".format(i), rng.sample(blend_ids, min(blends_per_recipe, len(blend_ids))))
+                for i in range(recipes)
+            ],
+            batch_size=BATCH_SIZE,
+        )
+    ]
+
+    return Catalogue(ingredient_ids, blend_ids, recipe_ids, total_rows)
+
+
+def measure(run, repeat=3):
+    """Best wall time over ``repeat`` runs and the query count of one run"""
+    best = None
+    queries = 0
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+        queries = len(context.captured_queries)
+        best = seconds if best is None else min(best, seconds)
+    return best, queries
+
+
+def rolled_back(run):
+    """Wrap ``run`` so whatever it writes is undone afterwards"""
+
+    def wrapper():
+        with transaction.atomic():
+            run()
+            transaction.set_rollback(True)
+
+    return wrapper
+
+
+class BenchmarkSuite:
+    """The timed scenarios for one generated catalogue.
+
+    Every scenario has a query budget: the number of queries it may make
+    however large the catalogue is, or a budget that grows with what it
+    reads where that is inherent, such as one query per import chunk.
+    Scenarios with a latency target also have a budget in seconds.
+    """
+
+    def __init__(self, catalogue, sample_blends=100, import_chunk_size=2000, sample_names=50):
+        self.catalogue = catalogue
+        self.factory = RequestFactory()
+        self.recipe = Recipe.objects.get(pk=catalogue.recipe_ids[0])
+        self.sample_blend_ids = catalogue.blend_ids[:sample_blends]
+        self.import_chunk_size = import_chunk_size
+        self.recipe_csv = "".join(stream_recipe_csv(self.recipe))
+        self.check_recipe = None
+        self.ingredient_index = IngredientIndex.build()
+        # Spellings an import meets: a plural, and an extra word
+        names = Ingredient.objects.filter(
+            pk__in=catalogue.ingredient_ids[:sample_names]
+        ).values_list('name', flat=True)
+        self.match_names = [variant for name in names for variant in (name + "s", "organic " + name)]
+
+    def setUp(self):
+        # check_recipe_file plans the recipe's own file, and only for
+        # recipes without blends, so give it a copy of the export
+        self.check_recipe = Recipe.objects.create(name="benchmark check")
+        self.check_recipe.file.save("benchmark-check.csv", ContentFile(self.recipe_csv.encode()))
+
+    def tearDown(self):
+        if self.check_recipe is not None:
+            default_storage.delete(self.check_recipe.file.name)
+            self.check_recipe.delete()
+            self.check_recipe = None
+
+    def scenarios(self):
+        from . import views
+
+        rows = self.recipe_csv.count("\n") - 1
+        chunks = rows // self.import_chunk_size + 1
+        sample = len(self.sample_blend_ids)
+        return [
+            Scenario("recipes", lambda: views.recipes(self.factory.get("/recipes")), 4),
+            Scenario(
+                "recipes_api",
+                lambda: views.recipes_api(self.factory.get("/api/recipes", {"page_size": 50})),
+                3,
+            ),
+            Scenario(
+                "recipe_detail",
+                lambda: views.recipe_detail(self.factory.get("/recipe"), self.recipe.pk),
+                4,
+            ),
+            Scenario(
+                "check_recipe_file",
+                lambda: views.check_recipe_file(self.factory.get("/check"), self.check_recipe.pk),
+                6,
+            ),
+            # The view only queues the job, which runs once its transaction
+            # commits. Each chunk is planned and saved in its own savepoint,
+            # the shared name index may have to be built first.
+            Scenario("check_job", rolled_back(self.check_job), 6 * chunks + 10),
+            Scenario(
+                "export_csv",
+                lambda: b"".join(
+                    views.export_recipe(self.factory.get("/export"), self.recipe.pk).streaming_content
+                ),
+                2,
+            ),
+            Scenario(
+                "import_csv",
+                rolled_back(lambda: import_recipe_csv(io.StringIO(self.recipe_csv), chunk_size=self.import_chunk_size)),
+                8 * chunks + 4,
+            ),
+            Scenario("blend_ratios", self.blend_ratios, 2 * sample + 2),
+            Scenario("blend_rollup", BlendRollup.load, 1),
+            Scenario("similar_blends", self.similar_blends, 1),
+            Scenario("match_ingredients", self.match_ingredients, 0, MATCH_SECONDS * len(self.match_names)),
+        ]
+
+    def check_job(self):
+        """Run a CHECK job of the recipe's export as a worker would, a chunk per transaction"""
+        job = ImportJob.objects.create(recipe=self.check_recipe, kind=ImportJob.CHECK)
+        run_import_job(job.pk, chunk_size=self.import_chunk_size)
+
+    def blend_ratios(self):
+        """The ratio methods as a page calls them, one blend at a time"""
+        ingredient_ids = {}
+        for blend_id, ingredient_id in BlendIngredient.objects.filter(
+            blend_id__in=self.sample_blend_ids
+        ).values_list('blend_id', 'ingredient_id'):
+            ingredient_ids.setdefault(blend_id, []).append(ingredient_id)
+        for blend in Blend.objects.filter(id__in=self.sample_blend_ids):
+            first, last = ingredient_ids[blend.pk][0], ingredient_ids[blend.pk][-1]
+            blend.get_ingredient_ratio(first)
+            blend.get_ingredients_ratio(first, last)
+
+    def similar_blends(self):
+        """Build a blend index and find the neighbours of the sample blends in batches"""
+        BlendIndex.build().nearest(self.sample_blend_ids, k=10)
+
+    def match_ingredients(self):
+        """Fuzzy lookups of names an import does not know exactly"""
+        for name in self.match_names:
+            self.ingredient_index.match(name)
+
+    def run(self, repeat=3, names=None):
+        """Run the scenarios, or those in ``names``, and return BenchmarkResults"""
+        results = []
+        self.setUp()
+        try:
+            for scenario in self.scenarios():
+                if names and scenario.name not in names:
+                    continue
+                seconds, queries = measure(scenario.run, repeat)
+                results.append(BenchmarkResult(
+                    scenario.name, seconds, queries, scenario.query_budget, scenario.seconds_budget
+                ))
+        finally:
+            self.tearDown()
+        return results
+
+
+def find_regressions(results, baseline=None, threshold=REGRESSION_THRESHOLD):
+    """Describe every result over its budgets or slower than the baseline.
+
+    ``baseline`` maps scenario names to a dict with ``seconds`` and
+    ``queries``, as written by results_to_json.
+    """
+    baseline = baseline or {}
+    regressions = []
+    for result in results:
+        if result.queries > result.query_budget:
+            regressions.append("{}: {} queries, budget {}".format(result.name, result.queries, result.query_budget))
+        if result.seconds_budget is not None and result.seconds > result.seconds_budget:
+            regressions.append("{}: {:.3f}s, budget {:.3f}s".format(result.name, result.seconds, result.seconds_budget))
+        before = baseline.get(result.name)
+        if before is None:
+            continue
+        if result.queries > before["queries"]:
+            regressions.append("{}: {} queries, was {}".format(result.name, result.queries, before["queries"]))
+        if result.seconds > before["seconds"] * (1 + threshold):
+            regressions.append("{}: {:.3f}s, was {:.3f}s".format(result.name, result.seconds, before["seconds"]))
+    return regressions
+
+
+def results_to_json(results):
+    return json.dumps(
+        {result.name: {"seconds": result.seconds, "queries": result.queries} for result in results},
+        indent=2,
+        sort_keys=True,
+    )
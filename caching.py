@@ -0,0 +1,158 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Tags, Warning, register
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from .loaders import load_recipe_tree
+from .models import Blend, BlendIngredient, Ingredient, Recipe, RecipeBlend
+
+
+# Cache alias and timeout for recipe pages. Each recipe has one key per
+# cached part, holding the part with the Recipe.modified it was built
+# for, so the cache holds at most len(CACHED_PARTS) entries per recipe
+# and an edit deletes them. The backend's MAX_ENTRIES bounds the rest:
+# see check_recipe_cache for the backends that evict by use.
+DEFAULT_CACHE_ALIAS = "default"
+DEFAULT_TIMEOUT = 60 * 60
+
+# Backends that cull without regard to use once MAX_ENTRIES is reached
+CULLING_BACKENDS = (
+    "django.core.cache.backends.filebased.FileBasedCache",
+    "django.core.cache.backends.db.DatabaseCache",
+)
+
+# For each model, the attribute of a changed instance and the Recipe
+# lookup that finds the recipes showing it
+RECIPE_DEPENDENCIES = {
+    RecipeBlend: ("recipe_id", "pk__in"),
+    Blend: ("pk", "recipeblend__blend_id__in"),
+    BlendIngredient: ("blend_id", "recipeblend__blend_id__in"),
+    Ingredient: ("pk", "recipeblend__blend__blendingredient__ingredient_id__in"),
+}
+
+
+def get_cache_alias():
+    return getattr(settings, "BREW_CACHE_ALIAS", DEFAULT_CACHE_ALIAS)
+
+
+def get_cache():
+    return caches[get_cache_alias()]
+
+
+@register(Tags.caches)
+def check_recipe_cache(app_configs, **kwargs):
+    """Warn when recipe pages are cached in a backend that does not evict least recently used entries"""
+    alias = get_cache_alias()
+    backend = settings.CACHES.get(alias, {}).get("BACKEND")
+    if backend not in CULLING_BACKENDS:
+        return []
+    return [Warning(
+        "Recipe pages are cached in {!r}, whose {} culls entries without regard to use.".format(alias, backend),
+        hint=(
+            "Set BREW_CACHE_ALIAS to a local-memory, Memcached or Redis cache, "
+            "which evict least recently used entries."
+        ),
+        id="brew.W001",
+    )]
+
+
+def recipe_cache_key(recipe_id, part):
+    return "brew:recipe:{}:{}".format(recipe_id, part)
+
+
+def recipe_version(recipe):
+    return recipe.modified.timestamp()
+
+
+def recipe_etag(recipe):
+    return '"{}-{}"'.format(recipe.pk, recipe.modified.timestamp() if recipe.modified else 0)
+
+
+def invalidate_recipes(model, ids):
+    """Mark every recipe depending on the given rows of ``model`` as modified.
+
+    Bumping Recipe.modified changes the recipe's ETag, and the cached
+    parts of the recipes touched are deleted. Returns the number of
+    recipes touched.
+    """
+    ids = {pk for pk in ids if pk is not None}
+    if not ids:
+        return 0
+    lookup = RECIPE_DEPENDENCIES[model][1]
+    recipe_ids = set(Recipe.objects.filter(**{lookup: ids}).values_list('pk', flat=True))
+    if not recipe_ids:
+        return 0
+    get_cache().delete_many(
+        [recipe_cache_key(recipe_id, part) for recipe_id in recipe_ids for part in CACHED_PARTS]
+    )
+    return Recipe.objects.filter(pk__in=recipe_ids).update(modified=timezone.now())
+
+
+def invalidate_for_instance(instance):
+    attribute = RECIPE_DEPENDENCIES[type(instance)][0]
+    return invalidate_recipes(type(instance), {getattr(instance, attribute)})
+
+
+def render_recipe_blends(recipe):
+    return mark_safe(render_to_string("brew/recipe_blends.html", {"recipe": recipe}).strip())
+
+
+def recipe_tree_data(recipe):
+    """The blend tree of a loaded recipe as plain data, for caching and JSON"""
+    return [
+        {
+            "id": blend.pk,
+            "name": blend.name,
+            "total_amount": blend.total_amount,
+            "total_cost": blend.total_cost,
+            "ingredients": [
+                {
+                    "id": ingredient.pk,
+                    "name": ingredient.name,
+                    "amount": ingredient.amount,
+                    "unit": ingredient.unit,
+                    "cost": ingredient.cost,
+                    "share": ingredient.share,
+                    "ratio": ingredient.ratio,
+                }
+                for ingredient in blend.ingredient_list
+            ],
+        }
+        for blend in recipe.blends
+    ]
+
+
+CACHED_PARTS = {
+    "blends_html": render_recipe_blends,
+    "tree": recipe_tree_data,
+}
+
+
+def get_cached_recipe_parts(recipes, part):
+    """Map each recipe's pk to its cached ``part``, building the missing ones.
+
+    Recipes that have not been modified since they were created carry no
+    version to check against and are always built. Parts cached for an
+    earlier version are built again. Missing parts are built with one
+    load_recipe_tree call for all of them.
+    """
+    cache = get_cache()
+    versioned = {recipe_cache_key(recipe.pk, part): recipe for recipe in recipes if recipe.modified}
+    cached = cache.get_many(list(versioned))
+    parts = {
+        versioned[key].pk: value
+        for key, (version, value) in cached.items()
+        if version == recipe_version(versioned[key])
+    }
+
+    missing = [recipe for recipe in recipes if recipe.pk not in parts]
+    if missing:
+        built = {}
+        for recipe in load_recipe_tree(missing):
+            parts[recipe.pk] = CACHED_PARTS[part](recipe)
+            if recipe.modified:
+                built[recipe_cache_key(recipe.pk, part)] = (recipe_version(recipe), parts[recipe.pk])
+        cache.set_many(built, getattr(settings, "BREW_RECIPE_CACHE_TIMEOUT", DEFAULT_TIMEOUT))
+    return parts
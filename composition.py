@@ -0,0 +1,76 @@
+from collections import namedtuple
+
+from .units import total_unit
+
+
+CompositionEntry = namedtuple("CompositionEntry", "ingredient_id name amount share cost")
+UnconvertedAmount = namedtuple("UnconvertedAmount", "ingredient_id name amount unit")
+
+
+def _ingredient_id(ingredient):
+    return getattr(ingredient, "pk", ingredient)
+
+
+class Composition:
+    """Ingredient amounts, shares and costs of a blend or brew.
+
+    Built from (ingredient id, name, base unit, amount, cost) rows already
+    aggregated per ingredient and base unit, so every lookup on it is
+    answered in memory. Amounts only add up in one base unit, ``unit``,
+    picked by units.total_unit. Amounts in other units are left out of
+    the amounts, shares and total and listed in ``unconverted``.
+    """
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.unit = total_unit({row[2] for row in rows})
+        self.unconverted = []
+        names = {}
+        amounts = {}
+        costs = {}
+        for ingredient_id, name, unit, amount, cost in rows:
+            names.setdefault(ingredient_id, name)
+            amounts.setdefault(ingredient_id, 0)
+            if unit == self.unit:
+                amounts[ingredient_id] += amount
+            else:
+                self.unconverted.append(UnconvertedAmount(ingredient_id, name, amount, unit))
+            if cost is not None:
+                costs[ingredient_id] = costs.get(ingredient_id, 0) + cost
+        self.total_amount = sum(amounts.values())
+        self.total_cost = sum(costs.values())
+        self.entries = {}
+        for ingredient_id, amount in amounts.items():
+            share = amount / self.total_amount if self.total_amount else 0
+            self.entries[ingredient_id] = CompositionEntry(
+                ingredient_id, names[ingredient_id], amount, share, costs.get(ingredient_id)
+            )
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ingredient):
+        return _ingredient_id(ingredient) in self.entries
+
+    def get(self, ingredient):
+        return self.entries.get(_ingredient_id(ingredient))
+
+    def amount(self, ingredient):
+        entry = self.get(ingredient)
+        return entry.amount if entry else 0
+
+    def share(self, ingredient):
+        entry = self.get(ingredient)
+        return entry.share if entry else 0
+
+    def cost(self, ingredient):
+        entry = self.get(ingredient)
+        return entry.cost if entry else 0
+
+    def ratio(self, ingredient1, ingredient2):
+        ingredient1_amount = self.amount(ingredient1)
+        ingredient2_amount = self.amount(ingredient2)
+        return ingredient1_amount / (ingredient1_amount + ingredient2_amount)
@@ -0,0 +1,65 @@
+import csv
+import json
+
+from .models import BlendIngredient, RecipeBlend
+
+
+EXPORT_HEADERS = ['blend', 'ingredient', 'amount', 'unit', 'cost', 'total', 'ratio']
+
+CHUNK_SIZE = 2000
+
+
+class Echo:
+    """File-like object that hands back what is written, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
+
+
+def iter_recipe_rows(recipe, chunk_size=CHUNK_SIZE):
+    """Yield export rows for every blend ingredient of a recipe.
+
+    Blend totals are read from the stored Blend totals and the rows with
+    a server-side iterator, so the export is a single query however large
+    the recipe is. A row's ratio is its share of the blend total, and 0
+    for rows in another base unit than the total.
+    """
+    rows = (
+        BlendIngredient.objects.filter(
+            blend_id__in=RecipeBlend.objects.filter(recipe=recipe).values('blend_id')
+        )
+        .order_by('blend_id', 'id')
+        .values_list(
+            'blend__name', 'ingredient__name', 'amount', 'unit', 'cost',
+            'base_amount', 'base_unit', 'blend__total_amount', 'blend__total_unit',
+        )
+        .iterator(chunk_size=chunk_size)
+    )
+    for blend_name, ingredient_name, amount, unit, cost, base_amount, base_unit, total, total_unit in rows:
+        yield [
+            blend_name,
+            ingredient_name,
+            amount,
+            unit,
+            cost,
+            amount * cost,
+            base_amount / total if total and base_unit == total_unit else 0,
+        ]
+
+
+def stream_recipe_csv(recipe):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_HEADERS)
+    for row in iter_recipe_rows(recipe):
+        yield writer.writerow(row)
+
+
+def stream_recipe_jsonl(recipe):
+    for row in iter_recipe_rows(recipe):
+        yield json.dumps(dict(zip(EXPORT_HEADERS, row)), default=str) + "\n"
+
+
+EXPORT_FORMATS = {
+    "csv": (stream_recipe_csv, "text/csv"),
+    "jsonl": (stream_recipe_jsonl, "application/jsonl"),
+}
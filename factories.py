@@ -0,0 +1,152 @@
+from collections import namedtuple
+
+from .models import Blend, BlendIngredient, Brew, BrewIngredient, Ingredient, Recipe, RecipeBlend
+
+
+BaseCatalogue = namedtuple("BaseCatalogue", "recipe ingredients brews blends")
+
+# The catalogue of fixtures/brew.yaml, built with bulk inserts instead
+BASE_INGREDIENTS = ("Dandelion Root", "Tulsi", "Licorice", "Ginger Root", "Black Assam Tea", "Cinnamon")
+
+# cost, unit and source of a blend row when its tuple leaves them out
+BLEND_ROW_DEFAULTS = (1, '', None)
+
+
+def _pk(instance):
+    return getattr(instance, 'pk', instance)
+
+
+def _in_order(model, objs):
+    """``objs`` read again in one query, for the totals their rows' bulk insert stored"""
+    fresh = model.objects.in_bulk([obj.pk for obj in objs])
+    return [fresh[obj.pk] for obj in objs]
+
+
+def make_ingredients(names, batch_size=None):
+    return Ingredient.objects.bulk_create([Ingredient(name=name) for name in names], batch_size=batch_size)
+
+
+def blend_rows(blend, rows):
+    """Unsaved BlendIngredients of a blend from (ingredient, amount[, cost[, unit[, source]]]) tuples.
+
+    Ingredients, blends and sources can be instances or ids.
+    """
+    made = []
+    for ingredient, amount, *rest in rows:
+        cost, unit, source = tuple(rest) + BLEND_ROW_DEFAULTS[len(rest):]
+        made.append(BlendIngredient(
+            blend_id=_pk(blend),
+            ingredient_id=_pk(ingredient),
+            amount=amount,
+            unit=unit,
+            cost=cost,
+            source_id=_pk(source),
+        ))
+    return made
+
+
+def make_blends(specs, batch_size=None):
+    """Blends from (name, rows) pairs, in one bulk insert for the blends and one for their rows"""
+    specs = list(specs)
+    blends = Blend.objects.bulk_create([Blend(name=name) for name, _ in specs], batch_size=batch_size)
+    rows = [row for blend, (_, spec_rows) in zip(blends, specs) for row in blend_rows(blend, spec_rows)]
+    if not rows:
+        return blends
+    BlendIngredient.objects.bulk_create(rows, batch_size=batch_size)
+    return _in_order(Blend, blends)
+
+
+def make_blend(name, rows=()):
+    blend, = make_blends([(name, rows)])
+    return blend
+
+
+def make_nested_blend(name, parts, rows=()):
+    """A blend of (blend, amount) parts, stored the way Blend.add_blend stores them, and its own rows"""
+    blend = make_blend(name, rows)
+    nested = [row for part, amount in parts for row in blend.nested_rows(part, amount)]
+    if nested:
+        BlendIngredient.objects.bulk_create(nested)
+        blend.refresh_from_db(fields=['total_amount', 'total_unit', 'total_cost'])
+    return blend
+
+
+def make_blend_tree(name, rows, depth=2, width=2, amount=100):
+    """A blend nesting ``width`` blends per level, ``depth`` levels down to blends of ``rows``.
+
+    Every level is named after its parent, as in "Tree", "Tree.0",
+    "Tree.0.1", and nests ``amount``, twice ``amount`` and so on of the
+    blends below it, as equal copies of the same composition would be
+    the same rows.
+    """
+    if not depth:
+        return make_blend(name, rows)
+    parts = [
+        (make_blend_tree("{}.{}".format(name, number), rows, depth - 1, width, amount), amount * (number + 1))
+        for number in range(width)
+    ]
+    return make_nested_blend(name, parts)
+
+
+def make_brews(specs):
+    """Brews from (name, rows) pairs, rows being (ingredient, amount[, unit]) tuples"""
+    specs = list(specs)
+    brews = Brew.objects.bulk_create([Brew(name=name) for name, _ in specs])
+    rows = [
+        BrewIngredient(brew=brew, ingredient_id=_pk(ingredient), amount=amount, unit=unit[0] if unit else '')
+        for brew, (_, spec_rows) in zip(brews, specs)
+        for ingredient, amount, *unit in spec_rows
+    ]
+    if not rows:
+        return brews
+    BrewIngredient.objects.bulk_create(rows)
+    return _in_order(Brew, brews)
+
+
+def make_recipes(specs, batch_size=None):
+    """Recipes from (name, blends) pairs, in one bulk insert for the recipes and one for their blends"""
+    specs = list(specs)
+    recipes = Recipe.objects.bulk_create([Recipe(name=name) for name, _ in specs], batch_size=batch_size)
+    RecipeBlend.objects.bulk_create(
+        [
+            RecipeBlend(recipe=recipe, blend_id=_pk(blend))
+            for recipe, (_, blends) in zip(recipes, specs)
+            for blend in blends
+        ],
+        batch_size=batch_size,
+    )
+    return recipes
+
+
+def make_recipe_catalogue(recipes, blends_per_recipe, rows, recipe_name="Recipe {}", blend_name="Blend {}.{}"):
+    """``recipes`` recipes of ``blends_per_recipe`` blends of ``rows`` each, all in bulk inserts"""
+    blends = make_blends(
+        (blend_name.format(number, blend_number), rows)
+        for number in range(recipes)
+        for blend_number in range(blends_per_recipe)
+    )
+    return make_recipes(
+        (recipe_name.format(number), blends[number * blends_per_recipe:(number + 1) * blends_per_recipe])
+        for number in range(recipes)
+    )
+
+
+def build_base_catalogue():
+    """The recipe, ingredients, brews and blends the tests start from, keyed by name"""
+    recipe, = make_recipes([("Test Recipe", ())])
+    ingredients = {ingredient.name: ingredient for ingredient in make_ingredients(BASE_INGREDIENTS)}
+    brews = make_brews([
+        ("Simple Brew", [(ingredients["Dandelion Root"], 1), (ingredients["Tulsi"], 1)]),
+        ("Complex Brew", ()),
+    ])
+    blends = make_blends([
+        ("Simple Blend", [(ingredients["Dandelion Root"], 123, 23, "g")]),
+        ("Complex Blend", ()),
+        ("Combination Blend", ()),
+    ])
+    return BaseCatalogue(
+        recipe,
+        ingredients,
+        {brew.name: brew for brew in brews},
+        {blend.name: blend for blend in blends},
+    )
@@ -0,0 +1,485 @@
+import csv
+from collections import Counter, namedtuple
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+
+from .caching import invalidate_recipes
+from .matching import add_to_ingredient_index, normalize_name
+from .models import Blend, BlendIngredient, Brew, BrewIngredient, Ingredient, RecipeBlend, nested_blend_rows
+from .parsers import parse_column, purchase_date
+from .planner import (
+    new_blend_names,
+    new_ingredient_names,
+    resolve_blend_names,
+    resolve_brew_names,
+    resolve_ingredient_names,
+)
+from .pricing import record_purchase_prices
+
+
+RecipeRow = namedtuple(
+    "RecipeRow", "line blend_name ingredient_name amount unit cost notes ratio", defaults=(None,)
+)
+BrewRow = namedtuple("BrewRow", "line brew_name ingredient_name amount unit price_per_kilogram cost notes")
+
+# Header names accepted for each column, in order of preference. The first
+# set matches the purchase spreadsheet, the others the older exports.
+COLUMNS = {
+    "blend_name": ("Name", "blend", "Blend.name"),
+    "ingredient_name": ("item", "ingredient", "BlendIngredient.name"),
+    "amount": ("amount", "BlendIngredient.amount"),
+    "unit": ("unit", "BlendIngredient.unit"),
+    "cost": ("cost/unit", "cost", "BlendIngredient.cost"),
+    "total_cost": ("total cost", "total"),
+    "ratio": ("weight ratio", "ratio"),
+    "notes": ("Notes", "notes"),
+}
+
+CHUNK_SIZE = 2000
+
+NESTING_CYCLE_MESSAGE = "Blends nest inside themselves, not loaded"
+EMPTY_NESTED_MESSAGE = "Nested blend has no ingredients, not loaded"
+
+
+class ImportReport:
+    """Counts of what a recipe import read and wrote"""
+
+    def __init__(self):
+        self.rows_read = 0
+        self.ingredients_created = 0
+        self.ingredients_matched = 0
+        self.blends_created = 0
+        self.blend_ingredients_created = 0
+        self.blend_ingredients_existing = 0
+        self.brews_created = 0
+        self.brew_ingredients_created = 0
+        self.prices_recorded = 0
+        self.chunks = 0
+        self.errors = []
+
+    @property
+    def status(self):
+        return 'Import Success' if not self.errors else 'Imported with errors'
+
+    def counts(self):
+        return {key: value for key, value in vars(self).items() if isinstance(value, int)}
+
+    def as_dict(self):
+        return {
+            "status": self.status,
+            "rows_read": self.rows_read,
+            "ingredients_created": self.ingredients_created,
+            "ingredients_matched": self.ingredients_matched,
+            "blends_created": self.blends_created,
+            "blend_ingredients_created": self.blend_ingredients_created,
+            "blend_ingredients_existing": self.blend_ingredients_existing,
+            "brews_created": self.brews_created,
+            "brew_ingredients_created": self.brew_ingredients_created,
+            "prices_recorded": self.prices_recorded,
+            "chunks": self.chunks,
+            "errors": self.errors,
+        }
+
+
+def find_columns(header, start=0, end=None):
+    """Map each known column to the index of its first matching header.
+
+    Only headers between ``start`` and ``end`` are searched, so a table
+    sitting beside others in the same sheet can be read on its own.
+    """
+    names = [name.strip() for name in header[start:end]]
+    columns = {}
+    for column, candidates in COLUMNS.items():
+        for name in candidates:
+            if name in names:
+                columns[column] = start + names.index(name)
+                break
+    missing = {"blend_name", "ingredient_name", "amount"} - columns.keys()
+    if missing:
+        raise ValueError("Recipe file is missing columns: {}".format(", ".join(sorted(missing))))
+    return columns
+
+
+def cell(row, columns, column):
+    index = columns.get(column)
+    if index is None or index >= len(row):
+        return ""
+    return row[index]
+
+
+RECIPE_COLUMN_KINDS = {
+    "amount": "quantity",
+    "cost": "currency",
+    "total_cost": "currency",
+    "ratio": "percent",
+}
+
+
+def to_field_places(value, field_name):
+    """Round ``value`` to the places of a BlendIngredient field, or None if the field cannot hold it"""
+    field = BlendIngredient._meta.get_field(field_name)
+    try:
+        value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+    except InvalidOperation:
+        return None
+    return value if len(value.as_tuple().digits) <= field.max_digits else None
+
+
+def parse_recipe_rows(rows, columns, errors=None):
+    """Turn a batch of (line, row) pairs into RecipeRows.
+
+    Each numeric column of the batch is converted in one parse_column
+    call. Rows without a blend or ingredient name are dropped, rows with
+    unreadable numbers are reported in ``errors`` as (line, message).
+    """
+    rows = [
+        (line, row) for line, row in rows
+        if cell(row, columns, "blend_name").strip() and cell(row, columns, "ingredient_name").strip()
+    ]
+    parsed = {
+        column: parse_column([cell(row, columns, column) for line, row in rows], kind)
+        for column, kind in RECIPE_COLUMN_KINDS.items()
+    }
+    bad = {}
+    for column in RECIPE_COLUMN_KINDS:
+        for index, message in parsed[column].errors:
+            bad.setdefault(index, message)
+
+    recipe_rows = []
+    for index, (line, row) in enumerate(rows):
+        if index in bad:
+            if errors is not None:
+                errors.append((line, bad[index]))
+            continue
+        quantity = parsed["amount"].values[index]
+        if quantity is None:
+            if errors is not None:
+                errors.append((line, "Missing amount"))
+            continue
+        amount = quantity.amount
+        cost = parsed["cost"].values[index]
+        total_cost = parsed["total_cost"].values[index]
+        # The spreadsheet rounds cost/unit to cents, the total keeps the precision
+        if total_cost is not None and amount:
+            cost = total_cost / amount
+        amount = to_field_places(amount, "amount")
+        cost = to_field_places(cost or Decimal(0), "cost")
+        if amount is None or cost is None:
+            if errors is not None:
+                errors.append((line, "Amount or cost is too large"))
+            continue
+        recipe_rows.append(RecipeRow(
+            line,
+            cell(row, columns, "blend_name").strip(),
+            cell(row, columns, "ingredient_name").strip(),
+            amount,
+            cell(row, columns, "unit").strip() or quantity.unit,
+            cost,
+            cell(row, columns, "notes").strip(),
+            parsed["ratio"].values[index],
+        ))
+    return recipe_rows
+
+
+def read_recipe_rows(csvfile, errors=None, batch_size=CHUNK_SIZE):
+    """Yield a RecipeRow for every blend ingredient line in a recipe CSV.
+
+    Rows without a blend or ingredient name are skipped. Rows whose
+    numbers cannot be read are reported in ``errors`` as (line, message).
+    """
+    reader = csv.reader(csvfile)
+    columns = find_columns(next(reader))
+
+    for batch in chunked(enumerate(reader, start=2), batch_size):
+        yield from parse_recipe_rows(batch, columns, errors)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BulkImporter:
+    """Write chunks of parsed rows with batched lookups and bulk inserts.
+
+    Names already resolved are remembered across chunks, so memory grows
+    with the number of distinct names, not with rows. Subclasses write
+    their own rows in ``import_chunk``.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, report=None):
+        self.chunk_size = chunk_size
+        self.report = report if report is not None else ImportReport()
+        self.ingredient_ids = {}
+        self.created_ingredient_ids = set()
+
+    def run(self, rows):
+        for chunk in chunked(rows, self.chunk_size):
+            self.write_chunk(chunk)
+        self.finish()
+        return self.report
+
+    def write_chunk(self, rows):
+        with transaction.atomic():
+            self.import_chunk(rows)
+        self.report.chunks += 1
+
+    def import_chunk(self, rows):
+        raise NotImplementedError
+
+    def finish(self):
+        """Write what has to wait for every chunk, once they are all written"""
+
+    def resolve_ingredients(self, names):
+        names = names - self.ingredient_ids.keys()
+        if not names:
+            return
+        matched = {}
+        self.ingredient_ids.update(resolve_ingredient_names(names, matched))
+        self.report.ingredients_matched += len(matched)
+        missing = new_ingredient_names(names - self.ingredient_ids.keys())
+        if missing:
+            spellings = set(missing.values())
+            Ingredient.objects.bulk_create(
+                [Ingredient(name=name) for name in sorted(spellings)], ignore_conflicts=True
+            )
+            created = dict(Ingredient.objects.filter(name__in=spellings).values_list('name', 'id'))
+            # bulk_create sends no signals, so keep the shared index current by hand
+            transaction.on_commit(lambda: add_to_ingredient_index(created.items()))
+            self.ingredient_ids.update((name, created[spelling]) for name, spelling in missing.items())
+            self.created_ingredient_ids.update(created.values())
+            self.report.ingredients_created += len(spellings)
+
+
+class RecipeImporter(BulkImporter):
+    """Write recipe rows as Blends and BlendIngredients, linked to ``recipe`` if given.
+
+    Blend names are compared with normalize_name. A row whose item is
+    named like a blend, stored or in the same import, nests that blend
+    the way Blend.add_blend does. Nested rows copy the
+    whole composition of their blend, so they are held back and written
+    by ``finish``, children before parents, once every plain row is in.
+    """
+
+    def __init__(self, recipe=None, chunk_size=CHUNK_SIZE, report=None):
+        super().__init__(chunk_size, report)
+        self.recipe = recipe
+        self.blend_ids = {}
+        self.linked_blend_ids = set()
+        # (line, blend id, nested blend id, amount) waiting for ``finish``
+        self.nested = []
+
+    def import_chunk(self, rows):
+        self.report.rows_read += len(rows)
+        self.resolve_blends({row.blend_name for row in rows}, {row.ingredient_name for row in rows})
+        rows = self.hold_nested(rows)
+        self.resolve_ingredients({row.ingredient_name for row in rows})
+
+        new_rows = {}
+        for row in rows:
+            key = (
+                self.blend_ids[row.blend_name],
+                self.ingredient_ids[row.ingredient_name],
+                row.amount,
+                row.unit,
+                row.cost,
+            )
+            new_rows.setdefault(key, row)
+
+        existing = set(
+            BlendIngredient.objects.filter(
+                blend_id__in={key[0] for key in new_rows}
+            ).values_list('blend_id', 'ingredient_id', 'amount', 'unit', 'cost')
+        )
+        blend_ingredients = [
+            BlendIngredient(blend_id=blend_id, ingredient_id=ingredient_id, amount=amount, unit=unit, cost=cost)
+            for (blend_id, ingredient_id, amount, unit, cost) in new_rows
+            if (blend_id, ingredient_id, amount, unit, cost) not in existing
+        ]
+        BlendIngredient.objects.bulk_create(blend_ingredients, ignore_conflicts=True)
+        self.report.blend_ingredients_created += len(blend_ingredients)
+        self.report.blend_ingredients_existing += len(rows) - len(blend_ingredients)
+
+        # Blends named after a purchase date record what was paid for the rows loaded
+        loaded = {
+            (row.blend_id, row.ingredient_id, row.amount, row.unit, row.cost) for row in blend_ingredients
+        }
+        names = {self.blend_ids[row.blend_name]: row.blend_name for row in rows}
+        purchases = {blend_id: purchase_date(names[blend_id]) for blend_id, *_ in loaded}
+        purchases = {blend_id: date for blend_id, date in purchases.items() if date is not None}
+        if purchases:
+            self.report.prices_recorded += record_purchase_prices(purchases, loaded)
+
+        if self.recipe is not None:
+            self.link_blends({key[0] for key in new_rows})
+
+    def hold_nested(self, rows):
+        """Keep the rows nesting a blend for ``finish`` and return the others"""
+        plain = []
+        for row in rows:
+            source_id = self.blend_ids.get(row.ingredient_name)
+            if source_id is None:
+                plain.append(row)
+            else:
+                self.nested.append((row.line, self.blend_ids[row.blend_name], source_id, row.amount))
+        return plain
+
+    def finish(self):
+        with transaction.atomic():
+            self.unnest_ingredients()
+            self.write_nested()
+
+    def unnest_ingredients(self):
+        """Turn ingredients this import created before a blend of the same name was read into nested rows"""
+        blend_keys = {normalize_name(name): blend_id for name, blend_id in self.blend_ids.items()}
+        ingredient_sources = {
+            ingredient_id: blend_keys[normalize_name(name)] for name, ingredient_id in self.ingredient_ids.items()
+            if ingredient_id in self.created_ingredient_ids and normalize_name(name) in blend_keys
+        }
+        if not ingredient_sources:
+            return
+        rows = BlendIngredient.objects.filter(ingredient_id__in=ingredient_sources).values_list(
+            'blend_id', 'ingredient_id', 'amount'
+        )
+        for blend_id, ingredient_id, amount in rows:
+            self.nested.append((None, blend_id, ingredient_sources[ingredient_id], amount))
+            self.report.blend_ingredients_created -= 1
+        Ingredient.objects.filter(pk__in=ingredient_sources).delete()
+        self.created_ingredient_ids -= ingredient_sources.keys()
+        self.report.ingredients_created -= len(ingredient_sources)
+
+    def write_nested(self):
+        """Write the held back nested rows, each blend once the blends it nests are complete"""
+        pending, self.nested = self.nested, []
+        while pending:
+            nesting = {blend_id for _, blend_id, _, _ in pending}
+            ready = [part for part in pending if part[2] not in nesting]
+            if not ready:
+                break
+            pending = [part for part in pending if part[2] in nesting]
+            self.write_nested_parts(ready)
+        self.report.errors.extend((line, NESTING_CYCLE_MESSAGE) for line, _, _, _ in pending)
+
+    def write_nested_parts(self, parts):
+        part_rows = nested_blend_rows((blend_id, source_id, amount) for _, blend_id, source_id, amount in parts)
+        existing = set(
+            BlendIngredient.objects.filter(
+                blend_id__in={blend_id for _, blend_id, _, _ in parts}
+            ).values_list('blend_id', 'ingredient_id', 'amount', 'unit', 'cost')
+        )
+        blend_ingredients = []
+        for (line, _, _, _), rows in zip(parts, part_rows):
+            if not rows:
+                self.report.errors.append((line, EMPTY_NESTED_MESSAGE))
+                continue
+            keys = {(row.blend_id, row.ingredient_id, row.amount, row.unit, row.cost): row for row in rows}
+            new_rows = [row for key, row in keys.items() if key not in existing]
+            existing.update(keys)
+            self.report.blend_ingredients_created += len(new_rows)
+            self.report.blend_ingredients_existing += len(rows) - len(new_rows)
+            blend_ingredients.extend(new_rows)
+        BlendIngredient.objects.bulk_create(blend_ingredients, ignore_conflicts=True)
+        if self.recipe is not None:
+            self.link_blends({blend_id for _, blend_id, _, _ in parts})
+
+    def resolve_blends(self, names, items=()):
+        """Map blend names to ids, creating missing blends, along with the items named like a stored blend"""
+        names = names - self.blend_ids.keys()
+        items = set(items) - self.blend_ids.keys() - self.ingredient_ids.keys()
+        if not names and not items:
+            return
+        self.blend_ids.update(resolve_blend_names(names | items))
+        missing = new_blend_names(names - self.blend_ids.keys())
+        if missing:
+            spellings = set(missing.values())
+            Blend.objects.bulk_create([Blend(name=name) for name in sorted(spellings)])
+            created = dict(
+                Blend.objects.filter(name__in=spellings).values_list('name_key', 'id')
+            )
+            self.blend_ids.update((name, created[normalize_name(name)]) for name in missing)
+            # Items of this chunk may name the blends it creates
+            self.blend_ids.update(
+                (item, created[normalize_name(item)]) for item in items - self.blend_ids.keys()
+                if normalize_name(item) in created
+            )
+            self.report.blends_created += len(spellings)
+
+    def link_blends(self, blend_ids):
+        blend_ids = blend_ids - self.linked_blend_ids
+        if not blend_ids:
+            return
+        linked = set(
+            RecipeBlend.objects.filter(recipe=self.recipe, blend_id__in=blend_ids)
+            .values_list('blend_id', flat=True)
+        )
+        RecipeBlend.objects.bulk_create(
+            [RecipeBlend(recipe=self.recipe, blend_id=blend_id) for blend_id in sorted(blend_ids - linked)]
+        )
+        if blend_ids - linked:
+            invalidate_recipes(RecipeBlend, {self.recipe.pk})
+        self.linked_blend_ids |= blend_ids
+
+
+class BrewImporter(BulkImporter):
+    """Write brew rows as Brews and BrewIngredients"""
+
+    def __init__(self, chunk_size=CHUNK_SIZE, report=None):
+        super().__init__(chunk_size, report)
+        self.brew_ids = {}
+
+    def import_chunk(self, rows):
+        self.report.rows_read += len(rows)
+        self.resolve_ingredients({row.ingredient_name for row in rows})
+        self.resolve_brews({row.brew_name for row in rows})
+
+        # Brews may add the same amount of an ingredient twice, so rows are
+        # matched against stored ones by count rather than by presence
+        existing = Counter(
+            BrewIngredient.objects.filter(
+                brew_id__in={self.brew_ids[row.brew_name] for row in rows}
+            ).values_list('brew_id', 'ingredient_id', 'amount', 'unit')
+        )
+        new_rows = []
+        for row in rows:
+            # BrewIngredient stores whole amounts
+            key = (
+                self.brew_ids[row.brew_name],
+                self.ingredient_ids[row.ingredient_name],
+                int(row.amount.to_integral_value(ROUND_HALF_UP)),
+                row.unit,
+            )
+            if existing[key]:
+                existing[key] -= 1
+            else:
+                new_rows.append(key)
+        BrewIngredient.objects.bulk_create([
+            BrewIngredient(brew_id=brew_id, ingredient_id=ingredient_id, amount=amount, unit=unit)
+            for brew_id, ingredient_id, amount, unit in new_rows
+        ])
+        self.report.brew_ingredients_created += len(new_rows)
+
+    def resolve_brews(self, names):
+        names = names - self.brew_ids.keys()
+        if not names:
+            return
+        self.brew_ids.update(resolve_brew_names(names))
+        missing = names - self.brew_ids.keys()
+        if missing:
+            Brew.objects.bulk_create([Brew(name=name) for name in missing])
+            self.brew_ids.update(
+                Brew.objects.filter(name__in=missing).values_list('name', 'id')
+            )
+            self.report.brews_created += len(missing)
+
+
+def import_recipe_csv(csvfile, recipe=None, chunk_size=CHUNK_SIZE):
+    """Import a recipe CSV from an open text file and return an ImportReport"""
+    importer = RecipeImporter(recipe, chunk_size=chunk_size)
+    importer.run(read_recipe_rows(csvfile, importer.report.errors))
+    return importer.report
@@ -0,0 +1,219 @@
+import json
+import logging
+import re
+import threading
+import time
+import warnings
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+logger = logging.getLogger(__name__)
+
+# What to do when a view or block goes over its query budget: "log",
+# "warn" or "raise". Tests can set BREW_QUERY_BUDGET_ACTION = "raise".
+DEFAULT_BUDGET_ACTION = "warn"
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_lists = re.compile(r"\bIN \((?:\s*(?:%s|\?|:\w+)\s*,?)+\)", re.IGNORECASE)
+_whitespace = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudgetWarning(RuntimeWarning):
+    pass
+
+
+def fingerprint(sql):
+    """Reduce a query to its shape, so the same lookup with other values matches"""
+    sql = _literals.sub("?", sql)
+    sql = _in_lists.sub("IN (...)", sql)
+    return _whitespace.sub(" ", sql).strip()
+
+
+class QueryStats:
+    """Wall time, queries and rows fetched for one request or block"""
+
+    def __init__(self, name, budget=None):
+        self.name = name
+        self.budget = budget
+        self.seconds = 0
+        self.query_seconds = 0
+        self.rows = 0
+        self.fingerprints = Counter()
+
+    @property
+    def queries(self):
+        return sum(self.fingerprints.values())
+
+    @property
+    def duplicates(self):
+        """Query shapes run more than once, with how often, most repeated first"""
+        return [(sql, count) for sql, count in self.fingerprints.most_common() if count > 1]
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.queries > self.budget
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "seconds": round(self.seconds, 6),
+            "query_seconds": round(self.query_seconds, 6),
+            "queries": self.queries,
+            "rows": self.rows,
+            "budget": self.budget,
+            "duplicates": [{"sql": sql, "count": count} for sql, count in self.duplicates],
+        }
+
+    def __call__(self, execute, sql, params, many, context):
+        """Database execute wrapper recording each query"""
+        cursor = context["cursor"]
+        self._count_rows(cursor)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - start
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def _count_rows(self, cursor):
+        # Rows are fetched after execute returns, so the cursor's fetch
+        # methods are wrapped once and count into every recorder using it
+        recorders = cursor.__dict__.setdefault("_query_stats", [])
+        if self in recorders:
+            return
+        if not recorders:
+            for method, count in (
+                ("fetchone", lambda row: row is not None),
+                ("fetchmany", len),
+                ("fetchall", len),
+            ):
+                cursor.__dict__[method] = _counting(getattr(cursor, method), count, recorders)
+        recorders.append(self)
+
+
+def _counting(fetch, count, recorders):
+    def wrapper(*args, **kwargs):
+        result = fetch(*args, **kwargs)
+        rows = count(result)
+        for stats in recorders:
+            stats.rows += rows
+        return result
+
+    return wrapper
+
+
+class Metrics:
+    """Running totals per view or block name, for the snapshot endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+
+    def record(self, stats):
+        with self.lock:
+            entry = self.entries.setdefault(stats.name, {
+                "calls": 0,
+                "seconds": 0,
+                "max_seconds": 0,
+                "queries": 0,
+                "max_queries": 0,
+                "rows": 0,
+                "over_budget": 0,
+                "duplicates": Counter(),
+            })
+            entry["calls"] += 1
+            entry["seconds"] += stats.seconds
+            entry["max_seconds"] = max(entry["max_seconds"], stats.seconds)
+            entry["queries"] += stats.queries
+            entry["max_queries"] = max(entry["max_queries"], stats.queries)
+            entry["rows"] += stats.rows
+            entry["over_budget"] += stats.over_budget
+            entry["duplicates"].update(dict(stats.duplicates))
+
+    def snapshot(self, top=5):
+        with self.lock:
+            return {
+                name: dict(
+                    entry,
+                    mean_seconds=entry["seconds"] / entry["calls"],
+                    duplicates=[
+                        {"sql": sql, "count": count} for sql, count in entry["duplicates"].most_common(top)
+                    ],
+                )
+                for name, entry in self.entries.items()
+            }
+
+
+metrics = Metrics()
+
+
+def check_budget(stats):
+    if not stats.over_budget:
+        return
+    message = "{} ran {} queries, over its budget of {}".format(stats.name, stats.queries, stats.budget)
+    action = getattr(settings, "BREW_QUERY_BUDGET_ACTION", DEFAULT_BUDGET_ACTION)
+    if action == "raise":
+        raise QueryBudgetExceeded(message)
+    if action == "warn":
+        warnings.warn(message, QueryBudgetWarning, stacklevel=3)
+    logger.warning(message)
+
+
+@contextmanager
+def instrument(name, budget=None, using=DEFAULT_DB_ALIAS):
+    """Record wall time, queries and rows of the block as QueryStats.
+
+    The stats are logged as JSON, added to the metrics snapshot and
+    checked against ``budget``.
+    """
+    stats = QueryStats(name, budget)
+    start = time.perf_counter()
+    with connections[using].execute_wrapper(stats):
+        try:
+            yield stats
+        finally:
+            stats.seconds = time.perf_counter() - start
+    metrics.record(stats)
+    logger.info("%s", json.dumps(stats.as_dict(), sort_keys=True), extra={"query_stats": stats.as_dict()})
+    check_budget(stats)
+
+
+def query_budget(budget):
+    """Give a view a query budget for QueryInstrumentationMiddleware to check"""
+
+    def decorator(view):
+        view.query_budget = budget
+        return view
+
+    return decorator
+
+
+class QueryInstrumentationMiddleware:
+    """Instrument every request, named after the view that handles it"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with instrument(request.path) as stats:
+            request.query_stats = stats
+            response = self.get_response(request)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = request.query_stats
+        view = getattr(view_func, "view_class", view_func)
+        stats.name = "{}.{}".format(view.__module__, view.__name__)
+        stats.budget = getattr(view_func, "query_budget", None)
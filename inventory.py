@@ -0,0 +1,151 @@
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import StockEntry, StockLevel
+from .units import BASE_PLACES, ingredient_densities, to_base_quantity
+
+
+# Days of consumption the burn rate is averaged over
+BURN_RATE_DAYS = 30
+
+StockReport = namedtuple("StockReport", "ingredient_id name on_hand unit burn_rate days_remaining")
+
+
+class StockUnitError(ValueError):
+    """Raised when an entry's base unit differs from the unit its ingredient is stocked in"""
+
+
+def stock_entry(ingredient, kind, amount, unit, densities=None, **fields):
+    """An unsaved StockEntry for ``amount`` in ``unit``, converted to the ingredient's base unit"""
+    ingredient_id = getattr(ingredient, 'pk', ingredient)
+    if densities is None:
+        densities = ingredient_densities([ingredient_id])
+    amount, base_unit = to_base_quantity(amount, unit, densities.get(ingredient_id))
+    return StockEntry(ingredient_id=ingredient_id, kind=kind, amount=amount, unit=base_unit, **fields)
+
+
+def record_entries(entries):
+    """Append unsaved StockEntries to the ledger and move the stock levels they touch.
+
+    The levels are locked for the rest of the transaction, so concurrent
+    bookings of an ingredient queue up and every running balance follows
+    on from the one before. Takes the same few queries however many
+    entries are recorded.
+    """
+    entries = list(entries)
+    if not entries:
+        return entries
+    ingredient_ids = {entry.ingredient_id for entry in entries}
+    now = timezone.now()
+    with transaction.atomic():
+        StockLevel.objects.bulk_create(
+            [StockLevel(ingredient_id=ingredient_id) for ingredient_id in ingredient_ids], ignore_conflicts=True
+        )
+        levels = StockLevel.objects.select_for_update().in_bulk(ingredient_ids)
+        for entry in entries:
+            level = levels[entry.ingredient_id]
+            if entry.unit != level.unit:
+                if level.unit or level.on_hand or level.consumed:
+                    raise StockUnitError(
+                        "Ingredient {} is stocked in {!r}, not {!r}".format(entry.ingredient_id, level.unit, entry.unit)
+                    )
+                level.unit = entry.unit
+            level.on_hand += entry.amount
+            if entry.kind == StockEntry.CONSUMPTION:
+                level.consumed -= entry.amount
+            level.updated = now
+            entry.balance, entry.consumed = level.on_hand, level.consumed
+        StockEntry.objects.bulk_create(entries)
+        StockLevel.objects.bulk_update(levels.values(), ['on_hand', 'consumed', 'unit', 'updated'])
+    return entries
+
+
+def record_purchase(ingredient, amount, unit, **fields):
+    entry, = record_entries([stock_entry(ingredient, StockEntry.PURCHASE, amount, unit, **fields)])
+    return entry
+
+
+def record_stocktake(ingredient, counted, unit, **fields):
+    """Adjust the stock of an ingredient to what was counted, returning the adjustment"""
+    entry = stock_entry(ingredient, StockEntry.ADJUSTMENT, counted, unit, **fields)
+    with transaction.atomic():
+        level = StockLevel.objects.select_for_update().filter(ingredient_id=entry.ingredient_id).first()
+        entry.amount -= level.on_hand if level else 0
+        if not entry.amount:
+            return None
+        entry, = record_entries([entry])
+    return entry
+
+
+def book_brew(brew):
+    """Book a brew's use of its blend out of stock, ingredient by ingredient.
+
+    Blend.add_blend stores a nested blend as copies of its rows, so the
+    blend's own composition is already flattened.
+    """
+    if not brew.blend_id or not brew.blend_amount:
+        return []
+    composition = brew.blend.get_composition()
+    return record_entries(
+        StockEntry(
+            ingredient_id=entry.ingredient_id,
+            kind=StockEntry.CONSUMPTION,
+            amount=-(entry.share * Decimal(brew.blend_amount)).quantize(BASE_PLACES),
+            unit=composition.unit,
+            brew=brew,
+            blend_id=brew.blend_id,
+        )
+        for entry in composition
+        if entry.share
+    )
+
+
+def stock_report(ingredient_ids=None, days=BURN_RATE_DAYS):
+    """Stock on hand, daily burn rate and days remaining per ingredient, in one query.
+
+    Consumption over the last ``days`` is the running total now less the
+    running total of the last entry before the window, found with one
+    index lookup per ingredient however long the ledger is.
+    """
+    start = timezone.now() - datetime.timedelta(days=days)
+    consumed_before = (
+        StockEntry.objects.filter(ingredient_id=OuterRef('ingredient_id'), created__lt=start)
+        .order_by('-created', '-id')
+        .values('consumed')[:1]
+    )
+    levels = StockLevel.objects.annotate(
+        consumed_before=Coalesce(Subquery(consumed_before), Value(Decimal(0)))
+    ).order_by('ingredient__name')
+    if ingredient_ids is not None:
+        levels = levels.filter(ingredient_id__in=ingredient_ids)
+
+    report = []
+    for ingredient_id, name, on_hand, unit, consumed, before in levels.values_list(
+        'ingredient_id', 'ingredient__name', 'on_hand', 'unit', 'consumed', 'consumed_before'
+    ):
+        burn_rate = (consumed - before) / days
+        days_remaining = max(on_hand, 0) / burn_rate if burn_rate > 0 else None
+        report.append(StockReport(ingredient_id, name, on_hand, unit, burn_rate, days_remaining))
+    return report
+
+
+def brews_remaining(blend, amount_per_brew):
+    """How many brews of ``amount_per_brew`` of a blend the stock on hand covers"""
+    composition = blend.get_composition()
+    levels = StockLevel.objects.in_bulk([entry.ingredient_id for entry in composition])
+    amount_per_brew = Decimal(amount_per_brew)
+    remaining = None
+    for entry in composition:
+        needed = entry.share * amount_per_brew
+        if not needed:
+            continue
+        level = levels.get(entry.ingredient_id)
+        brews = int(max(level.on_hand, 0) // needed) if level else 0
+        remaining = brews if remaining is None else min(remaining, brews)
+    return remaining or 0
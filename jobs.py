@@ -0,0 +1,197 @@
+import datetime
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .importers import CHUNK_SIZE, ImportReport, RecipeImporter, chunked, read_recipe_rows
+from .models import BlendIngredient, ImportJob
+from .planner import plan_recipe_import
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+
+# A running job not saved for this long is taken to have died with its worker
+STALE_AFTER = datetime.timedelta(minutes=5)
+
+# Errors kept per job; the count in ``counts`` keeps going past it
+MAX_ERRORS = 1000
+
+CONFLICT_MESSAGE = "Conflicts with a stored blend ingredient, not loaded"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "BREW_IMPORT_WORKERS", DEFAULT_WORKERS),
+                thread_name_prefix="brew-import",
+            )
+        return _executor
+
+
+def queue_import_job(recipe, kind=ImportJob.CHECK):
+    """Create a job and start it once the current transaction commits"""
+    job = ImportJob.objects.create(recipe=recipe, kind=kind)
+    transaction.on_commit(lambda: start_import_job(job.pk))
+    return job
+
+
+def retry_import_job(job):
+    """Queue a failed job again and start it once the current transaction commits.
+
+    ``last_line`` and ``stored_before`` are kept, so the run resumes after
+    the last committed chunk and the rows those chunks loaded do not
+    conflict. Returns False if the job has not failed.
+    """
+    retried = ImportJob.objects.filter(pk=job.pk, status=ImportJob.FAILED).update(
+        status=ImportJob.QUEUED, failure='', finished=None, updated=timezone.now()
+    )
+    if not retried:
+        return False
+    job.status, job.failure, job.finished = ImportJob.QUEUED, '', None
+    transaction.on_commit(lambda: start_import_job(job.pk))
+    return True
+
+
+def start_import_job(job_id):
+    """Run a job on the worker pool, or right away with BREW_IMPORT_JOBS_EAGER"""
+    if getattr(settings, "BREW_IMPORT_JOBS_EAGER", False):
+        return run_import_job(job_id)
+    return get_executor().submit(_run_in_worker, job_id)
+
+
+def _run_in_worker(job_id):
+    try:
+        return run_import_job(job_id)
+    finally:
+        # Worker threads open their own connections
+        connection.close()
+
+
+def claimable_jobs():
+    """Jobs waiting to run, and running jobs whose worker stopped saving them"""
+    return ImportJob.objects.filter(
+        Q(status=ImportJob.QUEUED)
+        | Q(status=ImportJob.RUNNING, updated__lt=timezone.now() - STALE_AFTER)
+    )
+
+
+def claim_job(job_id):
+    return claimable_jobs().filter(pk=job_id).update(
+        status=ImportJob.RUNNING, started=timezone.now(), updated=timezone.now()
+    ) == 1
+
+
+def resume_import_jobs():
+    """Start every queued or abandoned job on the worker pool"""
+    return [start_import_job(job_id) for job_id in claimable_jobs().order_by('created').values_list('pk', flat=True)]
+
+
+def run_import_job(job_id, chunk_size=CHUNK_SIZE):
+    """Claim and run one job. Returns the job, or None if another worker has it."""
+    if not claim_job(job_id):
+        return None
+    job = ImportJob.objects.select_related('recipe').get(pk=job_id)
+    try:
+        JobRun(job, chunk_size).run()
+    except Exception as error:
+        logger.exception("Import job %s failed", job.pk)
+        job.status = ImportJob.FAILED
+        job.failure = str(error)
+    else:
+        job.status = ImportJob.DONE
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'failure', 'finished', 'updated'])
+    return job
+
+
+class JobRun:
+    """Read a job's file in chunks, committing each chunk with the job's progress"""
+
+    def __init__(self, job, chunk_size=CHUNK_SIZE):
+        self.job = job
+        self.chunk_size = chunk_size
+        self.counts = Counter(job.counts.get("totals", {}))
+        self.names = {
+            key: set(job.counts.get(key, ())) for key in ("blends_to_create", "ingredients_to_create", "ingredients_matched")
+        }
+        self.importer = RecipeImporter(job.recipe, chunk_size) if job.kind == ImportJob.LOAD else None
+
+    def run(self):
+        if self.job.stored_before is None:
+            self.job.stored_before = BlendIngredient.objects.aggregate(last=Max('pk'))['last'] or 0
+            self.job.save(update_fields=['stored_before', 'updated'])
+        # read_recipe_rows keeps appending to this list, so it is only
+        # ever trimmed in place
+        errors = []
+        with open(self.job.recipe.file.path, newline='') as csvfile:
+            rows = read_recipe_rows(csvfile, errors, batch_size=self.chunk_size)
+            for chunk in chunked(rows, self.chunk_size):
+                if self.importer is not None:
+                    self.hold_committed([row for row in chunk if row.line <= self.job.last_line])
+                chunk = [row for row in chunk if row.line > self.job.last_line]
+                if chunk:
+                    end = chunk[-1].line
+                    self.commit(chunk, [error for error in errors if error[0] <= end], end)
+                    errors[:] = [error for error in errors if error[0] > end]
+        errors = [error for error in errors if error[0] > self.job.last_line]
+        if errors:
+            self.commit([], errors, errors[-1][0])
+        if self.importer is not None:
+            self.finish()
+
+    def hold_committed(self, rows):
+        """Hold the nested rows of chunks a previous run committed, in case it stopped before finishing"""
+        if rows:
+            self.importer.resolve_blends({row.blend_name for row in rows}, {row.ingredient_name for row in rows})
+            self.importer.hold_nested(rows)
+
+    def finish(self):
+        """Write the nested blend rows the importer held back, with the job's final counts"""
+        with transaction.atomic():
+            self.importer.report = ImportReport()
+            self.importer.finish()
+            self.counts.update(self.importer.report.counts())
+            self.save_progress(self.importer.report.errors)
+
+    def commit(self, rows, errors, last_line):
+        with transaction.atomic():
+            plan = plan_recipe_import(rows, self.job.stored_before)
+            if self.importer is not None:
+                # Only rows that are neither stored nor conflicting are loaded
+                self.importer.report = ImportReport()
+                self.importer.write_chunk(plan.rows_to_create)
+                self.counts.update(self.importer.report.counts())
+            self.counts.update(
+                rows=len(rows),
+                rows_to_create=len(plan.rows_to_create),
+                rows_matching=len(plan.rows_matching),
+                rows_conflicting=len(plan.rows_conflicting),
+            )
+            self.names["blends_to_create"].update(plan.blends_to_create)
+            self.names["ingredients_to_create"].update(plan.ingredients_to_create)
+            self.names["ingredients_matched"].update(plan.ingredients_matched)
+
+            errors = sorted(errors + [(row.line, CONFLICT_MESSAGE) for row in plan.rows_conflicting])
+            self.job.last_line = last_line
+            self.job.chunks += 1
+            self.save_progress(errors)
+
+    def save_progress(self, errors):
+        self.counts.update(errors=len(errors))
+        job = self.job
+        job.errors = (job.errors + [list(error) for error in errors])[:MAX_ERRORS]
+        job.counts = dict({key: sorted(names) for key, names in self.names.items()}, totals=dict(self.counts))
+        job.save(update_fields=['errors', 'counts', 'last_line', 'chunks', 'updated'])
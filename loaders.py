@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+from django.db.models import Prefetch, prefetch_related_objects
+
+from .composition import Composition
+from .models import BlendIngredient, Recipe, RecipeBlend
+
+
+def load_recipe_tree(recipes=None):
+    """Load recipes with their blends and ingredients in a fixed number of queries.
+
+    Each recipe gets a ``blends`` list. Each blend gets an ``ingredient_list``
+    of Ingredients carrying ``amount``, ``unit``, ``share`` and a formatted
+    ``ratio``, and has its composition primed so the model ratio methods
+    do not query again. ``recipes`` may be a queryset or a list of
+    recipes already fetched, which saves querying them again.
+    """
+    if recipes is None:
+        recipes = Recipe.objects.all()
+
+    recipes = list(recipes)
+    prefetch_related_objects(
+        recipes,
+        Prefetch(
+            'recipeblend_set',
+            queryset=RecipeBlend.objects.select_related('blend').order_by('added', 'id'),
+        ),
+        Prefetch(
+            'recipeblend_set__blend__blendingredient_set',
+            queryset=BlendIngredient.objects.select_related('ingredient').order_by('id'),
+        ),
+    )
+
+    for recipe in recipes:
+        recipe.blends = []
+        for recipe_blend in recipe.recipeblend_set.all():
+            blend = recipe_blend.blend
+            if not hasattr(blend, 'ingredient_list'):
+                build_blend_tree(blend, blend.blendingredient_set.all())
+            recipe.blends.append(blend)
+
+    return recipes
+
+
+def build_blend_tree(blend, blend_ingredients):
+    """Fill in ``blend.ingredient_list`` from already fetched BlendIngredients.
+
+    Amounts and shares are in the blend's base unit, so rows of one
+    ingredient entered in different units of it add up.
+    """
+    ingredients = {}
+    amounts = defaultdict(int)
+    costs = defaultdict(int)
+    units = {}
+
+    for blend_ingredient in blend_ingredients:
+        ingredient_id = blend_ingredient.ingredient_id
+        ingredients.setdefault(ingredient_id, blend_ingredient.ingredient)
+        units.setdefault(ingredient_id, blend_ingredient.unit)
+        amounts[ingredient_id, blend_ingredient.base_unit] += blend_ingredient.base_amount
+        costs[ingredient_id, blend_ingredient.base_unit] += blend_ingredient.amount * blend_ingredient.cost
+
+    blend._composition = Composition(
+        (ingredient_id, ingredients[ingredient_id].name, unit, amount, costs[ingredient_id, unit])
+        for (ingredient_id, unit), amount in sorted(amounts.items())
+    )
+
+    blend.ingredient_list = []
+    for entry in blend._composition:
+        ingredient = ingredients[entry.ingredient_id]
+        ingredient.amount = entry.amount
+        ingredient.unit = blend._composition.unit or units[entry.ingredient_id]
+        ingredient.cost = entry.cost
+        ingredient.share = entry.share
+        ingredient.ratio = "{0:.0%}".format(entry.share)
+        blend.ingredient_list.append(ingredient)
+
+    return blend
@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...benchmarks import (
+    REGRESSION_THRESHOLD,
+    SCALES,
+    BenchmarkSuite,
+    find_regressions,
+    generate_catalogue,
+    results_to_json,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the recipe views, import, export and blend calculations against a "
+        "generated catalogue. Everything generated is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--scenario", action="append", dest="scenarios",
+                            help="Only run this scenario, may be repeated")
+        parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+        parser.add_argument("--save", help="Write the results as JSON to this file")
+        parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                            help="Allowed slowdown against the baseline, 0.25 being 25%%")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        with transaction.atomic():
+            self.stdout.write("Generating {} catalogue...".format(options["scale"]))
+            catalogue = generate_catalogue(seed=options["seed"], **SCALES[options["scale"]])
+            self.stdout.write("{} ingredients, {} blends, {} blend ingredients".format(
+                len(catalogue.ingredient_ids), len(catalogue.blend_ids), catalogue.blend_ingredients
+            ))
+            results = BenchmarkSuite(catalogue).run(options["repeat"], options["scenarios"])
+            transaction.set_rollback(True)
+
+        for result in results:
+            self.stdout.write("{:<20} {:>10.4f}s {:>6} queries (budget {})".format(
+                result.name, result.seconds, result.queries, result.query_budget
+            ))
+
+        if options["save"]:
+            with open(options["save"], "w") as results_file:
+                results_file.write(results_to_json(results))
+
+        regressions = find_regressions(results, baseline, options["threshold"])
+        if regressions:
+            raise CommandError("Regressions:\n" + "\n".join(regressions))
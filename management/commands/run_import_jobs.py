@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...jobs import resume_import_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued recipe import jobs on a worker pool, resuming jobs whose worker "
+        "stopped, from the last chunk they committed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll", type=float, default=0,
+                            help="Keep looking for new jobs every this many seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            futures = resume_import_jobs()
+            for future in futures:
+                job = future.result() if hasattr(future, "result") else future
+                if job is not None:
+                    self.stdout.write("{}: {}".format(job, job.failure or "{} chunks".format(job.chunks)))
+            if not options["poll"]:
+                return
+            time.sleep(options["poll"])
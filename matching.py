@@ -0,0 +1,127 @@
+import re
+import threading
+from collections import Counter, defaultdict
+
+
+# Trigram similarity a name needs to resolve to one of the ingredient
+# names it contains the words of
+SIMILARITY_THRESHOLD = 0.55
+
+_non_word = re.compile(r"[^0-9a-z]+")
+
+
+def normalize_name(name):
+    """Lower case a name and collapse punctuation and whitespace to single spaces"""
+    return _non_word.sub(" ", name.lower()).strip()
+
+
+def trigrams(normalized_name):
+    """Trigrams of each word, padded the way pg_trgm pads them"""
+    grams = set()
+    for word in normalized_name.split():
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class IngredientIndex:
+    """Resolve raw ingredient names to Ingredient ids in memory.
+
+    Names and aliases are matched exactly after normalization first, then
+    by trigram similarity. A similar name has to contain every word of the
+    name it resolves to, so "cinnamon quills" resolves to "cinnamon" but
+    "dandelion leaf" never to "dandelion root", nor "ing14" to "ing1".
+    Candidates come from an inverted word index: a name is only a
+    candidate when every one of its words is in the query, so the posting
+    lists of the query's words are counted and trigram similarity is only
+    computed for names all of whose words were hit.
+    """
+
+    def __init__(self, names=()):
+        self.exact = {}
+        self.keys = []
+        self.word_counts = []
+        self.word_postings = defaultdict(list)
+        for name, ingredient_id in names:
+            self.add(name, ingredient_id)
+
+    @classmethod
+    def build(cls):
+        from .models import Ingredient, IngredientAlias
+
+        index = cls(Ingredient.objects.values_list('name', 'id'))
+        for name, ingredient_id in IngredientAlias.objects.values_list('name', 'ingredient_id'):
+            index.add(name, ingredient_id)
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, name, ingredient_id):
+        normalized = normalize_name(name)
+        if not normalized or normalized in self.exact:
+            return
+        self.exact[normalized] = ingredient_id
+        words = frozenset(normalized.split())
+        key = len(self.keys)
+        self.keys.append((trigrams(normalized), ingredient_id))
+        self.word_counts.append(len(words))
+        for word in words:
+            self.word_postings[word].append(key)
+
+    def match(self, name, threshold=SIMILARITY_THRESHOLD):
+        """Return (ingredient_id, similarity) for the best match, or (None, 0)"""
+        normalized = normalize_name(name)
+        if normalized in self.exact:
+            return self.exact[normalized], 1.0
+
+        grams = trigrams(normalized)
+        if not grams:
+            return None, 0
+        hits = Counter()
+        for word in set(normalized.split()):
+            hits.update(self.word_postings.get(word, ()))
+
+        word_counts = self.word_counts
+        best_id, best_similarity = None, 0
+        for key in [key for key, count in hits.items() if count == word_counts[key]]:
+            key_grams, ingredient_id = self.keys[key]
+            shared = len(grams & key_grams)
+            similarity = shared / (len(grams) + len(key_grams) - shared)
+            if similarity > best_similarity:
+                best_id, best_similarity = ingredient_id, similarity
+        if best_similarity < threshold:
+            return None, best_similarity
+        return best_id, best_similarity
+
+    def resolve(self, name, threshold=SIMILARITY_THRESHOLD):
+        return self.match(name, threshold)[0]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_ingredient_index():
+    """The process-wide IngredientIndex, built on first use"""
+    global _index
+    index = _index
+    if index is None:
+        with _index_lock:
+            if _index is None:
+                _index = IngredientIndex.build()
+            index = _index
+    return index
+
+
+def invalidate_ingredient_index():
+    global _index
+    _index = None
+
+
+def add_to_ingredient_index(names):
+    """Add (name, ingredient_id) pairs to the process-wide index if it is built"""
+    index = _index
+    if index is not None:
+        for name, ingredient_id in names:
+            index.add(name, ingredient_id)
@@ -0,0 +1,104 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Brew',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Ingredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Recipe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40)),
+                ('file', models.FileField(blank=True, upload_to='', verbose_name='Recipe File')),
+                ('created', models.DateTimeField(auto_now_add=True, null=True)),
+                ('modified', models.DateTimeField(auto_now_add=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BrewIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField()),
+                ('brew', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='brew.brew')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='brew.ingredient')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='brew',
+            name='ingredients',
+            field=models.ManyToManyField(blank=True, through='brew.BrewIngredient', to='brew.ingredient'),
+        ),
+        migrations.CreateModel(
+            name='BlendIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=5, max_digits=12)),
+                ('unit', models.CharField(max_length=5)),
+                ('cost', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('blend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='brew.blend')),
+                ('source', models.ForeignKey(blank=True, help_text='Blend this row was copied from by Blend.add_blend', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='derived_ingredients', to='brew.blend')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='brew.ingredient')),
+            ],
+            options={
+                'unique_together': {('ingredient', 'blend', 'amount', 'unit', 'cost')},
+            },
+        ),
+        migrations.AddField(
+            model_name='blend',
+            name='ingredients',
+            field=models.ManyToManyField(blank=True, through='brew.BlendIngredient', through_fields=('blend', 'ingredient'), to='brew.ingredient'),
+        ),
+        migrations.CreateModel(
+            name='IngredientAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80, unique=True)),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='brew.ingredient')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecipeBlend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('added', models.DateTimeField(auto_now_add=True, null=True)),
+                ('blend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='brew.blend')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='brew.recipe')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='blend',
+            field=models.ManyToManyField(blank=True, through='brew.RecipeBlend', to='brew.blend'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:37
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_totals(apps, schema_editor):
+    Blend = apps.get_model('brew', 'Blend')
+    BlendIngredient = apps.get_model('brew', 'BlendIngredient')
+    Brew = apps.get_model('brew', 'Brew')
+    BrewIngredient = apps.get_model('brew', 'BrewIngredient')
+    total_cost = DecimalField(max_digits=22, decimal_places=9)
+
+    blend_rows = BlendIngredient.objects.filter(blend=OuterRef('pk')).order_by().values('blend')
+    Blend.objects.update(
+        total_amount=Coalesce(
+            Subquery(blend_rows.annotate(total=Sum('amount')).values('total')),
+            Value(Decimal(0)),
+            output_field=DecimalField(max_digits=17, decimal_places=5),
+        ),
+        total_cost=Coalesce(
+            Subquery(blend_rows.annotate(total=Sum(F('amount') * F('cost'), output_field=total_cost)).values('total')),
+            Value(Decimal(0)),
+            output_field=total_cost,
+        ),
+    )
+    brew_rows = BrewIngredient.objects.filter(brew=OuterRef('pk')).order_by().values('brew')
+    Brew.objects.update(
+        total_amount=Coalesce(Subquery(brew_rows.annotate(total=Sum('amount')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blend',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=5, default=0, editable=False, max_digits=17),
+        ),
+        migrations.AddField(
+            model_name='blend',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=9, default=0, editable=False, max_digits=22),
+        ),
+        migrations.AddField(
+            model_name='brew',
+            name='total_amount',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='blendingredient',
+            index=models.Index(fields=['blend', 'ingredient', 'amount'], name='brew_blendingr_blend_ingr_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='brewingredient',
+            index=models.Index(fields=['brew', 'ingredient', 'amount'], name='brew_brewingr_brew_ingr_idx'),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
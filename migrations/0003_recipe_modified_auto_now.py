@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0002_blend_totals_and_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0004_recipe_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('check', 'Check'), ('load', 'Load')], default='check', max_length=10)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('last_line', models.IntegerField(default=0, help_text='Last file line of the last committed chunk')),
+                ('chunks', models.IntegerField(default=0)),
+                ('counts', models.JSONField(blank=True, default=dict)),
+                ('errors', models.JSONField(blank=True, default=list)),
+                ('failure', models.TextField(blank=True)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='import_jobs', to='brew.recipe')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created'], name='brew_importjob_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,188 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:46
+
+import re
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+# brew.units and brew.matching as of this migration, frozen so that later
+# changes to them do not change what it stores
+
+# Unit name: (base unit, amount of the base unit in one of it)
+UNITS = {
+    "g": ("g", Decimal(1)),
+    "gr": ("g", Decimal(1)),
+    "gram": ("g", Decimal(1)),
+    "gramme": ("g", Decimal(1)),
+    "mg": ("g", Decimal("0.001")),
+    "milligram": ("g", Decimal("0.001")),
+    "kg": ("g", Decimal(1000)),
+    "kilo": ("g", Decimal(1000)),
+    "kilogram": ("g", Decimal(1000)),
+    "oz": ("g", Decimal("28.349523125")),
+    "ounce": ("g", Decimal("28.349523125")),
+    "lb": ("g", Decimal("453.59237")),
+    "pound": ("g", Decimal("453.59237")),
+    "ml": ("ml", Decimal(1)),
+    "millilitre": ("ml", Decimal(1)),
+    "milliliter": ("ml", Decimal(1)),
+    "cl": ("ml", Decimal(10)),
+    "dl": ("ml", Decimal(100)),
+    "l": ("ml", Decimal(1000)),
+    "litre": ("ml", Decimal(1000)),
+    "liter": ("ml", Decimal(1000)),
+    "tsp": ("ml", Decimal("4.92892159375")),
+    "teaspoon": ("ml", Decimal("4.92892159375")),
+    "tbsp": ("ml", Decimal("14.78676478125")),
+    "tablespoon": ("ml", Decimal("14.78676478125")),
+    "cup": ("ml", Decimal("236.5882365")),
+}
+
+DEFAULT_DENSITIES = {
+    "water": Decimal(1),
+    "filtered water": Decimal(1),
+    "spring water": Decimal(1),
+}
+
+BASE_PLACES = Decimal("0.00001")
+
+BATCH_SIZE = 1000
+
+_non_word = re.compile(r"[^0-9a-z]+")
+
+
+def normalize_name(name):
+    return _non_word.sub(" ", name.lower()).strip()
+
+
+def lookup_unit(name):
+    name = normalize_name(name or "").replace(" ", "")
+    if name in UNITS:
+        return UNITS[name]
+    if name.endswith("s") and name[:-1] in UNITS:
+        return UNITS[name[:-1]]
+    return None
+
+
+def to_base_quantity(amount, unit, density=None):
+    amount = Decimal(amount)
+    known = lookup_unit(unit)
+    if known is None:
+        return amount.quantize(BASE_PLACES), ""
+    base_unit, factor = known
+    base_amount = amount * factor
+    if base_unit == "ml" and density:
+        base_amount, base_unit = base_amount * Decimal(density), "g"
+    return base_amount.quantize(BASE_PLACES), base_unit
+
+
+def fill_base_quantities(apps, schema_editor):
+    Ingredient = apps.get_model('brew', 'Ingredient')
+    Blend = apps.get_model('brew', 'Blend')
+    BlendIngredient = apps.get_model('brew', 'BlendIngredient')
+    Brew = apps.get_model('brew', 'Brew')
+    BrewIngredient = apps.get_model('brew', 'BrewIngredient')
+
+    densities = {
+        pk: DEFAULT_DENSITIES[normalize_name(name)]
+        for pk, name in Ingredient.objects.values_list('pk', 'name')
+        if normalize_name(name) in DEFAULT_DENSITIES
+    }
+    for model in (BlendIngredient, BrewIngredient):
+        batch = []
+        for row in model.objects.only('pk', 'ingredient_id', 'amount', 'unit').iterator(chunk_size=BATCH_SIZE):
+            row.base_amount, row.base_unit = to_base_quantity(row.amount, row.unit, densities.get(row.ingredient_id))
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                model.objects.bulk_update(batch, ['base_amount', 'base_unit'])
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, ['base_amount', 'base_unit'])
+
+    base_amount = models.DecimalField(max_digits=17, decimal_places=5)
+    blend_rows = BlendIngredient.objects.filter(blend=OuterRef('pk')).order_by().values('blend')
+    Blend.objects.update(
+        total_amount=Coalesce(
+            Subquery(blend_rows.annotate(total=Sum('base_amount')).values('total')),
+            Value(Decimal(0)),
+            output_field=base_amount,
+        ),
+    )
+    brew_rows = BrewIngredient.objects.filter(brew=OuterRef('pk')).order_by().values('brew')
+    Brew.objects.update(
+        total_amount=Coalesce(
+            Subquery(brew_rows.annotate(total=Sum('base_amount')).values('total')),
+            Value(Decimal(0)),
+            output_field=base_amount,
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0005_import_job'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='blendingredient',
+            name='brew_blendingr_blend_ingr_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='brewingredient',
+            name='brew_brewingr_brew_ingr_idx',
+        ),
+        migrations.AddField(
+            model_name='blendingredient',
+            name='base_amount',
+            field=models.DecimalField(decimal_places=5, default=0, editable=False, help_text='Amount in grams, or millilitres for volumes of unknown density', max_digits=17),
+        ),
+        migrations.AddField(
+            model_name='blendingredient',
+            name='base_unit',
+            field=models.CharField(blank=True, default='', editable=False, max_length=2),
+        ),
+        migrations.AddField(
+            model_name='brewingredient',
+            name='base_amount',
+            field=models.DecimalField(decimal_places=5, default=0, editable=False, help_text='Amount in grams, or millilitres for volumes of unknown density', max_digits=17),
+        ),
+        migrations.AddField(
+            model_name='brewingredient',
+            name='base_unit',
+            field=models.CharField(blank=True, default='', editable=False, max_length=2),
+        ),
+        migrations.AddField(
+            model_name='brewingredient',
+            name='unit',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='ingredient',
+            name='density',
+            field=models.DecimalField(blank=True, decimal_places=4, help_text='Grams per millilitre, to weigh ingredients measured by volume', max_digits=8, null=True),
+        ),
+        migrations.AlterField(
+            model_name='blendingredient',
+            name='unit',
+            field=models.CharField(max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='brew',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=5, default=0, editable=False, max_digits=17),
+        ),
+        migrations.AddIndex(
+            model_name='blendingredient',
+            index=models.Index(fields=['blend', 'ingredient', 'base_amount'], name='brew_blendingr_blend_ingr_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='brewingredient',
+            index=models.Index(fields=['brew', 'ingredient', 'base_amount'], name='brew_brewingr_brew_ingr_idx'),
+        ),
+        migrations.RunPython(fill_base_quantities, migrations.RunPython.noop),
+    ]
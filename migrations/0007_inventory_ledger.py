@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0006_base_quantities'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockLevel',
+            fields=[
+                ('ingredient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='brew.ingredient')),
+                ('on_hand', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('consumed', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('unit', models.CharField(blank=True, default='', max_length=2)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='brew',
+            name='blend',
+            field=models.ForeignKey(blank=True, help_text='Blend brewed, booked out of stock through its composition when the brew is created', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='brews', to='brew.blend'),
+        ),
+        migrations.AddField(
+            model_name='brew',
+            name='blend_amount',
+            field=models.DecimalField(decimal_places=5, default=0, help_text="Amount of the blend brewed, in the blend's base unit", max_digits=12),
+        ),
+        migrations.CreateModel(
+            name='StockEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('purchase', 'Purchase'), ('consumption', 'Consumption'), ('adjustment', 'Adjustment')], max_length=12)),
+                ('amount', models.DecimalField(decimal_places=5, max_digits=17)),
+                ('unit', models.CharField(blank=True, default='', max_length=2)),
+                ('balance', models.DecimalField(decimal_places=5, editable=False, max_digits=17)),
+                ('consumed', models.DecimalField(decimal_places=5, editable=False, max_digits=17)),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('blend', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_entries', to='brew.blend')),
+                ('brew', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_entries', to='brew.brew')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_entries', to='brew.ingredient')),
+            ],
+            options={
+                'verbose_name_plural': 'stock entries',
+                'indexes': [models.Index(fields=['ingredient', 'created', 'id'], name='brew_stockentry_ingr_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:51
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from brew.parsers import purchase_date
+
+
+def fill_price_history(apps, schema_editor):
+    Blend = apps.get_model('brew', 'Blend')
+    BlendIngredient = apps.get_model('brew', 'BlendIngredient')
+    PriceRecord = apps.get_model('brew', 'PriceRecord')
+
+    dates = {pk: purchase_date(name) for pk, name in Blend.objects.values_list('pk', 'name')}
+    dates = {pk: date for pk, date in dates.items() if date is not None}
+    rows = BlendIngredient.objects.filter(blend_id__in=dates, source__isnull=True).values_list(
+        'pk', 'blend_id', 'ingredient_id', 'amount', 'cost', 'base_amount', 'base_unit'
+    )
+    PriceRecord.objects.bulk_create(
+        [
+            PriceRecord(
+                ingredient_id=ingredient_id,
+                date=dates[blend_id],
+                amount=base_amount,
+                unit=base_unit,
+                cost_per_unit=(cost * amount / base_amount if base_amount else cost).quantize(Decimal("0.000000001")),
+                blend_ingredient_id=pk,
+            )
+            for pk, blend_id, ingredient_id, amount, cost, base_amount, base_unit in rows.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0007_inventory_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=5, help_text='Amount bought, in base units', max_digits=17)),
+                ('unit', models.CharField(blank=True, default='', max_length=2)),
+                ('cost_per_unit', models.DecimalField(decimal_places=9, max_digits=17)),
+                ('blend_ingredient', models.OneToOneField(blank=True, help_text='Purchase row the price was read from', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='price_record', to='brew.blendingredient')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='brew.ingredient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ingredient', 'date', 'id'], name='brew_pricerecord_ingr_idx'), models.Index(fields=['date'], name='brew_pricerecord_date_idx')],
+            },
+        ),
+        migrations.RunPython(fill_price_history, migrations.RunPython.noop),
+    ]
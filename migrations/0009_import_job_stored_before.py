@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0008_price_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='stored_before',
+            field=models.IntegerField(blank=True, help_text='Last BlendIngredient id when the job first ran; only rows up to it conflict', null=True),
+        ),
+    ]
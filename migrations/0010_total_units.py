@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:18
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Case, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+
+# brew.units.TOTAL_UNITS as of this migration
+TOTAL_UNITS = ("g", "ml", "")
+
+
+def refresh_totals(apps, schema_editor):
+    """Total every blend and brew again in one base unit, as refresh_totals now does"""
+    base_amount = models.DecimalField(max_digits=17, decimal_places=5)
+    rank = Case(*[When(base_unit=unit, then=Value(rank)) for rank, unit in enumerate(TOTAL_UNITS)])
+    for parent_name, row_name, parent_field in (
+        ('Blend', 'BlendIngredient', 'blend'),
+        ('Brew', 'BrewIngredient', 'brew'),
+    ):
+        parents = apps.get_model('brew', parent_name)
+        rows = apps.get_model('brew', row_name)
+
+        def unit_of(parent):
+            return Subquery(
+                rows.objects.filter(**{parent_field: parent}).annotate(rank=rank).order_by('rank').values('base_unit')[:1]
+            )
+
+        total_rows = rows.objects.filter(
+            **{parent_field: OuterRef('pk'), 'base_unit': unit_of(OuterRef(OuterRef('pk')))}
+        ).order_by().values(parent_field)
+        parents.objects.update(
+            total_unit=Coalesce(unit_of(OuterRef('pk')), Value('')),
+            total_amount=Coalesce(
+                Subquery(total_rows.annotate(total=Sum('base_amount')).values('total')),
+                Value(Decimal(0)),
+                output_field=base_amount,
+            ),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0009_import_job_stored_before'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blend',
+            name='total_unit',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Base unit of total_amount', max_length=2),
+        ),
+        migrations.AddField(
+            model_name='brew',
+            name='total_unit',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Base unit of total_amount', max_length=2),
+        ),
+        migrations.RunPython(refresh_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:32
+
+import re
+
+from django.db import migrations, models
+
+
+# brew.matching.normalize_name as of this migration
+_non_word = re.compile(r"[^0-9a-z]+")
+
+BATCH_SIZE = 1000
+
+
+def normalize_name(name):
+    return _non_word.sub(" ", name.lower()).strip()
+
+
+def fill_name_keys(apps, schema_editor):
+    Blend = apps.get_model('brew', 'Blend')
+    batch = []
+    for blend in Blend.objects.only('pk', 'name').iterator(chunk_size=BATCH_SIZE):
+        blend.name_key = normalize_name(blend.name)
+        batch.append(blend)
+        if len(batch) == BATCH_SIZE:
+            Blend.objects.bulk_update(batch, ['name_key'])
+            batch = []
+    if batch:
+        Blend.objects.bulk_update(batch, ['name_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('brew', '0010_total_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blend',
+            name='name_key',
+            field=models.CharField(db_index=True, default='', editable=False, help_text='Name as matching.normalize_name has it', max_length=80),
+        ),
+        migrations.RunPython(fill_name_keys, migrations.RunPython.noop),
+    ]
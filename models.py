@@ -1,105 +1,416 @@
 import datetime
-import csv
-from django.db import models
+from collections import defaultdict
+from decimal import Decimal
+from django.db import models, transaction
+from django.db.models import Case, DecimalField, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
+
+from .composition import Composition
+from .matching import normalize_name
+from .units import TOTAL_UNITS, set_base_quantities, total_unit
+
+
+TOTAL_COST = DecimalField(max_digits=22, decimal_places=9)
+
+# Places of BlendIngredient.amount and cost, which nested copies are rounded to
+NESTED_AMOUNT_PLACES = Decimal("0.00001")
+NESTED_COST_PLACES = Decimal("0.0001")
+
+# Sent with the model and ``parent_ids`` whenever rows of a blend or brew
+# change, whether one at a time or in bulk
+parent_rows_changed = Signal()
+
+
+def get_amounts(parent, rows, ingredients):
+    """Amount of each ingredient in a blend or brew, in its total unit, in one indexed query"""
+    composition = getattr(parent, '_composition', None)
+    if composition is not None:
+        return [composition.amount(ingredient) for ingredient in ingredients]
+    ingredient_ids = [getattr(ingredient, 'pk', ingredient) for ingredient in ingredients]
+    amounts = dict(
+        rows.filter(ingredient_id__in=ingredient_ids, base_unit=parent.total_unit)
+        .values_list('ingredient_id')
+        .annotate(total=Sum('base_amount'))
+        .order_by()
+    )
+    return [amounts.get(ingredient_id, 0) for ingredient_id in ingredient_ids]
+
+
+def total_unit_of(model, parent):
+    """Subquery of the base unit the totals of a parent's rows are measured in, as units.total_unit picks it"""
+    return Subquery(
+        model.objects.filter(**{model.parent_field: parent})
+        .annotate(rank=Case(*[When(base_unit=unit, then=Value(rank)) for rank, unit in enumerate(TOTAL_UNITS)]))
+        .order_by('rank')
+        .values('base_unit')[:1]
+    )
+
+
+def total_rows(model):
+    """Rows of the parent in the outer query that are in its total unit, for totals subqueries"""
+    return model.objects.filter(
+        **{model.parent_field: OuterRef('pk'), 'base_unit': total_unit_of(model, OuterRef(OuterRef('pk')))}
+    ).order_by().values(model.parent_field)
+
+
+def refresh_parent_totals(model, parent_ids):
+    """Refresh the stored totals of the blends or brews owning rows of ``model``"""
+    parent_ids = {parent_id for parent_id in parent_ids if parent_id is not None}
+    if parent_ids:
+        model._meta.get_field(model.parent_field).related_model.refresh_totals(parent_ids)
+        parent_rows_changed.send(sender=model, parent_ids=parent_ids)
+
+
+class IngredientRowQuerySet(models.QuerySet):
+    """BlendIngredient and BrewIngredient rows, keeping base quantities and totals current.
+
+    Single saves and deletes are handled by the models and signals. Bulk
+    creates, updates and deletes convert their rows' units in one batch
+    and refresh the totals of every parent they touch in one query.
+    """
+
+    def _parent_ids(self):
+        return set(self.order_by().values_list(self.model.parent_field + '_id', flat=True).distinct())
+
+    def _refresh(self, parent_ids):
+        refresh_parent_totals(self.model, parent_ids)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(set_base_quantities(objs), *args, **kwargs)
+        self._refresh(getattr(obj, self.model.parent_field + '_id') for obj in objs)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        parent_ids = set()
+        if self.model.parent_field in fields:
+            parent_ids = self.filter(pk__in=[obj.pk for obj in objs])._parent_ids()
+        if {'amount', 'unit', 'ingredient', 'ingredient_id'} & set(fields):
+            objs = set_base_quantities(objs)
+            fields = list(fields) + ['base_amount', 'base_unit']
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        self._refresh(parent_ids | {getattr(obj, self.model.parent_field + '_id') for obj in objs})
+        return rows
+
+    def update(self, **kwargs):
+        parent_ids = self._parent_ids()
+        converted = {'amount', 'unit', 'ingredient', 'ingredient_id'} & kwargs.keys()
+        pks = list(self.values_list('pk', flat=True)) if converted else []
+        rows = super().update(**kwargs)
+        if converted:
+            objs = set_base_quantities(
+                self.model.objects.filter(pk__in=pks).only('pk', 'ingredient_id', 'amount', 'unit')
+            )
+            # Plain bulk_update, the totals are refreshed once below
+            models.QuerySet.bulk_update(self.model.objects.all(), objs, ['base_amount', 'base_unit'])
+        moved_to = kwargs.get(self.model.parent_field, kwargs.get(self.model.parent_field + '_id'))
+        if moved_to is not None:
+            parent_ids.add(getattr(moved_to, 'pk', moved_to))
+        self._refresh(parent_ids)
+        return rows
+
+    def delete(self):
+        # The post_delete receiver leaves rows deleted through a queryset
+        # to this single refresh
+        parent_ids = self._parent_ids()
+        deleted = super().delete()
+        self._refresh(parent_ids)
+        return deleted
 
 
 class Ingredient(models.Model):
     name = models.CharField(max_length=40, unique=True)
+    density = models.DecimalField(
+        max_digits=8,
+        decimal_places=4,
+        null=True,
+        blank=True,
+        help_text='Grams per millilitre, to weigh ingredients measured by volume',
+    )
 
     def __str__(self) -> str:
         return self.name
 
 
+class IngredientAlias(models.Model):
+    name = models.CharField(max_length=80, unique=True)
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name='aliases')
+
+    def __str__(self) -> str:
+        return self.name + " -> " + self.ingredient.name
+
+
 class Brew(models.Model):
     name = models.CharField(max_length=80)
     created = models.DateTimeField(auto_now=False, auto_now_add=True, blank=True)
+    total_amount = models.DecimalField(max_digits=17, decimal_places=5, default=0, editable=False)
+    total_unit = models.CharField(
+        max_length=2, blank=True, default='', editable=False, help_text='Base unit of total_amount'
+    )
     ingredients = models.ManyToManyField(
         Ingredient,
         through='BrewIngredient',
         blank=True
     )
+    blend = models.ForeignKey(
+        'Blend',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='brews',
+        help_text='Blend brewed, booked out of stock through its composition when the brew is created',
+    )
+    blend_amount = models.DecimalField(
+        max_digits=12,
+        decimal_places=5,
+        default=0,
+        help_text="Amount of the blend brewed, in the blend's base unit",
+    )
 
     def __str__(self) -> str:
         return self.created.strftime("%Y-%m-%d %H:%M:%S") + " " + self.name
 
+    def save(self, *args, **kwargs):
+        # A new brew is booked out of stock by a post_save receiver, so a
+        # booking that fails takes the brew with it
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def add_ingredient(self, ingredient, amount):
         BrewIngredient.objects.create(
             ingredient=ingredient,
             brew=self,
             amount=amount
         )
+        self._composition = None
+        self.refresh_from_db(fields=['total_amount', 'total_unit'])
     
     def get_ingredient_amount(self, ingredient):
         return BrewIngredient.objects.get(ingredient=ingredient, brew=self).amount
 
+    @classmethod
+    def refresh_totals(cls, brew_ids):
+        """Recompute the stored totals of the given brews from their ingredients"""
+        rows = total_rows(BrewIngredient)
+        cls.objects.filter(pk__in=brew_ids).update(
+            total_unit=Coalesce(total_unit_of(BrewIngredient, OuterRef('pk')), Value('')),
+            total_amount=Coalesce(
+                Subquery(rows.annotate(total=Sum('base_amount')).values('total')),
+                Value(Decimal(0)),
+                output_field=cls._meta.get_field('total_amount'),
+            ),
+        )
+
+    def get_amounts(self, *ingredients):
+        """Amounts of some ingredients, read from the composition if it is loaded"""
+        return get_amounts(self, BrewIngredient.objects.filter(brew=self), ingredients)
+
+    def get_composition(self):
+        if getattr(self, '_composition', None) is None:
+            self._composition = Composition(
+                (ingredient_id, name, unit, amount, None)
+                for ingredient_id, name, unit, amount in BrewIngredient.objects.filter(brew=self)
+                .values_list('ingredient_id', 'ingredient__name', 'base_unit')
+                .annotate(total_amount=Sum('base_amount'))
+                .order_by('ingredient_id', 'base_unit')
+            )
+        return self._composition
+
     def get_total_ingredient_amounts(self):
-        return sum(list(map(lambda i: i.amount, BrewIngredient.objects.filter(brew=self))))
+        return self.total_amount
 
     def get_ingredient_ratio(self, ingredient):
-        return self.get_ingredient_amount(ingredient) / self.get_total_ingredient_amounts()
+        amount, = self.get_amounts(ingredient)
+        return float(amount) / float(self.total_amount) if self.total_amount else 0
 
     def get_ingredients_ratio(self, ingredient1, ingredient2):
-        ingredient1_amount = self.get_ingredient_amount(ingredient1)
-        ingredient2_amount = self.get_ingredient_amount(ingredient2)
-        return ingredient1_amount / (ingredient1_amount + ingredient2_amount)
+        amount1, amount2 = self.get_amounts(ingredient1, ingredient2)
+        return float(amount1) / float(amount1 + amount2)
+
+    def get_cost(self, method='latest'):
+        """Cost of the brew's ingredients at the prices of the day it was brewed"""
+        from .pricing import cost_brews
+
+        return cost_brews([self], method)[self.pk]
 
-class BrewIngredient(models.Model):
+
+class IngredientRow(models.Model):
+    """An amount of an ingredient in a blend or brew, with its amount in base units"""
+
+    base_amount = models.DecimalField(
+        max_digits=17,
+        decimal_places=5,
+        default=0,
+        editable=False,
+        help_text='Amount in grams, or millilitres for volumes of unknown density',
+    )
+    base_unit = models.CharField(max_length=2, blank=True, default='', editable=False)
+
+    objects = IngredientRowQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # The base quantity is set from amount and unit by a pre_save signal
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'base_amount', 'base_unit'}
+        super().save(*args, **kwargs)
+
+
+class BrewIngredient(IngredientRow):
     ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE)
     brew = models.ForeignKey(Brew, on_delete=models.CASCADE)
     amount = models.IntegerField()
+    unit = models.CharField(max_length=20, blank=True, default='')
+
+    parent_field = 'brew'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['brew', 'ingredient', 'base_amount'], name='brew_brewingr_brew_ingr_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.brew.__str__() + " " + self.ingredient.name
 
+class BlendQuerySet(models.QuerySet):
+    """Blends, keeping name_key current on bulk creates, which bypass save"""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for blend in objs:
+            blend.name_key = normalize_name(blend.name)
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 class Blend(models.Model):
     name = models.CharField(max_length=80)
+    name_key = models.CharField(
+        max_length=80, db_index=True, editable=False, default='', help_text='Name as matching.normalize_name has it'
+    )
     created = models.DateTimeField(auto_now=False, auto_now_add=True, blank=True)
+    total_amount = models.DecimalField(max_digits=17, decimal_places=5, default=0, editable=False)
+    total_unit = models.CharField(
+        max_length=2, blank=True, default='', editable=False, help_text='Base unit of total_amount'
+    )
+    total_cost = models.DecimalField(max_digits=22, decimal_places=9, default=0, editable=False)
     ingredients = models.ManyToManyField(
         Ingredient,
         through='BlendIngredient',
+        through_fields=('blend', 'ingredient'),
         blank=True
     )
 
+    objects = BlendQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.created.strftime("%Y-%m-%d %H:%M:%S") + " " + self.name
 
-    def add_ingredient(self, ingredient, amount, cost=1):
+    def save(self, *args, **kwargs):
+        # Imports look blends up by normalized name
+        self.name_key = normalize_name(self.name)
+        if kwargs.get('update_fields') is not None and 'name' in kwargs['update_fields']:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'name_key'}
+        super().save(*args, **kwargs)
+
+    def add_ingredient(self, ingredient, amount, cost=1, unit=''):
         BlendIngredient.objects.create(
             ingredient=ingredient,
             blend=self,
             amount=amount,
+            unit=unit,
             cost=cost
         )
+        self._composition = None
+        self.refresh_from_db(fields=['total_amount', 'total_unit', 'total_cost'])
+
+    def nested_rows(self, blend, amount):
+        """Unsaved rows copying ``amount`` of another blend into this one"""
+        rows, = nested_blend_rows([(self.pk, blend.pk, amount)])
+        return rows
 
     def add_blend(self, blend, amount):
-        for ingredient in blend.ingredients.all():
-            ingredient_amount = blend.get_ingredient_ratio(ingredient) * amount
-            self.add_ingredient(ingredient, ingredient_amount)
+        BlendIngredient.objects.bulk_create(self.nested_rows(blend, amount))
+        self._composition = None
+        self.refresh_from_db(fields=['total_amount', 'total_unit', 'total_cost'])
     
     def get_ingredient_amount(self, ingredient):
-        return sum(blend_ingredient.amount for blend_ingredient in BlendIngredient.objects.filter(ingredient=ingredient, blend=self))
+        amount, = self.get_amounts(ingredient)
+        return amount
+
+    @classmethod
+    def refresh_totals(cls, blend_ids):
+        """Recompute the stored totals of the given blends from their ingredients.
+
+        The cost covers every row, the amount only the rows in the blend's total unit.
+        """
+        rows = BlendIngredient.objects.filter(blend=OuterRef('pk')).order_by().values('blend')
+        cls.objects.filter(pk__in=blend_ids).update(
+            total_unit=Coalesce(total_unit_of(BlendIngredient, OuterRef('pk')), Value('')),
+            total_amount=Coalesce(
+                Subquery(total_rows(BlendIngredient).annotate(total=Sum('base_amount')).values('total')),
+                Value(Decimal(0)),
+                output_field=cls._meta.get_field('total_amount'),
+            ),
+            total_cost=Coalesce(
+                Subquery(rows.annotate(total=Sum(F('amount') * F('cost'), output_field=TOTAL_COST)).values('total')),
+                Value(Decimal(0)),
+                output_field=TOTAL_COST,
+            ),
+        )
+
+    def get_amounts(self, *ingredients):
+        """Amounts of some ingredients, read from the composition if it is loaded"""
+        return get_amounts(self, BlendIngredient.objects.filter(blend=self), ingredients)
+
+    def get_composition(self):
+        if getattr(self, '_composition', None) is None:
+            self._composition = Composition(
+                BlendIngredient.objects.filter(blend=self)
+                .values_list('ingredient_id', 'ingredient__name', 'base_unit')
+                .annotate(
+                    total_amount=Sum('base_amount'),
+                    total_cost=Sum(F('amount') * F('cost'), output_field=TOTAL_COST),
+                )
+                .order_by('ingredient_id', 'base_unit')
+            )
+        return self._composition
 
     def get_total_ingredient_amounts(self):
-        return sum(list(map(lambda i: i.amount, BlendIngredient.objects.filter(blend=self))))
+        return self.total_amount
 
     def get_ingredient_ratio(self, ingredient):
-        return self.get_ingredient_amount(ingredient) / self.get_total_ingredient_amounts()
+        amount, = self.get_amounts(ingredient)
+        return amount / self.total_amount if self.total_amount else 0
 
     def get_ingredients_ratio(self, ingredient1, ingredient2):
-        ingredient1_amount = self.get_ingredient_amount(ingredient1)
-        ingredient2_amount = self.get_ingredient_amount(ingredient2)
-        return ingredient1_amount / (ingredient1_amount + ingredient2_amount)
+        amount1, amount2 = self.get_amounts(ingredient1, ingredient2)
+        return amount1 / (amount1 + amount2)
 
 
-class BlendIngredient(models.Model):
+class BlendIngredient(IngredientRow):
     ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE)
     blend = models.ForeignKey(Blend, on_delete=models.CASCADE)
     amount = models.DecimalField(decimal_places=5, max_digits=12)
-    unit = models.CharField(max_length=5)
+    unit = models.CharField(max_length=20)
     cost = models.DecimalField(max_digits=10, decimal_places=4)
+    source = models.ForeignKey(
+        Blend,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='derived_ingredients',
+        help_text='Blend this row was copied from by Blend.add_blend',
+    )
+
+    parent_field = 'blend'
 
     class Meta:
         unique_together = ('ingredient', 'blend', 'amount', 'unit', 'cost')
+        indexes = [
+            models.Index(fields=['blend', 'ingredient', 'base_amount'], name='brew_blendingr_blend_ingr_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.blend.__str__() + " " + self.ingredient.name
@@ -108,17 +419,65 @@ class BlendIngredient(models.Model):
         return self.blend.get_ingredient_ratio(self.ingredient)
 
 
+def nested_blend_rows(parts):
+    """Unsaved rows for (blend id, nested blend id, amount) parts, in one query.
+
+    Each part becomes a row per ingredient of the nested blend, with its
+    share of ``amount`` and the nested blend's cost per unit, as a list
+    per part. Shares are of the nested blend's total unit, so the copies
+    are in it too, and rows in other units are not copied.
+    """
+    parts = [(blend_id, source_id, Decimal(str(amount))) for blend_id, source_id, amount in parts]
+    compositions = defaultdict(list)
+    for source_id, ingredient_id, unit, amount, cost in (
+        BlendIngredient.objects.filter(blend_id__in={source_id for _, source_id, _ in parts})
+        .values_list('blend_id', 'ingredient_id', 'base_unit')
+        .annotate(
+            total_amount=Sum('base_amount'),
+            total_cost=Sum(F('amount') * F('cost'), output_field=TOTAL_COST),
+        )
+        .order_by('blend_id', 'ingredient_id')
+    ):
+        compositions[source_id].append((ingredient_id, unit, amount, cost))
+    for source_id, composition in compositions.items():
+        unit = total_unit({row[1] for row in composition})
+        compositions[source_id] = [row for row in composition if row[1] == unit]
+    totals = {
+        source_id: sum(amount for _, _, amount, _ in composition) for source_id, composition in compositions.items()
+    }
+    return [
+        [
+            BlendIngredient(
+                blend_id=blend_id,
+                ingredient_id=ingredient_id,
+                amount=(ingredient_amount / totals[source_id] * amount).quantize(NESTED_AMOUNT_PLACES),
+                unit=unit,
+                cost=(cost / ingredient_amount if ingredient_amount else Decimal(0)).quantize(NESTED_COST_PLACES),
+                source_id=source_id,
+            )
+            for ingredient_id, unit, ingredient_amount, cost in compositions[source_id]
+            if totals[source_id]
+        ]
+        for blend_id, source_id, amount in parts
+    ]
+
+
 class Recipe(models.Model):
     name = models.CharField(max_length=40)
     file = models.FileField(verbose_name='Recipe File', blank=True)
     created = models.DateTimeField(auto_now=False, auto_now_add=True, null=True, blank=True)
-    modified = models.DateTimeField(auto_now_add=True, null=True)
+    modified = models.DateTimeField(auto_now=True, null=True)
     blend = models.ManyToManyField(
         Blend,
         through='RecipeBlend',
         blank=True
     )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created', '-id'], name='brew_recipe_created_id_idx'),
+        ]
+
     def __str__(self) -> str:
         return self.created.strftime("%Y-%m-%d %H:%M:%S") + " " + self.name
     
@@ -134,52 +493,163 @@ class Recipe(models.Model):
             return "Already exists."
 
 
-    def export_recipe_to_csv(self):
-        status = "Exporting to CSV"
-        headers = ['blend', 'ingredient', 'amount', 'unit', 'cost', 'total', 'ratio']
+    def export_recipe_to_csv(self, csvfile):
+        from .exporters import stream_recipe_csv
 
-        with open(self.name + '.csv', 'w', newline='') as csvfile:
-            status = "Writing to CSV"
-            recipe_writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            blends = self.blend.select_related()
-            if(blends):
-                for blend in blends:
-                    for blend_ingredient in BlendIngredient.objects.filter(blend=blend):
-                        recipe_writer.writerow([blend_ingredient.blend.name, blend_ingredient.ingredient.name, blend_ingredient.amount, blend_ingredient.unit, blend_ingredient.cost, blend_ingredient.amount * blend_ingredient.cost, blend_ingredient.get_ingredient_ratio()])
-        
-        self.file = self.name + '.csv'
-        status = 'CSV Writing Success'
-        return status
-
-    def import_recipe_from_csv(self):
-        status = "Importing from CSV"
-        headers = ['blend', 'ingredient', 'amount', 'unit', 'cost', 'total', 'ratio']
-        blend_for_import = None
-
-        with open(self.name + '.csv', 'w', newline='') as csvfile:
-            status = "Reading from CSV"
-            blend_reader = csv.reader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            
-            for blend_ingredient in blend_reader:
-                ingredient = blend_reader.readrow()
-                try:
-                    BlendIngredient.objects.get_or_create(name=ingredient.name)
-                except:
-                    raise ImportError
-                
-                try:
-                    blend_for_import.add_ingredient(ingredient)
-                except:
-                    raise RuntimeError
-                else:
-                    pass
-        
-        self.file = csvfile
-        status = 'Import Success'
-        return status
+        csvfile.writelines(stream_recipe_csv(self))
+        return 'CSV Writing Success'
+
+    def import_recipe_from_csv(self, csvfile=None):
+        from .importers import import_recipe_csv
+
+        if csvfile is not None:
+            return import_recipe_csv(csvfile, recipe=self)
+
+        with open(self.file.path, newline='') as csvfile:
+            return import_recipe_csv(csvfile, recipe=self)
 
 
 class RecipeBlend(models.Model):
     added = models.DateTimeField(auto_now=False, auto_now_add=True, null=True, blank=True)
     blend = models.ForeignKey(Blend, on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
+
+
+class ImportJob(models.Model):
+    """A check or load of a recipe file, run in the background a chunk at a time.
+
+    Progress, counts and per-row errors are saved with every committed
+    chunk, so an interrupted job resumes after ``last_line``.
+    """
+
+    CHECK = 'check'
+    LOAD = 'load'
+    KIND_CHOICES = [(CHECK, 'Check'), (LOAD, 'Load')]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='import_jobs')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=CHECK)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    last_line = models.IntegerField(default=0, help_text='Last file line of the last committed chunk')
+    chunks = models.IntegerField(default=0)
+    stored_before = models.IntegerField(
+        null=True, blank=True, help_text='Last BlendIngredient id when the job first ran; only rows up to it conflict'
+    )
+    counts = models.JSONField(default=dict, blank=True)
+    errors = models.JSONField(default=list, blank=True)
+    failure = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created'], name='brew_importjob_status_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return "{} {} of {} ({})".format(self.kind, self.pk, self.recipe.name, self.status)
+
+    @property
+    def is_active(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "recipe": self.recipe_id,
+            "kind": self.kind,
+            "status": self.status,
+            "last_line": self.last_line,
+            "chunks": self.chunks,
+            "counts": self.counts,
+            "errors": self.errors,
+            "failure": self.failure,
+        }
+
+
+class StockEntry(models.Model):
+    """One line of the append-only inventory ledger.
+
+    ``amount`` is the signed change in the ingredient's base unit.
+    ``balance`` and ``consumed`` are the running stock on hand and total
+    consumption after the entry, so the stock at any point in time is a
+    single index lookup rather than a sum over the history. Mistakes are
+    corrected with an adjustment, never by editing entries.
+    """
+
+    PURCHASE = 'purchase'
+    CONSUMPTION = 'consumption'
+    ADJUSTMENT = 'adjustment'
+    KIND_CHOICES = [(PURCHASE, 'Purchase'), (CONSUMPTION, 'Consumption'), (ADJUSTMENT, 'Adjustment')]
+
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name='stock_entries')
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES)
+    amount = models.DecimalField(max_digits=17, decimal_places=5)
+    unit = models.CharField(max_length=2, blank=True, default='')
+    balance = models.DecimalField(max_digits=17, decimal_places=5, editable=False)
+    consumed = models.DecimalField(max_digits=17, decimal_places=5, editable=False)
+    brew = models.ForeignKey(Brew, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_entries')
+    blend = models.ForeignKey(Blend, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_entries')
+    note = models.CharField(max_length=200, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'stock entries'
+        indexes = [
+            models.Index(fields=['ingredient', 'created', 'id'], name='brew_stockentry_ingr_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return "{} {} {}{}".format(self.kind, self.ingredient.name, self.amount, self.unit)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Stock entries cannot be changed, record an adjustment instead")
+        super().save(*args, **kwargs)
+
+
+class StockLevel(models.Model):
+    """The running balance of one ingredient, kept by every ledger entry"""
+
+    ingredient = models.OneToOneField(Ingredient, on_delete=models.CASCADE, primary_key=True, related_name='stock')
+    on_hand = models.DecimalField(max_digits=17, decimal_places=5, default=0)
+    consumed = models.DecimalField(max_digits=17, decimal_places=5, default=0)
+    unit = models.CharField(max_length=2, blank=True, default='')
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return "{} {}{}".format(self.ingredient.name, self.on_hand, self.unit)
+
+
+class PriceRecord(models.Model):
+    """What an ingredient cost per base unit when it was bought on ``date``"""
+
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name='prices')
+    date = models.DateField()
+    amount = models.DecimalField(max_digits=17, decimal_places=5, help_text='Amount bought, in base units')
+    unit = models.CharField(max_length=2, blank=True, default='')
+    cost_per_unit = models.DecimalField(max_digits=17, decimal_places=9)
+    blend_ingredient = models.OneToOneField(
+        BlendIngredient,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='price_record',
+        help_text='Purchase row the price was read from',
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ingredient', 'date', 'id'], name='brew_pricerecord_ingr_idx'),
+            models.Index(fields=['date'], name='brew_pricerecord_date_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return "{} {} {}/{}".format(self.date, self.ingredient.name, self.cost_per_unit, self.unit)
@@ -0,0 +1,64 @@
+import base64
+import binascii
+import datetime
+from collections import namedtuple
+
+from django.db.models import F, Q
+
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 200
+
+KeysetPage = namedtuple("KeysetPage", "items next_cursor")
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created, pk):
+    value = "{}|{}".format(created.isoformat() if created else "", pk)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created, pk = value.rsplit("|", 1)
+        return (datetime.datetime.fromisoformat(created) if created else None), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid page cursor {!r}".format(cursor))
+
+
+def page_size_from(value, default=PAGE_SIZE):
+    """Read a requested page size, falling back to the default and capped at MAX_PAGE_SIZE"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def paginate_keyset(queryset, cursor=None, page_size=PAGE_SIZE):
+    """One page of ``queryset``, newest first by (created, id).
+
+    Each page starts after the (created, id) of the previous page's last
+    row, so it is an index range scan however deep the page is, unlike an
+    OFFSET that reads and discards every earlier row. Rows without a
+    created date come last, by id.
+    """
+    queryset = queryset.order_by(F('created').desc(nulls_last=True), '-id')
+    if cursor:
+        created, pk = decode_cursor(cursor)
+        if created is None:
+            queryset = queryset.filter(created__isnull=True, id__lt=pk)
+        else:
+            queryset = queryset.filter(
+                Q(created__lt=created) | Q(created=created, id__lt=pk) | Q(created__isnull=True)
+            )
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1].created, items[-1].pk)
+    return KeysetPage(items, next_cursor)
@@ -0,0 +1,187 @@
+import ast
+import datetime
+import operator
+import re
+from collections import namedtuple
+from decimal import Decimal, DivisionByZero, InvalidOperation, Overflow
+from functools import lru_cache
+
+
+ParsedColumn = namedtuple("ParsedColumn", "values errors")
+Quantity = namedtuple("Quantity", "amount unit")
+
+# Day zero of spreadsheet date serials, as Excel and Google Sheets count them
+SERIAL_EPOCH = datetime.date(1899, 12, 30)
+
+# Characters of a bad cell quoted in its error message
+ERROR_TEXT_LENGTH = 40
+
+_number = r"[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)?(?:\.\d+)?"
+_currency = re.compile(r"(-)?\s*\$?\s*(" + _number + r")\s*\$?")
+_percent = re.compile(r"(" + _number + r")\s*%")
+_quantity = re.compile(r"(" + _number + r")\s*([A-Za-z].*)?")
+_serial = re.compile(r"\d{5}(?:\.\d+)?")
+_date_formats = ("%Y-%m-%d", "%d/%m/%Y", "%d/%m/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S")
+# Purchase blends are named "2022-01-09 Purchase Spices" or "2022Mar31Purchase"
+_purchase_names = (
+    (re.compile(r"(\d{4}-\d{2}-\d{2})\s*purchase", re.I), "%Y-%m-%d"),
+    (re.compile(r"(\d{4}[a-z]{3}\d{1,2})\s*purchase", re.I), "%Y%b%d"),
+)
+
+_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+
+class ParseError(ValueError):
+    pass
+
+
+def _finite(value):
+    if not value.is_finite():
+        raise ParseError("not a finite number")
+    return value
+
+
+def _decimal(text):
+    if text in ("", "+", "-", "."):
+        raise ParseError("not a number")
+    return _finite(Decimal(text.replace(",", "")))
+
+
+def evaluate_formula(formula):
+    """Evaluate a spreadsheet arithmetic formula such as "=29.11/440*1000" exactly"""
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return Decimal(str(node.value))
+        if isinstance(node, ast.BinOp) and type(node.op) in _operators:
+            return _operators[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            value = evaluate(node.operand)
+            return -value if isinstance(node.op, ast.USub) else value
+        raise ParseError("unsupported formula")
+
+    try:
+        value = evaluate(ast.parse(formula.lstrip("=").replace("$", ""), mode="eval"))
+    except (SyntaxError, DivisionByZero, InvalidOperation, Overflow, RecursionError):
+        # Formulas nested too deeply for the parser or evaluator are
+        # rejected like any other formula it cannot read
+        raise ParseError("unsupported formula")
+    return _finite(value)
+
+
+def parse_decimal_value(text):
+    if text.startswith("="):
+        return evaluate_formula(text)
+    return _decimal(text)
+
+
+def parse_currency_value(text):
+    if text.startswith("="):
+        return evaluate_formula(text)
+    match = _currency.fullmatch(text)
+    if not match:
+        raise ParseError("not a currency amount")
+    value = _decimal(match.group(2))
+    return -value if match.group(1) else value
+
+
+def parse_percent_value(text):
+    if text.startswith("="):
+        return evaluate_formula(text)
+    match = _percent.fullmatch(text)
+    if match:
+        return _decimal(match.group(1)) / 100
+    return _decimal(text)
+
+
+def parse_quantity_value(text):
+    if text.startswith("="):
+        return Quantity(evaluate_formula(text), "")
+    match = _quantity.fullmatch(text)
+    if not match:
+        raise ParseError("not a quantity")
+    return Quantity(_decimal(match.group(1)), (match.group(2) or "").strip())
+
+
+def parse_date_value(text):
+    if _serial.fullmatch(text):
+        return SERIAL_EPOCH + datetime.timedelta(days=int(Decimal(text)))
+    for date_format in _date_formats:
+        try:
+            return datetime.datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    raise ParseError("not a date")
+
+
+def purchase_date(name):
+    """The date in a purchase blend's name, or None if it is not a purchase"""
+    for pattern, date_format in _purchase_names:
+        match = pattern.match(name.strip())
+        if match:
+            try:
+                return datetime.datetime.strptime(match.group(1), date_format).date()
+            except ValueError:
+                return None
+    return None
+
+
+PARSERS = {
+    "decimal": parse_decimal_value,
+    "currency": parse_currency_value,
+    "percent": parse_percent_value,
+    "quantity": parse_quantity_value,
+    "date": parse_date_value,
+}
+
+
+def _shortened(text):
+    return text if len(text) <= ERROR_TEXT_LENGTH else text[:ERROR_TEXT_LENGTH] + "..."
+
+
+@lru_cache(maxsize=65536)
+def parse_value(text, kind):
+    """Parse one cell, returning (value, error message).
+
+    Blank cells give (None, None). Spreadsheet columns repeat the same
+    few strings ("grams", "$0.05") over and over, so results are cached
+    and each distinct string is parsed once.
+    """
+    text = text.strip()
+    if not text:
+        return None, None
+    try:
+        return PARSERS[kind](text), None
+    except (ParseError, InvalidOperation) as error:
+        return None, "{!r} is {}".format(_shortened(text), error if isinstance(error, ParseError) else "not a number")
+
+
+def parse_column(values, kind):
+    """Parse a whole column of cells of one kind.
+
+    Returns a ParsedColumn of the typed values, None for blank or bad
+    cells, and (index, message) errors for the bad ones.
+    """
+    if kind not in PARSERS:
+        raise ValueError("Unknown column kind {!r}".format(kind))
+    parsed = []
+    errors = []
+    for index, text in enumerate(values):
+        value, error = parse_value(text, kind)
+        parsed.append(value)
+        if error:
+            errors.append((index, error))
+    return ParsedColumn(parsed, errors)
+
+
+def to_fixed_point(values, places):
+    """Convert Decimals to integers scaled by 10 ** places, keeping None"""
+    scale = Decimal(10) ** places
+    return [None if value is None else int((value * scale).to_integral_value()) for value in values]
@@ -0,0 +1,147 @@
+from collections import defaultdict
+
+from .matching import get_ingredient_index, normalize_name
+from .models import Blend, BlendIngredient, Brew, Ingredient
+
+
+class ImportPlan:
+    """What importing a set of recipe rows would do, without doing it.
+
+    Rows are split into rows to create, rows that already exist exactly
+    and rows that conflict with a different amount, unit or cost already
+    stored for the same blend and ingredient.
+    """
+
+    def __init__(self):
+        self.blends_to_create = []
+        self.ingredients_to_create = []
+        self.ingredients_matched = {}
+        self.rows_to_create = []
+        self.rows_matching = []
+        self.rows_conflicting = []
+
+    def __bool__(self):
+        return bool(self.rows_to_create or self.rows_matching or self.rows_conflicting)
+
+    @property
+    def rows(self):
+        return (
+            [(row, "create") for row in self.rows_to_create]
+            + [(row, "matching") for row in self.rows_matching]
+            + [(row, "conflict") for row in self.rows_conflicting]
+        )
+
+
+def resolve_oldest_names(model, names):
+    """Map names to ids for a model without unique names, the oldest row winning"""
+    ids = {}
+    for name, pk in model.objects.filter(name__in=names).order_by('-id').values_list('name', 'id'):
+        ids[name] = pk
+    return ids
+
+
+def resolve_blend_names(names):
+    """Map names to the ids of blends with the same normalized name, the oldest blend winning.
+
+    "2022-02-05 Purchase black tea" finds the blend "2022-02-05 Purchase Black Tea".
+    """
+    ids = {}
+    stored = Blend.objects.filter(name_key__in={normalize_name(name) for name in names})
+    for name_key, pk in stored.order_by('-id').values_list('name_key', 'id'):
+        ids[name_key] = pk
+    return {name: ids[normalize_name(name)] for name in names if normalize_name(name) in ids}
+
+
+def resolve_brew_names(names):
+    return resolve_oldest_names(Brew, names)
+
+
+def resolve_ingredient_names(names, matched=None):
+    """Map ingredient names to ids by exact name, then by alias or similarity.
+
+    Names resolved through the in-memory index are also added to
+    ``matched`` when it is given.
+    """
+    ingredient_ids = dict(Ingredient.objects.filter(name__in=names).values_list('name', 'id'))
+    missing = set(names) - ingredient_ids.keys()
+    if missing:
+        index = get_ingredient_index()
+        for name in missing:
+            ingredient_id = index.resolve(name)
+            if ingredient_id is not None:
+                ingredient_ids[name] = ingredient_id
+                if matched is not None:
+                    matched[name] = ingredient_id
+    return ingredient_ids
+
+
+def new_ingredient_names(names):
+    """Map names to the spelling their ingredient is created with, one per normalized name.
+
+    "Cinnamon Quills" and "cinnamon quills" in the same import become one
+    ingredient, under the spelling that sorts first.
+    """
+    spellings = {}
+    for name in sorted(names):
+        spellings.setdefault(normalize_name(name), name)
+    return {name: spellings[normalize_name(name)] for name in names}
+
+
+def new_blend_names(names):
+    """Map names to the spelling their blend is created with, one per normalized name, as for ingredients"""
+    return new_ingredient_names(names)
+
+
+def plan_recipe_import(rows, stored_before=None):
+    """Work out what importing ``rows`` would create, with one query per table.
+
+    Rows only conflict with blend ingredients up to the id ``stored_before``
+    when it is given, so the chunks of one file are not checked against
+    the rows its earlier chunks loaded.
+    """
+    rows = list(rows)
+    plan = ImportPlan()
+
+    blend_names = {row.blend_name for row in rows}
+    blend_ids = resolve_blend_names(blend_names | {row.ingredient_name for row in rows})
+    # Items named like a blend nest it, as the importer does
+    blend_keys = {normalize_name(name) for name in blend_names}
+    nested = {
+        row.ingredient_name for row in rows
+        if row.ingredient_name in blend_ids or normalize_name(row.ingredient_name) in blend_keys
+    }
+    ingredient_ids = resolve_ingredient_names(
+        {row.ingredient_name for row in rows} - nested, plan.ingredients_matched
+    )
+    plan.blends_to_create = sorted(set(new_blend_names(blend_names - blend_ids.keys()).values()))
+    plan.ingredients_to_create = sorted(set(new_ingredient_names(
+        {row.ingredient_name for row in rows} - nested - ingredient_ids.keys()
+    ).values()))
+
+    stored_rows = BlendIngredient.objects.filter(blend_id__in=blend_ids.values())
+    if stored_before is not None:
+        stored_rows = stored_rows.filter(pk__lte=stored_before)
+    stored = defaultdict(set)
+    nested_pairs = set()
+    for blend_id, ingredient_id, amount, unit, cost, source_id in stored_rows.values_list('blend_id', 'ingredient_id', 'amount', 'unit', 'cost', 'source_id'):
+        if source_id is None:
+            stored[blend_id, ingredient_id].add((amount, unit, cost))
+        else:
+            nested_pairs.add((blend_id, source_id))
+
+    for row in rows:
+        if row.ingredient_name in nested:
+            if (blend_ids.get(row.blend_name), blend_ids.get(row.ingredient_name)) in nested_pairs:
+                plan.rows_matching.append(row)
+            else:
+                plan.rows_to_create.append(row)
+            continue
+        key = (blend_ids.get(row.blend_name), ingredient_ids.get(row.ingredient_name))
+        if (row.amount, row.unit, row.cost) in stored[key]:
+            plan.rows_matching.append(row)
+        elif stored[key]:
+            plan.rows_conflicting.append(row)
+        else:
+            plan.rows_to_create.append(row)
+
+    return plan
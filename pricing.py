@@ -0,0 +1,225 @@
+import datetime
+from bisect import bisect_right
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import BlendIngredient, BrewIngredient, Ingredient, PriceRecord, StockEntry, StockLevel
+
+
+# Days of purchases a moving average price covers
+AVERAGE_DAYS = 90
+
+COST_PLACES = Decimal("0.000000001")
+
+LATEST = "latest"
+AVERAGE = "average"
+FIFO = "fifo"
+COSTING_METHODS = (LATEST, AVERAGE, FIFO)
+
+
+def _ingredient_id(ingredient):
+    return getattr(ingredient, 'pk', ingredient)
+
+
+def record_purchase_prices(blend_dates, keys=None):
+    """Add a PriceRecord for each row of the given purchase blends that has none.
+
+    ``blend_dates`` maps purchase blend ids to their purchase dates. Rows
+    copied from nested blends are not purchases and are left out. With
+    ``keys``, only the rows whose (blend id, ingredient id, amount, unit,
+    cost) is one of them are recorded, such as the rows an import loaded.
+    """
+    rows = BlendIngredient.objects.filter(
+        blend_id__in=blend_dates, source__isnull=True, price_record__isnull=True
+    ).values_list('pk', 'blend_id', 'ingredient_id', 'amount', 'unit', 'cost', 'base_amount', 'base_unit')
+    records = [
+        PriceRecord(
+            ingredient_id=ingredient_id,
+            date=blend_dates[blend_id],
+            amount=base_amount,
+            unit=base_unit,
+            cost_per_unit=(cost * amount / base_amount if base_amount else cost).quantize(COST_PLACES),
+            blend_ingredient_id=pk,
+        )
+        for pk, blend_id, ingredient_id, amount, unit, cost, base_amount, base_unit in rows
+        if keys is None or (blend_id, ingredient_id, amount, unit, cost) in keys
+    ]
+    PriceRecord.objects.bulk_create(records, ignore_conflicts=True)
+    return len(records)
+
+
+def prices_at(ingredients, date):
+    """Map ingredient ids to their latest cost per unit on or before ``date``, in one query"""
+    latest = (
+        PriceRecord.objects.filter(ingredient_id=OuterRef('pk'), date__lte=date)
+        .order_by('-date', '-id')
+        .values('cost_per_unit')[:1]
+    )
+    return {
+        ingredient_id: cost
+        for ingredient_id, cost in Ingredient.objects.filter(pk__in=[_ingredient_id(i) for i in ingredients])
+        .annotate(cost=Subquery(latest))
+        .values_list('pk', 'cost')
+        if cost is not None
+    }
+
+
+def average_prices(ingredients, date, days=AVERAGE_DAYS):
+    """Map ingredient ids to their cost per unit averaged over the purchases of the last ``days``, in one query"""
+    rows = (
+        PriceRecord.objects.filter(
+            ingredient_id__in=[_ingredient_id(i) for i in ingredients],
+            date__gt=date - datetime.timedelta(days=days),
+            date__lte=date,
+        )
+        .values('ingredient_id')
+        .annotate(bought=Sum('amount'), spent=Sum(F('amount') * F('cost_per_unit')))
+        .values_list('ingredient_id', 'bought', 'spent')
+        .order_by()
+    )
+    return {ingredient_id: spent / bought for ingredient_id, bought, spent in rows if bought}
+
+
+def fifo_prices(ingredients):
+    """Map ingredient ids to the cost of the next unit their stock will use, oldest purchase first, in one query"""
+    consumed = StockLevel.objects.filter(ingredient_id=OuterRef('ingredient_id')).values('consumed')
+    rows = list(
+        PriceRecord.objects.filter(ingredient_id__in=[_ingredient_id(i) for i in ingredients])
+        .annotate(consumed=Coalesce(Subquery(consumed), Value(Decimal(0))))
+        .order_by('ingredient_id', 'date', 'id')
+        .values_list('ingredient_id', 'date', 'amount', 'cost_per_unit', 'consumed')
+    )
+    history = PriceHistory(row[:4] for row in rows)
+    consumed = {row[0]: row[4] for row in rows}
+    return {ingredient_id: history.fifo(ingredient_id, used, 1) for ingredient_id, used in consumed.items()}
+
+
+class PriceHistory:
+    """The price records of some ingredients, searchable by date in memory.
+
+    Loaded with one range query. Prices at a date, moving averages and
+    FIFO costs are then binary searches over each ingredient's records,
+    using running totals of the amounts bought and spent, so costing any
+    number of brews makes no more queries.
+    """
+
+    def __init__(self, records):
+        self.dates = defaultdict(list)
+        self.costs = defaultdict(list)
+        self.bought = defaultdict(list)
+        self.spent = defaultdict(list)
+        for ingredient_id, date, amount, cost in records:
+            bought = self.bought[ingredient_id]
+            spent = self.spent[ingredient_id]
+            self.dates[ingredient_id].append(date)
+            self.costs[ingredient_id].append(cost)
+            bought.append((bought[-1] if bought else 0) + amount)
+            spent.append((spent[-1] if spent else 0) + amount * cost)
+
+    @classmethod
+    def load(cls, ingredients=None, until=None):
+        """Load the records of ``ingredients``, or all of them, up to ``until``"""
+        records = PriceRecord.objects.order_by('ingredient_id', 'date', 'id')
+        if ingredients is not None:
+            records = records.filter(ingredient_id__in=[_ingredient_id(i) for i in ingredients])
+        if until is not None:
+            records = records.filter(date__lte=until)
+        return cls(records.values_list('ingredient_id', 'date', 'amount', 'cost_per_unit'))
+
+    def at(self, ingredient, date):
+        """Cost per unit of the latest purchase on or before ``date``, or None"""
+        ingredient_id = _ingredient_id(ingredient)
+        index = bisect_right(self.dates.get(ingredient_id, ()), date)
+        return self.costs[ingredient_id][index - 1] if index else None
+
+    def average(self, ingredient, date, days=AVERAGE_DAYS):
+        """Cost per unit averaged over the purchases of the ``days`` up to ``date``.
+
+        Falls back to the latest price when nothing was bought in that time.
+        """
+        ingredient_id = _ingredient_id(ingredient)
+        dates = self.dates.get(ingredient_id, ())
+        end = bisect_right(dates, date)
+        start = bisect_right(dates, date - datetime.timedelta(days=days))
+        if start == end:
+            return self.at(ingredient_id, date)
+        bought, spent = self.bought[ingredient_id], self.spent[ingredient_id]
+        amount = bought[end - 1] - (bought[start - 1] if start else 0)
+        if not amount:
+            return self.costs[ingredient_id][end - 1]
+        return (spent[end - 1] - (spent[start - 1] if start else 0)) / amount
+
+    def fifo(self, ingredient, consumed_before, amount):
+        """Cost per unit of ``amount`` taken from stock once ``consumed_before`` has been used.
+
+        Stock is used in the order it was bought. Anything beyond the
+        recorded purchases is costed at the last price.
+        """
+        ingredient_id = _ingredient_id(ingredient)
+        bought = self.bought.get(ingredient_id)
+        if not bought:
+            return None
+        costs = self.costs[ingredient_id]
+        index = bisect_right(bought, consumed_before)
+        if not amount:
+            return costs[min(index, len(costs) - 1)]
+        position, remaining, total = consumed_before, amount, 0
+        while remaining > 0 and index < len(bought):
+            taken = min(remaining, bought[index] - position)
+            total += taken * costs[index]
+            position += taken
+            remaining -= taken
+            index += 1
+        if remaining > 0:
+            total += remaining * costs[-1]
+        return total / amount
+
+
+def cost_brews(brews, method=LATEST, days=AVERAGE_DAYS):
+    """Map brew ids to the cost of their ingredients on the day they were brewed.
+
+    ``method`` is LATEST for the last price paid, AVERAGE for the moving
+    average over ``days`` or FIFO for the purchases the brew's stock came
+    from. FIFO needs the brew's consumption in the inventory ledger; rows
+    entered directly on a brew are costed at the latest price. Three
+    queries however many brews: their rows, their ledger entries and the
+    price history up to the last brew.
+    """
+    if method not in COSTING_METHODS:
+        raise ValueError("Unknown costing method {!r}".format(method))
+    brews = list(brews)
+    if not brews:
+        return {}
+    dates = {brew.pk: brew.created.date() for brew in brews}
+
+    # (ingredient id, amount, amount consumed before) per brew
+    used = defaultdict(list)
+    for brew_id, ingredient_id, amount in BrewIngredient.objects.filter(brew_id__in=dates).values_list(
+        'brew_id', 'ingredient_id', 'base_amount'
+    ):
+        used[brew_id].append((ingredient_id, amount, None))
+    for brew_id, ingredient_id, amount, consumed in StockEntry.objects.filter(
+        brew_id__in=dates, kind=StockEntry.CONSUMPTION
+    ).values_list('brew_id', 'ingredient_id', 'amount', 'consumed'):
+        # Consumption entries are negative and ``consumed`` includes them
+        used[brew_id].append((ingredient_id, -amount, consumed + amount))
+
+    history = PriceHistory.load(
+        {ingredient_id for rows in used.values() for ingredient_id, _, _ in rows}, until=max(dates.values())
+    )
+    costs = {}
+    for brew_id, date in dates.items():
+        total = Decimal(0)
+        for ingredient_id, amount, consumed_before in used[brew_id]:
+            if method == FIFO and consumed_before is not None:
+                cost = history.fifo(ingredient_id, consumed_before, amount)
+            elif method == AVERAGE:
+                cost = history.average(ingredient_id, date, days)
+            else:
+                cost = history.at(ingredient_id, date)
+            total += amount * (cost or 0)
+        costs[brew_id] = total
+    return costs
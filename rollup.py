@@ -0,0 +1,163 @@
+import numpy as np
+from django.db.models import F
+
+from .models import BlendIngredient
+
+
+class BlendCycleError(ValueError):
+    """Raised when blends are nested inside themselves"""
+
+    def __init__(self, blend_ids):
+        self.blend_ids = sorted(blend_ids)
+        super().__init__("Blends nest inside themselves: {}".format(self.blend_ids))
+
+
+class BlendRollup:
+    """Flattened composition and cost per unit for a whole catalogue of blends.
+
+    Built from every BlendIngredient row at once. Rows with a ``source``
+    are copies of a nested blend, so they become edges of the blend graph
+    and the nested blend's own rows supply their composition and cost.
+    Blends are then resolved level by level, children before parents,
+    with array operations over all the blends of a level. Compositions
+    are kept as sparse (blend, ingredient, amount) entries, as a
+    catalogue's blends use few of its ingredients each.
+    """
+
+    def __init__(self, rows):
+        rows = list(rows)
+        blend_col, ingredient_col, amount_col, cost_col, source_col = (
+            list(column) for column in zip(*rows)
+        ) if rows else ([], [], [], [], [])
+
+        self.blend_ids = np.unique(
+            np.array(blend_col + [s for s in source_col if s is not None], dtype=np.int64)
+        )
+        self.ingredient_ids = np.unique(np.array(ingredient_col, dtype=np.int64))
+        self._blend_index = {blend_id: i for i, blend_id in enumerate(self.blend_ids.tolist())}
+
+        blends = np.searchsorted(self.blend_ids, np.array(blend_col, dtype=np.int64))
+        ingredients = np.searchsorted(self.ingredient_ids, np.array(ingredient_col, dtype=np.int64))
+        amounts = np.array(amount_col, dtype=np.float64)
+        costs = np.array(cost_col, dtype=np.float64)
+        nested = np.array([s is not None for s in source_col], dtype=bool)
+        sources = np.searchsorted(
+            self.blend_ids, np.array([s or 0 for s in source_col], dtype=np.int64)
+        )
+
+        size = len(self.blend_ids)
+        self.total_amounts = np.bincount(blends, weights=amounts, minlength=size)
+
+        direct = ~nested
+        self._direct = (blends[direct], ingredients[direct], amounts[direct])
+        self._direct_costs = np.bincount(
+            blends[direct], weights=amounts[direct] * costs[direct], minlength=size
+        )
+
+        # Several copied rows make up one nesting, one edge per (parent, child)
+        edges = blends[nested] * size + sources[nested]
+        edge_keys, edge_index = np.unique(edges, return_inverse=True)
+        self._parents, self._children = np.divmod(edge_keys, size) if size else (edge_keys, edge_keys)
+        self._edge_amounts = np.bincount(edge_index, weights=amounts[nested], minlength=len(edge_keys))
+
+        self.levels = self._levels()
+        self.total_costs = self._roll_up(self._direct_costs)
+        self.unit_costs = self._per_unit(self.total_costs)
+        self._composition = None
+
+    @classmethod
+    def load(cls, queryset=None):
+        """Build a rollup from all BlendIngredient rows, or ``queryset``, in one query.
+
+        Only rows in their blend's total unit are read, so amounts and
+        costs per unit are those of Blend.total_amount.
+        """
+        if queryset is None:
+            queryset = BlendIngredient.objects.all()
+        rows = queryset.filter(base_unit=F('blend__total_unit')).values_list(
+            'blend_id', 'ingredient_id', 'amount', 'base_amount', 'cost', 'source_id'
+        )
+        # Amounts are compared in base units, so costs become cost per base unit
+        return cls(
+            (blend_id, ingredient_id, base_amount, cost * amount / base_amount if base_amount else cost, source_id)
+            for blend_id, ingredient_id, amount, base_amount, cost, source_id in rows
+        )
+
+    def _levels(self):
+        """Nesting depth of every blend, leaves being 0"""
+        levels = np.zeros(len(self.blend_ids), dtype=np.int64)
+        for _ in range(len(self.blend_ids) + 1):
+            updated = levels.copy()
+            np.maximum.at(updated, self._parents, levels[self._children] + 1)
+            if np.array_equal(updated, levels):
+                return levels
+            changed = updated != levels
+            levels = updated
+        raise BlendCycleError(self.blend_ids[changed].tolist())
+
+    def _per_unit(self, values, blends=slice(None)):
+        totals = self.total_amounts[blends].reshape((-1,) + (1,) * (values.ndim - 1))
+        return np.divide(values, totals, out=np.zeros_like(values), where=totals > 0)
+
+    def _roll_up(self, direct):
+        """Add each nested blend's per-unit values, scaled by the nested amount, to its parent"""
+        totals = direct.copy()
+        edge_levels = self.levels[self._parents]
+        for level in range(1, int(self.levels.max(initial=0)) + 1):
+            edges = edge_levels == level
+            if not edges.any():
+                continue
+            weights = self._edge_amounts[edges].reshape((-1,) + (1,) * (totals.ndim - 1))
+            children = self._children[edges]
+            np.add.at(totals, self._parents[edges], weights * self._per_unit(totals[children], children))
+        return totals
+
+    def _coalesce(self, blends, ingredients, amounts):
+        """Sparse entries with one entry per (blend, ingredient), sorted by blend"""
+        keys, index = np.unique(blends * len(self.ingredient_ids) + ingredients, return_inverse=True)
+        blends, ingredients = np.divmod(keys, len(self.ingredient_ids)) if len(keys) else (keys, keys)
+        return blends, ingredients, np.bincount(index, weights=amounts, minlength=len(keys))
+
+    def _entries_of(self, entries, blends):
+        """Positions of the entries of each of ``blends``, with the index into ``blends`` they belong to"""
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(entries, minlength=len(self.blend_ids)))))
+        starts = indptr[blends]
+        counts = indptr[blends + 1] - starts
+        owner = np.repeat(np.arange(len(blends)), counts)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + starts[owner]
+        return positions, owner
+
+    @property
+    def composition(self):
+        """Flattened shares per unit of blend, as sparse (blends, ingredients, shares) arrays sorted by blend"""
+        if self._composition is None:
+            blends, ingredients, amounts = self._coalesce(*self._direct)
+            edge_levels = self.levels[self._parents]
+            for level in range(1, int(self.levels.max(initial=0)) + 1):
+                edges = np.nonzero(edge_levels == level)[0]
+                if not len(edges):
+                    continue
+                # Children are at lower levels, so their entries are complete
+                children = self._children[edges]
+                positions, owner = self._entries_of(blends, children)
+                scale = self._per_unit(self._edge_amounts[edges], children)
+                blends, ingredients, amounts = self._coalesce(
+                    np.concatenate([blends, self._parents[edges][owner]]),
+                    np.concatenate([ingredients, ingredients[positions]]),
+                    np.concatenate([amounts, amounts[positions] * scale[owner]]),
+                )
+            self._composition = (blends, ingredients, self._per_unit(amounts, blends))
+        return self._composition
+
+    def _blend(self, blend):
+        return self._blend_index[getattr(blend, 'pk', blend)]
+
+    def cost_per_unit(self, blend):
+        return float(self.unit_costs[self._blend(blend)])
+
+    def flattened(self, blend):
+        """Map ingredient id to its share of one unit of ``blend``"""
+        blends, ingredients, shares = self.composition
+        positions, _ = self._entries_of(blends, np.array([self._blend(blend)]))
+        present = positions[shares[positions] != 0]
+        return dict(zip(self.ingredient_ids[ingredients[present]].tolist(), shares[present].tolist()))
@@ -0,0 +1,195 @@
+from collections import namedtuple
+from decimal import Decimal
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .inventory import record_entries
+from .models import TOTAL_COST, Blend, BlendIngredient, Brew, BrewIngredient, Ingredient, StockEntry, StockLevel
+from .pricing import prices_at
+from .units import BASE_PLACES, MASS
+
+
+class Target(namedtuple("Target", "components total")):
+    """A batch to make from parts of Blends and Ingredients.
+
+    ``components`` maps each Blend or Ingredient to its parts of the
+    batch, as in 1 part tea to 7 parts blend, and ``total`` is the batch
+    size in base units.
+    """
+
+    @classmethod
+    def servings(cls, components, servings, per_serving):
+        return cls(components, Decimal(servings) * Decimal(per_serving))
+
+
+def _component_key(component):
+    if isinstance(component, Blend):
+        return ('blend', component.pk)
+    if isinstance(component, Ingredient):
+        return ('ingredient', component.pk)
+    raise TypeError("Targets are made of Blends and Ingredients, not {!r}".format(component))
+
+
+class ScalingPlan:
+    """Ingredient amounts for a list of Targets, solved together.
+
+    ``amounts`` has a row per target and a column per ingredient id in
+    ``ingredient_ids``, in base units. ``stock_cover`` is how many times
+    over the stock on hand covers each target, and ``shortfall`` what the
+    plan as a whole needs beyond the stock on hand.
+    """
+
+    def __init__(self, targets, ingredient_ids, amounts, units, costs, on_hand, factor):
+        self.targets = targets
+        self.ingredient_ids = ingredient_ids
+        self.amounts = amounts
+        self.units = units
+        self.costs = costs
+        self.factor = factor
+        needed = amounts.sum(axis=0)
+        self.shortfall = {
+            ingredient_id: Decimal(missing).quantize(BASE_PLACES)
+            for ingredient_id, missing in zip(ingredient_ids.tolist(), needed - on_hand)
+            if missing > 1e-9
+        }
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cover = np.where(amounts > 0, on_hand[np.newaxis, :] / amounts, np.inf)
+        self.stock_cover = cover.min(axis=1) if len(ingredient_ids) else np.full(len(targets), np.inf)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def amounts_for(self, index):
+        """{ingredient id: amount} of one target, leaving out what it does not use"""
+        return {
+            ingredient_id: Decimal(amount).quantize(BASE_PLACES)
+            for ingredient_id, amount in zip(self.ingredient_ids.tolist(), self.amounts[index].tolist())
+            if amount > 0
+        }
+
+    @transaction.atomic
+    def create_blends(self, names):
+        """Store each target as a new Blend, with all their rows in one bulk insert"""
+        blends = Blend.objects.bulk_create([Blend(name=name) for name in names])
+        BlendIngredient.objects.bulk_create([
+            BlendIngredient(
+                blend=blend,
+                ingredient_id=ingredient_id,
+                amount=amount,
+                unit=self.units[ingredient_id],
+                cost=self.costs[ingredient_id],
+            )
+            for index, blend in enumerate(blends)
+            for ingredient_id, amount in self.amounts_for(index).items()
+        ])
+        return blends
+
+    @transaction.atomic
+    def create_brews(self, names):
+        """Store each target as a new Brew, with all their rows in one bulk insert.
+
+        BrewIngredient stores whole amounts, so amounts are rounded. The
+        bulk insert sends no post_save, so the rows are booked out of
+        stock here, in the same transaction, as Brew.save books a brew.
+        """
+        brews = Brew.objects.bulk_create([Brew(name=name) for name in names])
+        rows = BrewIngredient.objects.bulk_create([
+            BrewIngredient(
+                brew=brew,
+                ingredient_id=ingredient_id,
+                amount=int(amount.to_integral_value()),
+                unit=self.units[ingredient_id],
+            )
+            for index, brew in enumerate(brews)
+            for ingredient_id, amount in self.amounts_for(index).items()
+            if amount.to_integral_value()
+        ])
+        record_entries(
+            StockEntry(
+                ingredient_id=row.ingredient_id,
+                kind=StockEntry.CONSUMPTION,
+                amount=-row.base_amount,
+                unit=row.base_unit,
+                brew=row.brew,
+            )
+            for row in rows
+        )
+        return brews
+
+
+def solve(targets, fit_stock=False):
+    """Scale every target to its total in one vectorised step.
+
+    The parts of each target are normalised to shares and multiplied
+    with the compositions of its blends, so ``amounts`` is one matrix
+    product for all the targets. With ``fit_stock`` every target is
+    scaled down by the same factor until the whole plan fits the stock
+    on hand. Two queries, three when a target uses a bare ingredient:
+    the blend compositions, the stock levels and the latest prices. A
+    blend's composition is made of its rows in its total unit.
+    """
+    targets = list(targets)
+    keys = sorted({_component_key(component) for target in targets for component in target.components})
+    columns = {key: index for index, key in enumerate(keys)}
+    blend_ids = [pk for kind, pk in keys if kind == 'blend']
+
+    rows = []
+    if blend_ids:
+        rows = list(
+            BlendIngredient.objects.filter(blend_id__in=blend_ids, base_unit=F('blend__total_unit'))
+            .values_list('blend_id', 'ingredient_id', 'base_unit')
+            .annotate(total=Sum('base_amount'), spent=Sum(F('amount') * F('cost'), output_field=TOTAL_COST))
+            .order_by()
+        )
+    ingredient_ids = np.array(sorted(
+        {ingredient_id for _, ingredient_id, _, _, _ in rows} | {pk for kind, pk in keys if kind == 'ingredient'}
+    ), dtype=np.int64)
+    ingredient_index = {ingredient_id: index for index, ingredient_id in enumerate(ingredient_ids.tolist())}
+
+    # Each component as shares of its ingredients
+    compositions = np.zeros((len(keys), len(ingredient_ids)))
+    units = {}
+    spent = {}
+    bought = {}
+    for blend_id, ingredient_id, unit, amount, cost in rows:
+        compositions[columns[('blend', blend_id)], ingredient_index[ingredient_id]] += float(amount)
+        units.setdefault(ingredient_id, unit)
+        spent[ingredient_id] = spent.get(ingredient_id, 0) + cost
+        bought[ingredient_id] = bought.get(ingredient_id, 0) + amount
+    for kind, pk in keys:
+        if kind == 'ingredient':
+            compositions[columns[(kind, pk)], ingredient_index[pk]] = 1
+    totals = compositions.sum(axis=1, keepdims=True)
+    compositions = np.divide(compositions, totals, out=np.zeros_like(compositions), where=totals > 0)
+
+    parts = np.zeros((len(targets), len(keys)))
+    for index, target in enumerate(targets):
+        for component, part in target.components.items():
+            parts[index, columns[_component_key(component)]] += float(part)
+    part_totals = parts.sum(axis=1, keepdims=True)
+    shares = np.divide(parts, part_totals, out=np.zeros_like(parts), where=part_totals > 0)
+    amounts = (shares @ compositions) * np.array([float(target.total) for target in targets])[:, np.newaxis]
+
+    stock = dict(
+        StockLevel.objects.filter(ingredient_id__in=ingredient_ids.tolist()).values_list('ingredient_id', 'on_hand')
+    )
+    on_hand = np.array([float(max(stock.get(pk, 0), 0)) for pk in ingredient_ids.tolist()])
+    factor = 1.0
+    if fit_stock:
+        needed = amounts.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = float(min(1.0, np.where(needed > 0, on_hand / needed, np.inf).min(initial=np.inf)))
+        amounts = amounts * factor
+
+    # Costs per base unit from the blends, or the latest price paid for bare ingredients
+    costs = {pk: (spent[pk] / bought[pk] if bought.get(pk) else Decimal(0)) for pk in bought}
+    bare = [pk for kind, pk in keys if kind == 'ingredient' and pk not in costs]
+    if bare:
+        costs.update(prices_at(bare, timezone.localdate()))
+    costs = {pk: Decimal(costs.get(pk, 0)).quantize(Decimal("0.0001")) for pk in ingredient_ids.tolist()}
+    units = {pk: units.get(pk, MASS) for pk in ingredient_ids.tolist()}
+
+    return ScalingPlan(targets, ingredient_ids, amounts, units, costs, on_hand, factor)
@@ -0,0 +1,130 @@
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import invalidate_for_instance, invalidate_recipes
+from .inventory import book_brew
+from .matching import invalidate_ingredient_index
+from .models import (
+    Blend,
+    BlendIngredient,
+    Brew,
+    BrewIngredient,
+    Ingredient,
+    IngredientAlias,
+    IngredientRowQuerySet,
+    RecipeBlend,
+    parent_rows_changed,
+    refresh_parent_totals,
+)
+from .similarity import blends_changed
+from .units import density_of, refresh_ingredient_base_quantities, set_base_quantities
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_save, sender=IngredientAlias)
+@receiver(post_delete, sender=IngredientAlias)
+def ingredient_names_changed(sender, **kwargs):
+    invalidate_ingredient_index()
+
+
+@receiver(pre_save, sender=BlendIngredient)
+@receiver(pre_save, sender=BrewIngredient)
+def convert_to_base_quantity(sender, instance, **kwargs):
+    # Also runs for fixtures, which are saved raw
+    set_base_quantities([instance])
+
+
+@receiver(pre_save, sender=BlendIngredient)
+@receiver(pre_save, sender=BrewIngredient)
+def remember_parent(sender, instance, **kwargs):
+    # A saved row may have moved to another blend or brew, whose old
+    # totals need refreshing too
+    if not instance._state.adding:
+        instance._previous_parent_id = (
+            sender.objects.filter(pk=instance.pk).values_list(sender.parent_field + '_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=BlendIngredient)
+@receiver(post_save, sender=BrewIngredient)
+@receiver(post_delete, sender=BlendIngredient)
+@receiver(post_delete, sender=BrewIngredient)
+def ingredient_rows_changed(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, IngredientRowQuerySet):
+        # Queryset deletes refresh every parent once when they are done
+        return
+    parent_ids = {
+        getattr(instance, sender.parent_field + '_id'),
+        getattr(instance, '_previous_parent_id', None),
+    }
+    if origin is not None and origin is not instance:
+        # Rows deleted along with a blend, brew or ingredient are refreshed
+        # together once it is deleted, by refresh_cascaded_parents
+        pending = origin.__dict__.setdefault('_deleted_row_parents', {})
+        pending.setdefault(sender, set()).update(parent_ids)
+        return
+    refresh_parent_totals(sender, parent_ids)
+
+
+@receiver(post_delete)
+def refresh_cascaded_parents(sender, instance, origin=None, **kwargs):
+    # The collector deletes rows before the blends, brews or ingredients
+    # they belong to, so by the origin's own post_delete they are all gone
+    if origin is not instance and not (isinstance(origin, QuerySet) and origin.model is sender):
+        return
+    pending = origin.__dict__.pop('_deleted_row_parents', None)
+    for model, parent_ids in (pending or {}).items():
+        refresh_parent_totals(model, parent_ids)
+
+
+@receiver(post_save, sender=Blend)
+@receiver(post_delete, sender=Blend)
+@receiver(post_save, sender=RecipeBlend)
+@receiver(post_delete, sender=RecipeBlend)
+@receiver(post_save, sender=Ingredient)
+def recipe_contents_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_for_instance(instance)
+
+
+@receiver(parent_rows_changed, sender=BlendIngredient)
+def blend_ingredients_changed(sender, parent_ids, **kwargs):
+    invalidate_recipes(Blend, parent_ids)
+
+
+@receiver(parent_rows_changed, sender=BlendIngredient)
+def blend_compositions_changed(sender, parent_ids, **kwargs):
+    transaction.on_commit(lambda: blends_changed(parent_ids))
+
+
+@receiver(pre_save, sender=Ingredient)
+def remember_density(sender, instance, update_fields=None, raw=False, **kwargs):
+    # The density rows are converted with comes from the density, or else
+    # the name, so saves changing neither leave the rows alone
+    instance._previous_density = None
+    if instance._state.adding or raw:
+        return
+    if update_fields is not None and not {'name', 'density'} & set(update_fields):
+        instance._previous_density = density_of(instance.name, instance.density)
+        return
+    stored = sender.objects.filter(pk=instance.pk).values_list('name', 'density').first()
+    if stored is not None:
+        instance._previous_density = density_of(*stored)
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_density_changed(sender, instance, created, raw=False, **kwargs):
+    if created or raw:
+        return
+    if density_of(instance.name, instance.density) != getattr(instance, '_previous_density', None):
+        refresh_ingredient_base_quantities(instance)
+
+
+@receiver(post_save, sender=Brew)
+def brew_created(sender, instance, created, raw=False, **kwargs):
+    # Runs inside the transaction of Brew.save
+    if created and not raw:
+        book_brew(instance)
@@ -0,0 +1,224 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+from django.db.models import F, Sum
+
+from .models import BlendIngredient
+
+
+COSINE = "cosine"
+L1 = "l1"
+METRICS = (COSINE, L1)
+
+# Distances computed at once per batch of queries, about 8 bytes each
+BATCH_CELLS = 4000000
+
+Neighbour = namedtuple("Neighbour", "blend_id distance")
+
+
+def composition_rows(blend_ids=None):
+    """(blend id, ingredient id, amount) for every blend, or for ``blend_ids``, in one query.
+
+    Only rows in the blend's total unit are summed, so shares are shares of Blend.total_amount.
+    """
+    rows = BlendIngredient.objects.filter(base_unit=F('blend__total_unit'))
+    if blend_ids is not None:
+        rows = rows.filter(blend_id__in=blend_ids)
+    return (
+        rows.values_list('blend_id', 'ingredient_id')
+        .annotate(total=Sum('base_amount'))
+        .order_by('blend_id', 'ingredient_id')
+    )
+
+
+class BlendIndex:
+    """Blend compositions as sparse vectors of ingredient shares, for nearest neighbour search.
+
+    A blend's own rows already hold nested blends flattened, so each
+    blend is one row of shares summing to one. The entries are also kept
+    grouped by ingredient, and a query reads only the entries of its own
+    ingredients: the cosine dot product and the L1 overlap sum(min(a, b))
+    are both sums over shared ingredients, as for share vectors
+    |a - b| = 2 - 2 * sum(min(a, b)).
+    """
+
+    def __init__(self, rows=(), columns=None):
+        self.columns = columns if columns is not None else {}
+        self._set(*self._arrays(rows))
+
+    def __len__(self):
+        return len(self.blend_ids)
+
+    def __contains__(self, blend):
+        return getattr(blend, 'pk', blend) in self._rows
+
+    def _arrays(self, rows):
+        rows = [(blend_id, ingredient_id, float(amount)) for blend_id, ingredient_id, amount in rows if amount > 0]
+        if not rows:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+        blend_col, ingredient_col, amounts = zip(*rows)
+        blend_ids, entry_rows = np.unique(np.array(blend_col, dtype=np.int64), return_inverse=True)
+        for ingredient_id in ingredient_col:
+            self.columns.setdefault(ingredient_id, len(self.columns))
+        columns = np.array([self.columns[ingredient_id] for ingredient_id in ingredient_col], dtype=np.int64)
+        return blend_ids, entry_rows, columns, np.array(amounts)
+
+    def _set(self, blend_ids, entry_rows, columns, amounts):
+        size = len(blend_ids)
+        totals = np.bincount(entry_rows, weights=amounts, minlength=size)
+        self.blend_ids = blend_ids
+        self.entry_rows = entry_rows
+        self.entry_columns = columns
+        self.shares = amounts / totals[entry_rows] if size else amounts
+        self.norms = np.sqrt(np.bincount(entry_rows, weights=self.shares ** 2, minlength=size))
+        self.row_indptr = np.concatenate(([0], np.cumsum(np.bincount(entry_rows, minlength=size))))
+
+        order = np.lexsort((entry_rows, columns))
+        self.column_rows = entry_rows[order]
+        self.column_shares = self.shares[order]
+        self.column_indptr = np.concatenate(([0], np.cumsum(np.bincount(columns, minlength=len(self.columns)))))
+        self._rows = {blend_id: row for row, blend_id in enumerate(blend_ids.tolist())}
+
+    @classmethod
+    def build(cls):
+        return cls(composition_rows())
+
+    def updated(self, blend_ids):
+        """A new index with the given blends read again, in one query.
+
+        Blends without rows any more are left out. The index itself is not
+        changed, so queries already running on it are not disturbed.
+        """
+        blend_ids = set(blend_ids)
+        index = BlendIndex(columns=dict(self.columns))
+        new_ids, new_rows, new_columns, new_shares = index._arrays(composition_rows(blend_ids))
+        keep = ~np.isin(self.blend_ids, list(blend_ids))
+        kept = keep[self.entry_rows]
+        renumbered = np.cumsum(keep) - 1
+        index._set(
+            np.concatenate([self.blend_ids[keep], new_ids]),
+            np.concatenate([renumbered[self.entry_rows[kept]], new_rows + int(keep.sum())]),
+            np.concatenate([self.entry_columns[kept], new_columns]),
+            np.concatenate([self.shares[kept], new_shares]),
+        )
+        return index
+
+    def _query(self, query):
+        """(columns, shares, norm, own row) of a blend, blend id or {ingredient: amount} dict"""
+        if isinstance(query, dict):
+            amounts = {getattr(ingredient, 'pk', ingredient): float(amount) for ingredient, amount in query.items()}
+            total = sum(amount for amount in amounts.values() if amount > 0)
+            if not total:
+                raise ValueError("A query needs a positive amount of some ingredient")
+            known = [(self.columns[pk], amount / total) for pk, amount in amounts.items() if amount > 0 and pk in self.columns]
+            columns, shares = zip(*known) if known else ((), ())
+            norm = np.sqrt(sum((amount / total) ** 2 for amount in amounts.values() if amount > 0))
+            return np.array(columns, dtype=np.int64), np.array(shares), norm, None
+        blend_id = getattr(query, 'pk', query)
+        if blend_id not in self._rows:
+            raise ValueError("Blend {} has no ingredients to compare".format(blend_id))
+        row = self._rows[blend_id]
+        entries = slice(self.row_indptr[row], self.row_indptr[row + 1])
+        return self.entry_columns[entries], self.shares[entries], self.norms[row], row
+
+    def nearest(self, queries, k=10, metric=COSINE):
+        """The ``k`` nearest blends to each query, as lists of Neighbours, closest first.
+
+        Queries are blends, blend ids or {ingredient: amount} dicts, and a
+        blend is never its own neighbour. Distances are 1 - cosine
+        similarity, or the L1 distance between share vectors, from 0 for
+        the same composition to 2 for nothing in common.
+        """
+        if metric not in METRICS:
+            raise ValueError("Unknown metric {!r}".format(metric))
+        queries = [self._query(query) for query in queries]
+        if not len(self):
+            return [[] for _ in queries]
+        batch = max(1, BATCH_CELLS // len(self))
+        results = []
+        for start in range(0, len(queries), batch):
+            results.extend(self._nearest(queries[start:start + batch], k, metric))
+        return results
+
+    def _nearest(self, queries, k, metric):
+        size = len(self)
+        lengths = [len(columns) for columns, _, _, _ in queries]
+        query_index = np.repeat(np.arange(len(queries)), lengths)
+        columns = np.concatenate([columns for columns, _, _, _ in queries]).astype(np.int64)
+        weights = np.concatenate([shares for _, shares, _, _ in queries])
+
+        # Gather the entries of every query ingredient in one go
+        starts = self.column_indptr[columns]
+        counts = self.column_indptr[columns + 1] - starts
+        pair = np.repeat(np.arange(len(columns)), counts)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + starts[pair]
+        rows = self.column_rows[positions]
+        shares = self.column_shares[positions]
+        if metric == COSINE:
+            contributions = weights[pair] * shares
+        else:
+            contributions = np.minimum(weights[pair], shares)
+        scores = np.bincount(
+            query_index[pair] * size + rows, weights=contributions, minlength=len(queries) * size
+        ).reshape(len(queries), size)
+
+        if metric == COSINE:
+            norms = np.outer([norm for _, _, norm, _ in queries], self.norms)
+            distances = 1 - np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+        else:
+            distances = 2 - 2 * scores
+        distances = np.maximum(distances, 0)
+        for index, (_, _, _, row) in enumerate(queries):
+            if row is not None:
+                distances[index, row] = np.inf
+
+        count = min(k, size)
+        nearest = np.argpartition(distances, count - 1, axis=1)[:, :count] if count < size else (
+            np.tile(np.arange(size), (len(queries), 1))
+        )
+        results = []
+        for index, rows in enumerate(nearest):
+            found = sorted(
+                (float(distances[index, row]), int(self.blend_ids[row])) for row in rows
+                if np.isfinite(distances[index, row])
+            )
+            results.append([Neighbour(blend_id, distance) for distance, blend_id in found])
+        return results
+
+
+_index = None
+_changed = set()
+_index_lock = threading.Lock()
+
+
+def get_blend_index():
+    """The process-wide BlendIndex, built on first use and brought up to date with changed blends"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = BlendIndex.build()
+            _changed.clear()
+        elif _changed:
+            _index = _index.updated(_changed)
+            _changed.clear()
+        return _index
+
+
+def blends_changed(blend_ids):
+    """Have the process-wide index read these blends again before its next query"""
+    with _index_lock:
+        if _index is not None:
+            _changed.update(blend_ids)
+
+
+def invalidate_blend_index():
+    global _index
+    with _index_lock:
+        _index = None
+        _changed.clear()
+
+
+def similar_blends(blend, k=10, metric=COSINE):
+    """The ``k`` blends whose composition is closest to ``blend``'s"""
+    return get_blend_index().nearest([blend], k, metric)[0]
@@ -1,15 +1,72 @@
-from django.test import TestCase
+from decimal import Decimal
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import datetime
+import io
+import json
 import os.path
-from brew.models import Blend, Brew, Ingredient, Recipe
+import shutil
+import tempfile
+from unittest import mock
+from brew.benchmarks import SCALES, BenchmarkResult, BenchmarkSuite, find_regressions, generate_catalogue
+from brew.caching import check_recipe_cache, get_cache, recipe_cache_key, recipe_etag
+from brew.factories import (
+    build_base_catalogue,
+    blend_rows,
+    make_blend,
+    make_blend_tree,
+    make_blends,
+    make_brews,
+    make_nested_blend,
+    make_recipe_catalogue,
+    make_recipes,
+)
+from brew.exporters import iter_recipe_rows
+from brew.importers import NESTING_CYCLE_MESSAGE, import_recipe_csv, read_recipe_rows
+from brew.inventory import StockUnitError, brews_remaining, record_purchase, record_stocktake, stock_report
+from brew.instrumentation import (
+    QueryBudgetExceeded,
+    QueryInstrumentationMiddleware,
+    fingerprint,
+    instrument,
+    metrics,
+)
+from brew.jobs import JobRun, resume_import_jobs, retry_import_job, run_import_job
+from brew.loaders import load_recipe_tree
+from brew.matching import get_ingredient_index, invalidate_ingredient_index, normalize_name
+from brew.models import Blend, BlendIngredient, Brew, BrewIngredient, ImportJob, Ingredient, IngredientAlias, PriceRecord, Recipe, StockEntry, StockLevel
+from brew.pagination import paginate_keyset
+from brew.parsers import Quantity, parse_column, parse_value, purchase_date, to_fixed_point
+from brew.planner import plan_recipe_import
+from brew.pricing import FIFO, PriceHistory, average_prices, cost_brews, prices_at
+from brew.rollup import BlendCycleError, BlendRollup
+from brew.scaling import Target, solve
+from brew.similarity import L1, BlendIndex, composition_rows, get_blend_index, invalidate_blend_index, similar_blends
+from brew.units import lookup_unit, to_base_quantity
+from brew.workbook import import_workbook, parse_workbook
+from brew import views
 
+SAMPLE_CSV = os.path.join(os.path.dirname(__file__), "Recipies_-_Alexs_Recipes.csv")
 
-class SimpleBrewTestCase(TestCase):
-    fixtures = ['brew.yaml']
+
+class CatalogueTestCase(TestCase):
+    """Starts from the base catalogue, built once per class with bulk inserts"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.catalogue = build_base_catalogue()
+        cls.ingredients = cls.catalogue.ingredients
+
+
+class SimpleBrewTestCase(CatalogueTestCase):
 
     def setUp(self):
-        self.brew = Brew.objects.get(name="Simple Brew")
-        self.dandelion = Ingredient.objects.get(name="Dandelion Root")
-        self.tulsi = Ingredient.objects.get(name="Tulsi")
+        self.brew = self.catalogue.brews["Simple Brew"]
+        self.dandelion = self.ingredients["Dandelion Root"]
+        self.tulsi = self.ingredients["Tulsi"]
         
     def test_brew_has_name(self):
         brew = Brew.objects.all().first()
@@ -33,17 +90,15 @@ class SimpleBrewTestCase(TestCase):
         self.assertEquals(self.brew.get_ingredients_ratio(self.dandelion, self.tulsi), 0.5)
 
 
-class ComplexBrewTestCase(TestCase):
-    fixtures = ['brew.yaml']
+class ComplexBrewTestCase(CatalogueTestCase):
 
-    def setUp(self):
-        self.brew = Brew.objects.get(name="Complex Brew")
-        self.dandelion = Ingredient.objects.get(name="Dandelion Root")
-        self.tulsi = Ingredient.objects.get(name="Tulsi")
-        self.licorice = Ingredient.objects.get(name="Licorice")
-        self.brew.add_ingredient(self.dandelion, 1)
-        self.brew.add_ingredient(self.tulsi, 1)
-        self.brew.add_ingredient(self.licorice, 1)
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dandelion = cls.ingredients["Dandelion Root"]
+        cls.tulsi = cls.ingredients["Tulsi"]
+        cls.licorice = cls.ingredients["Licorice"]
+        cls.brew, = make_brews([("Three Roots", [(cls.dandelion, 1), (cls.tulsi, 1), (cls.licorice, 1)])])
         
     def test_brew_has_three_ingredients(self):
         self.assertEquals(self.brew.ingredients.count(), 3)
@@ -52,59 +107,1162 @@ class ComplexBrewTestCase(TestCase):
         self.assertEquals(self.brew.get_ingredient_ratio(self.dandelion), 1/3)
         self.assertEquals(self.brew.get_ingredients_ratio(self.dandelion, self.tulsi), 0.5)
 
-class SimpleBlendTestCase(TestCase):
-    fixtures = ['brew.yaml']
+class BrewCompositionTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dandelion = cls.ingredients["Dandelion Root"]
+        cls.tulsi = cls.ingredients["Tulsi"]
+        cls.brew, = make_brews([("Three to one", [(cls.dandelion, 3), (cls.tulsi, 1)])])
+
+    def test_composition_is_one_query(self):
+        with self.assertNumQueries(1):
+            composition = self.brew.get_composition()
+            self.assertEquals(composition.total_amount, 4)
+            self.assertEquals(composition.share(self.dandelion), 0.75)
+            self.assertEquals(composition.ratio(self.tulsi, self.dandelion), 0.25)
+
+    def test_ratio_methods_reuse_composition(self):
+        self.brew.get_composition()
+        with self.assertNumQueries(0):
+            self.brew.get_ingredient_ratio(self.dandelion)
+            self.brew.get_ingredients_ratio(self.dandelion, self.tulsi)
+
+
+class BlendCompositionTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dandelion = cls.ingredients["Dandelion Root"]
+        cls.tulsi = cls.ingredients["Tulsi"]
+        cls.blend = make_blend("Two Dandelions", [
+            (cls.dandelion, 30, 2),
+            (cls.dandelion, 10, 1),
+            (cls.tulsi, 60, Decimal("0.5")),
+        ])
+
+    def test_composition_sums_amounts_and_costs(self):
+        composition = self.blend.get_composition()
+        self.assertEquals(len(composition), 2)
+        self.assertEquals(composition.total_amount, 100)
+        self.assertEquals(composition.amount(self.dandelion), 40)
+        self.assertEquals(composition.cost(self.dandelion), 70)
+        self.assertEquals(composition.total_cost, 100)
+        self.assertEquals(composition.share(self.tulsi), Decimal("0.6"))
+
+    def test_ratio_methods(self):
+        self.assertEquals(self.blend.get_ingredient_ratio(self.dandelion), Decimal("0.4"))
+        self.assertEquals(self.blend.get_ingredients_ratio(self.dandelion, self.tulsi), Decimal("0.4"))
+        blend_ingredient = self.blend.blendingredient_set.filter(ingredient=self.tulsi).get()
+        self.assertEquals(blend_ingredient.get_ingredient_ratio(), Decimal("0.6"))
+
+    def test_adding_ingredient_refreshes_composition(self):
+        self.blend.get_composition()
+        self.blend.add_ingredient(self.tulsi, 100)
+        self.assertEquals(self.blend.get_composition().total_amount, 200)
+
+    def test_ratio_is_one_query(self):
+        blend = Blend.objects.get(pk=self.blend.pk)
+        with self.assertNumQueries(1):
+            self.assertEquals(blend.get_ingredient_ratio(self.dandelion), Decimal("0.4"))
+        with self.assertNumQueries(0):
+            self.assertEquals(blend.get_total_ingredient_amounts(), 100)
+
+
+class StoredTotalsTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        self.blend = self.catalogue.blends["Complex Blend"]
+        self.other = self.catalogue.blends["Simple Blend"]
+        self.dandelion = self.ingredients["Dandelion Root"]
+        self.tulsi = self.ingredients["Tulsi"]
+
+    def totals(self, blend):
+        blend.refresh_from_db()
+        return blend.total_amount, blend.total_cost
+
+    def test_totals_follow_saves_and_deletes(self):
+        self.blend.add_ingredient(self.dandelion, 30, cost=2, unit="g")
+        self.assertEquals((self.blend.total_amount, self.blend.total_cost), (30, 60))
+        row = self.blend.blendingredient_set.get()
+        row.amount = 10
+        row.save()
+        self.assertEquals(self.totals(self.blend), (10, 20))
+        other_amount = self.totals(self.other)[0]
+        row.blend = self.other
+        row.save()
+        self.assertEquals(self.totals(self.blend), (0, 0))
+        self.assertEquals(self.totals(self.other)[0], other_amount + 10)
+        row.delete()
+        self.assertEquals(self.totals(self.other)[0], other_amount)
+
+    def test_totals_follow_bulk_writes(self):
+        BlendIngredient.objects.bulk_create([
+            BlendIngredient(blend=self.blend, ingredient=self.dandelion, amount=30, unit="g", cost=2),
+            BlendIngredient(blend=self.blend, ingredient=self.tulsi, amount=10, unit="g", cost=1),
+        ])
+        self.assertEquals(self.totals(self.blend), (40, 70))
+        BlendIngredient.objects.filter(blend=self.blend).update(cost=1)
+        self.assertEquals(self.totals(self.blend), (40, 40))
+        self.dandelion.delete()
+        self.assertEquals(self.totals(self.blend), (10, 10))
+
+    def test_queryset_deletes_refresh_once(self):
+        BlendIngredient.objects.bulk_create(
+            blend_rows(self.blend, [(self.tulsi, amount) for amount in range(1, 101)])
+            + blend_rows(self.other, [(self.tulsi, 1)])
+        )
+        with CaptureQueriesContext(connection) as queries:
+            BlendIngredient.objects.filter(ingredient=self.tulsi).delete()
+        self.assertLessEqual(len(queries), 10)
+        self.assertEquals(self.totals(self.blend), (0, 0))
+        self.assertEquals(self.totals(self.other)[0], 123)
+
+    def test_cascaded_deletes_refresh_once(self):
+        BlendIngredient.objects.bulk_create(
+            blend_rows(self.blend, [(self.tulsi, amount) for amount in range(1, 101)])
+            + blend_rows(self.other, [(self.tulsi, 1)])
+        )
+        with CaptureQueriesContext(connection) as queries:
+            Blend.objects.get(pk=self.blend.pk).delete()
+        self.assertLessEqual(len(queries), 20)
+        with CaptureQueriesContext(connection) as queries:
+            Ingredient.objects.filter(pk=self.tulsi.pk).delete()
+        self.assertLessEqual(len(queries), 20)
+        self.assertEquals(self.totals(self.other)[0], 123)
+
+    def test_brew_totals(self):
+        brew = self.catalogue.brews["Complex Brew"]
+        brew.add_ingredient(self.tulsi, 3)
+        self.assertEquals(brew.total_amount, brew.get_composition().total_amount)
+        BrewIngredient.objects.filter(brew=brew).update(amount=1)
+        brew.refresh_from_db()
+        self.assertEquals(brew.total_amount, brew.brewingredient_set.count())
+
+
+class UnitTestCase(CatalogueTestCase):
 
     def setUp(self):
-        self.blend = Blend.objects.get(name="Simple Blend")
+        self.blend = self.catalogue.blends["Complex Blend"]
+        self.dandelion = self.ingredients["Dandelion Root"]
+        self.tulsi = self.ingredients["Tulsi"]
+
+    def test_conversions(self):
+        self.assertEquals(lookup_unit(" Grams "), lookup_unit("g"))
+        self.assertIsNone(lookup_unit("handful"))
+        self.assertEquals(to_base_quantity(2, "kg"), (Decimal(2000), "g"))
+        self.assertEquals(to_base_quantity("1.5", "litres"), (Decimal(1500), "ml"))
+        self.assertEquals(to_base_quantity(2, "tbsp", density="0.5"), (Decimal("14.78676"), "g"))
+        self.assertEquals(to_base_quantity(3, "handful"), (Decimal(3), ""))
+
+    def test_totals_add_up_mixed_units(self):
+        BlendIngredient.objects.bulk_create([
+            BlendIngredient(blend=self.blend, ingredient=self.dandelion, amount=1, unit="kg", cost=2),
+            BlendIngredient(blend=self.blend, ingredient=self.tulsi, amount=500, unit="g", cost=1),
+        ])
+        self.blend.refresh_from_db()
+        self.assertEquals(self.blend.total_amount, 1500)
+        self.assertEquals(self.blend.total_cost, 502)
+        self.assertAlmostEqual(float(self.blend.get_ingredient_ratio(self.dandelion)), 2 / 3)
+
+    def test_totals_keep_other_units_apart(self):
+        BlendIngredient.objects.bulk_create([
+            BlendIngredient(blend=self.blend, ingredient=self.dandelion, amount=10, unit="g", cost=1),
+            BlendIngredient(blend=self.blend, ingredient=self.tulsi, amount=5, unit="ml", cost=1),
+            BlendIngredient(blend=self.blend, ingredient=self.tulsi, amount=2, unit="handful", cost=1),
+        ])
+        self.blend.refresh_from_db()
+        self.assertEquals((self.blend.total_amount, self.blend.total_unit, self.blend.total_cost), (10, "g", 17))
+        composition = self.blend.get_composition()
+        self.assertEquals((composition.total_amount, composition.unit), (10, "g"))
+        self.assertEquals(composition.share(self.tulsi), 0)
+        self.assertEquals(
+            sorted((entry.amount, entry.unit) for entry in composition.unconverted), [(2, ""), (5, "ml")]
+        )
+        self.assertEquals(self.blend.get_amounts(self.dandelion, self.tulsi), [10, 0])
+        BlendIngredient.objects.filter(blend=self.blend, unit="g").delete()
+        self.blend.refresh_from_db()
+        self.assertEquals((self.blend.total_amount, self.blend.total_unit), (5, "ml"))
+
+    def test_density_change_converts_stored_rows(self):
+        row = BlendIngredient.objects.create(blend=self.blend, ingredient=self.tulsi, amount=2, unit="l", cost=1)
+        self.assertEquals((row.base_amount, row.base_unit), (2000, "ml"))
+        self.tulsi.density = Decimal("0.25")
+        self.tulsi.save()
+        row.refresh_from_db()
+        self.blend.refresh_from_db()
+        self.assertEquals((row.base_amount, row.base_unit), (500, "g"))
+        self.assertEquals(self.blend.total_amount, 500)
+
+    def test_rename_keeps_stored_rows(self):
+        BlendIngredient.objects.create(blend=self.blend, ingredient=self.tulsi, amount=2, unit="l", cost=1)
+        self.tulsi.name = "Holy Basil"
+        with CaptureQueriesContext(connection) as queries:
+            self.tulsi.save()
+        # Only the recipes' cache keys are touched, no row is read again
+        scans = [query for query in queries if query["sql"].startswith(('SELECT "brew_blendingredient"', 'SELECT "brew_brewingredient"'))]
+        self.assertEquals(scans, [])
+        self.tulsi.density = Decimal("0.25")
+        self.tulsi.save(update_fields=['density'])
+        self.assertEquals(self.blend.blendingredient_set.get(ingredient=self.tulsi).base_unit, "g")
+
+
+class InventoryTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.ginger = cls.ingredients["Ginger Root"]
+        cls.tulsi = cls.ingredients["Tulsi"]
+        cls.blend = make_blend("Jan22", [(cls.ginger, 30, 1, "g"), (cls.tulsi, 10, 1, "g")])
+        record_purchase(cls.ginger, 1, "kg", note="ginger 1000g")
+        record_purchase(cls.tulsi, 200, "g")
+
+    def test_brew_books_consumption_through_the_blend(self):
+        Brew.objects.create(name="Morning", blend=self.blend, blend_amount=20)
+        ginger = StockLevel.objects.get(ingredient=self.ginger)
+        self.assertEquals((ginger.on_hand, ginger.consumed, ginger.unit), (985, 15, "g"))
+        entries = StockEntry.objects.filter(ingredient=self.ginger).order_by('id')
+        self.assertEquals([entry.balance for entry in entries], [1000, 985])
+        self.assertEquals(StockLevel.objects.get(ingredient=self.tulsi).on_hand, 195)
+        Brew.objects.create(name="Plain")
+        self.assertEquals(StockEntry.objects.count(), 4)
+
+    def test_failed_booking_does_not_save_the_brew(self):
+        shot = make_blend("Ginger Shot", [(self.ginger, 50, 1, "ml")])
+        with self.assertRaises(StockUnitError):
+            Brew.objects.create(name="Shot", blend=shot, blend_amount=10)
+        self.assertFalse(Brew.objects.filter(name="Shot").exists())
+        self.assertEquals(StockLevel.objects.get(ingredient=self.ginger).on_hand, 1000)
+
+    def test_nested_blends_are_booked_flattened(self):
+        outer = Blend.objects.create(name="Outer")
+        outer.add_blend(self.blend, 40)
+        Brew.objects.create(name="Nested", blend=outer, blend_amount=40)
+        self.assertEquals(StockLevel.objects.get(ingredient=self.ginger).on_hand, 970)
+
+    def test_stocktake_and_remaining_brews(self):
+        adjustment = record_stocktake(self.ginger, 850, "g")
+        self.assertEquals((adjustment.amount, adjustment.balance), (-150, 850))
+        self.assertIsNone(record_stocktake(self.ginger, "0.85", "kg"))
+        # 10g of ginger and 3.33g of tulsi a brew
+        self.assertEquals(brews_remaining(self.blend, Decimal("13.33")), 60)
+
+    def test_stock_report_reads_running_totals(self):
+        for _ in range(3):
+            Brew.objects.create(name="Brew", blend=self.blend, blend_amount=40)
+        old = StockEntry.objects.filter(ingredient=self.ginger, kind=StockEntry.CONSUMPTION).order_by('id').first()
+        StockEntry.objects.filter(pk__lte=old.pk).update(created=timezone.now() - datetime.timedelta(days=40))
+        with self.assertNumQueries(1):
+            report = {row.ingredient_id: row for row in stock_report(days=30)}
+        ginger = report[self.ginger.pk]
+        self.assertEquals((ginger.on_hand, ginger.unit), (910, "g"))
+        self.assertEquals(ginger.burn_rate, 2)
+        self.assertEquals(ginger.days_remaining, 455)
+
+    def test_ledger_is_append_only(self):
+        entry = StockEntry.objects.filter(ingredient=self.ginger).get()
+        entry.note = "changed"
+        with self.assertRaises(ValueError):
+            entry.save()
+        with self.assertRaises(StockUnitError):
+            record_purchase(self.ginger, 1, "l")
+
+
+class PriceHistoryTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        invalidate_ingredient_index()
+        self.report = import_recipe_csv(io.StringIO(
+            "Name,item,amount,unit,cost/unit,total cost\n"
+            "2022-01-09 Purchase Spices,Ginger Root,1,kg,$20.00,$20.00\n"
+            "2022-01-09 Purchase Spices,Tulsi,100,grams,$0.10,$10.00\n"
+            "2022Mar31Purchase,Ginger Root,500,grams,$0.03,$15.00\n"
+            "Jan22,Ginger Root,30,grams,$1.00,$30.00\n"
+        ))
+        self.ginger = self.ingredients["Ginger Root"]
+        self.tulsi = self.ingredients["Tulsi"]
+
+    def test_purchase_imports_record_prices(self):
+        self.assertEquals(purchase_date("2022Mar31PurchaseBlackTea"), datetime.date(2022, 3, 31))
+        self.assertIsNone(purchase_date("Jan22"))
+        self.assertEquals(self.report.prices_recorded, 3)
+        self.assertEquals(self.ginger.prices.order_by('date').first().cost_per_unit, Decimal("0.02"))
+
+    def test_only_loaded_rows_are_priced(self):
+        blend = make_blend("2022-05-01 Purchase Tea", [(self.ginger, 1, 20, "kg")])
+        report = import_recipe_csv(io.StringIO(
+            "Name,item,amount,unit,cost/unit\n"
+            "2022-05-01 Purchase Tea,Ginger Root,1,kg,$20.00\n"
+            "2022-05-01 Purchase Tea,Tulsi,100,grams,$0.10\n"
+        ))
+        self.assertEquals(report.prices_recorded, 1)
+        self.assertEquals(
+            list(PriceRecord.objects.filter(blend_ingredient__blend=blend).values_list('ingredient', flat=True)),
+            [self.tulsi.pk],
+        )
+
+    def test_prices_by_date(self):
+        with self.assertNumQueries(1):
+            prices = prices_at([self.ginger, self.tulsi], datetime.date(2022, 2, 1))
+        self.assertEquals(prices, {self.ginger.pk: Decimal("0.02"), self.tulsi.pk: Decimal("0.1")})
+        self.assertEquals(prices_at([self.ginger], datetime.date(2022, 1, 1)), {})
+        with self.assertNumQueries(1):
+            averages = average_prices([self.ginger], datetime.date(2022, 4, 1))
+        self.assertEquals(averages[self.ginger.pk], Decimal(35) / 1500)
+
+    def test_fifo_uses_oldest_purchases_first(self):
+        history = PriceHistory.load([self.ginger])
+        self.assertEquals(history.fifo(self.ginger, 0, 100), Decimal("0.02"))
+        self.assertEquals(history.fifo(self.ginger, 900, 200), Decimal("0.025"))
+        self.assertEquals(history.fifo(self.ginger, 2000, 10), Decimal("0.03"))
+
+    def test_costing_brews_takes_fixed_queries(self):
+        brews = []
+        for day in (datetime.date(2022, 2, 1), datetime.date(2022, 4, 1)):
+            brew = Brew.objects.create(name="Ginger")
+            Brew.objects.filter(pk=brew.pk).update(created=datetime.datetime(day.year, day.month, day.day))
+            brew.refresh_from_db()
+            brew.add_ingredient(self.ginger, 10)
+            brews.append(brew)
+        with self.assertNumQueries(3):
+            costs = cost_brews(brews)
+        self.assertEquals([costs[brew.pk] for brew in brews], [Decimal("0.2"), Decimal("0.3")])
+        self.assertEquals(brews[1].get_cost(FIFO), Decimal("0.3"))
+
+
+class SimpleBlendTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        self.blend = self.catalogue.blends["Simple Blend"]
     
     def test_blend_has_one_ingredients(self):
         self.assertEquals(self.blend.ingredients.count(), 1)
 
-class CombinationBlendTestCase(TestCase):
-    fixtures = ['brew.yaml']
+class CombinationBlendTestCase(CatalogueTestCase):
 
-    def setUp(self):
-        self.blend1 = Blend.objects.create(name="First Blend")
-        self.blend2 = Blend.objects.create(name="Second Blend")
-        self.combination_blend = Blend.objects.get(name="Combination Blend")
-        self.dandelion = Ingredient.objects.get(name="Dandelion Root")
-        self.tulsi = Ingredient.objects.get(name="Tulsi")
-        self.licorice = Ingredient.objects.get(name="Licorice")
-        self.ginger = Ingredient.objects.get(name="Ginger Root")
-        self.assam = Ingredient.objects.get(name="Black Assam Tea")
-        self.cinnamon = Ingredient.objects.get(name="Cinnamon")
-        self.blend1.add_ingredient(self.dandelion, 1)
-        self.blend1.add_ingredient(self.tulsi, 1)
-        self.blend1.add_ingredient(self.licorice, 1)
-        self.blend2.add_ingredient(self.ginger, 1)
-        self.blend2.add_ingredient(self.assam, 1)
-        self.blend2.add_ingredient(self.cinnamon, 1)
-        self.combination_blend.add_blend(self.blend1, 3)
-        self.combination_blend.add_blend(self.blend2, 3)
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        roots = ("Dandelion Root", "Tulsi", "Licorice")
+        spices = ("Ginger Root", "Black Assam Tea", "Cinnamon")
+        cls.blend1, cls.blend2 = make_blends(
+            (name, [(cls.ingredients[ingredient], 1) for ingredient in ingredients])
+            for name, ingredients in (("First Blend", roots), ("Second Blend", spices))
+        )
+        cls.combination_blend = cls.catalogue.blends["Combination Blend"]
+        cls.combination_blend.add_blend(cls.blend1, 3)
+        cls.combination_blend.add_blend(cls.blend2, 3)
         
     def test_combination_blend_has_six_ingredients(self):
         self.assertEquals(self.combination_blend.ingredients.count(), 6)
 
-class RecipeTestCase(TestCase):
-    fixtures = ['brew.yaml']
+    def test_blend_trees_nest_every_level(self):
+        tree = make_blend_tree("Tree", [(self.ingredients["Tulsi"], 1), (self.ingredients["Cinnamon"], 3)])
+        self.assertEquals(tree.total_amount, 300)
+        self.assertEquals(tree.get_ingredient_ratio(self.ingredients["Cinnamon"]), Decimal("0.75"))
+        self.assertEquals(Blend.objects.filter(name__startswith="Tree.").count(), 6)
+        self.assertEquals(
+            set(tree.blendingredient_set.values_list("source__name", flat=True)), {"Tree.0", "Tree.1"}
+        )
 
-    def setUp(self):
-        self.recipe = Recipe.objects.get(name="Test Recipe")
-        self.blend = Blend.objects.get(name="Simple Blend")
-        self.dandelion = Ingredient.objects.get(name="Dandelion Root")
-        self.tulsi = Ingredient.objects.get(name="Tulsi")
-        self.licorice = Ingredient.objects.get(name="Licorice")
-        self.blend.add_ingredient(self.dandelion, 1)
-        self.blend.add_ingredient(self.tulsi, 1)
-        self.blend.add_ingredient(self.licorice, 1)
-        self.recipe = Recipe.objects.get_or_create(name="Test")[0]
-        self.recipe.add_blend(self.blend)
+class BlendRollupTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dandelion = cls.ingredients["Dandelion Root"]
+        cls.tulsi = cls.ingredients["Tulsi"]
+        cls.assam = cls.ingredients["Black Assam Tea"]
+        cls.water = Ingredient.objects.create(name="Water")
+        cls.spices = make_blend("Purchase Spices", [
+            (cls.dandelion, 25, Decimal("0.08")),
+            (cls.tulsi, 75, Decimal("0.04")),
+        ])
+        cls.jan22 = make_nested_blend("Jan22", [(cls.spices, 60)], [(cls.assam, 40, Decimal("0.05"))])
+        cls.brew = make_nested_blend("Feb22Brew", [(cls.jan22, 50)], [(cls.water, 450, 0)])
+
+    def test_add_blend_keeps_cost(self):
+        row = self.jan22.blendingredient_set.get(ingredient=self.dandelion)
+        self.assertEquals(row.amount, 15)
+        self.assertEquals(row.cost, Decimal("0.08"))
+        self.assertEquals(row.source, self.spices)
+
+    def test_rollup_costs_and_composition(self):
+        with self.assertNumQueries(1):
+            rollup = BlendRollup.load()
+        self.assertAlmostEqual(rollup.cost_per_unit(self.spices), 0.05)
+        self.assertAlmostEqual(rollup.cost_per_unit(self.jan22), 0.05)
+        self.assertAlmostEqual(rollup.cost_per_unit(self.brew), 0.005)
+        flattened = rollup.flattened(self.brew)
+        self.assertAlmostEqual(flattened[self.water.id], 0.9)
+        self.assertAlmostEqual(flattened[self.dandelion.id], 0.015)
+        self.assertAlmostEqual(flattened[self.assam.id], 0.04)
+        self.assertAlmostEqual(sum(flattened.values()), 1)
+        self.assertEquals(rollup.levels.max(), 2)
+
+    def test_rollup_follows_changed_costs(self):
+        self.spices.blendingredient_set.filter(ingredient=self.tulsi).update(cost=Decimal("0.12"))
+        rollup = BlendRollup.load()
+        self.assertAlmostEqual(rollup.cost_per_unit(self.spices), 0.11)
+        self.assertAlmostEqual(rollup.cost_per_unit(self.jan22), 0.086)
+
+    def test_rollup_reads_rows_in_total_unit(self):
+        honey = Ingredient.objects.create(name="Honey")
+        BlendIngredient.objects.create(blend=self.spices, ingredient=honey, amount=500, unit='ml', cost=1)
+        self.spices.refresh_from_db()
+        self.assertEquals(self.spices.total_unit, 'ml')
+        rollup = BlendRollup.load()
+        # The unitless rows are not in the total, so they add no cost or share
+        self.assertAlmostEqual(rollup.cost_per_unit(self.spices), 1)
+        self.assertEquals(rollup.flattened(self.spices), {honey.id: 1})
+
+    def test_cycles_are_detected(self):
+        self.spices.add_blend(self.brew, 10)
+        with self.assertRaises(BlendCycleError) as error:
+            BlendRollup.load()
+        self.assertIn(self.spices.id, error.exception.blend_ids)
+
+
+class RecipeTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.blend = cls.catalogue.blends["Simple Blend"]
+        BlendIngredient.objects.bulk_create([
+            BlendIngredient(blend=cls.blend, ingredient=cls.ingredients[name], amount=1, unit='g', cost=1)
+            for name in ("Dandelion Root", "Tulsi", "Licorice")
+        ])
+        cls.recipe, = make_recipes([("Test", [cls.blend])])
 
     def test_can_export_recipe_to_csv(self):
-        self.recipe.export_recipe_to_csv()
-        self.assertTrue(os.path.exists(self.recipe.file.path))
-    
-    def can_import_recipe_from_csv(self):
-        status = self.recipe.import_recipe_from_csv()
-        self.assertEquals(status, 'Import Success')
\ No newline at end of file
+        csvfile = io.StringIO()
+        self.assertEquals(self.recipe.export_recipe_to_csv(csvfile), 'CSV Writing Success')
+        lines = csvfile.getvalue().splitlines()
+        self.assertEquals(lines[0], "blend,ingredient,amount,unit,cost,total,ratio")
+        self.assertEquals(len(lines), 5)
+
+    def test_exported_csv_can_be_imported(self):
+        csvfile = io.StringIO()
+        self.recipe.export_recipe_to_csv(csvfile)
+        csvfile.seek(0)
+        report = import_recipe_csv(csvfile)
+        self.assertEquals(report.rows_read, 4)
+        self.assertEquals(report.blend_ingredients_existing, 4)
+
+    def test_export_view_streams_in_constant_queries(self):
+        request = RequestFactory().get("/recipe/export", {"format": "jsonl"})
+        response = views.export_recipe(request, self.recipe.id)
+        with self.assertNumQueries(1):
+            lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEquals(len(lines), 4)
+        row = json.loads(lines[1])
+        self.assertEquals(row["ingredient"], "Dandelion Root")
+        self.assertEquals(Decimal(row["ratio"]), Decimal(1) / Decimal(126))
+
+    def test_export_ratios_are_shares_of_the_total_unit(self):
+        syrup = Ingredient.objects.create(name="Syrup")
+        BlendIngredient.objects.create(blend=self.blend, ingredient=syrup, amount=50, unit='ml', cost=1)
+        ratios = {row[1]: row[6] for row in iter_recipe_rows(self.recipe)}
+        self.assertEquals(ratios["Syrup"], 0)
+        self.assertEquals(ratios["Tulsi"], Decimal(1) / Decimal(126))
+
+
+class RecipeImportTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        invalidate_ingredient_index()
+        self.recipe = self.catalogue.recipe
+
+    def test_can_import_recipe_from_csv(self):
+        csvfile = io.StringIO(
+            "Name,item,amount,unit,cost/unit,total cost,weight ratio,Notes\n"
+            "Jan22,Tulsi,160,grams,$0.07,$10.58,58.18%,\n"
+            "Jan22,nettle,115,grams,$0.05,$6.32,41.82%,\n"
+            ",,,,,,,\n"
+        )
+        report = self.recipe.import_recipe_from_csv(csvfile)
+        self.assertEquals(report.status, 'Import Success')
+        self.assertEquals(report.ingredients_created, 1)
+        self.assertEquals(report.blends_created, 1)
+        self.assertEquals(report.blend_ingredients_created, 2)
+        blend = self.recipe.blend.get()
+        self.assertEquals(blend.name, "Jan22")
+        self.assertEquals(blend.get_composition().total_amount, 275)
+        self.assertEquals(blend.blendingredient_set.get(ingredient__name="Tulsi").cost, Decimal("0.0661"))
+
+    def test_import_is_idempotent_and_chunked(self):
+        # New ingredients join the shared name index once their chunk commits
+        with open(SAMPLE_CSV, newline='') as csvfile, self.captureOnCommitCallbacks(execute=True):
+            first = import_recipe_csv(csvfile, recipe=self.recipe, chunk_size=50)
+        self.assertGreater(first.chunks, 1)
+        self.assertGreater(first.blend_ingredients_created, 100)
+        with open(SAMPLE_CSV, newline='') as csvfile:
+            with CaptureQueriesContext(connection) as queries:
+                second = import_recipe_csv(csvfile, recipe=self.recipe, chunk_size=50)
+        self.assertLessEqual(len(queries), first.chunks * 7)
+        self.assertEquals(second.blend_ingredients_created, 0)
+        self.assertEquals(second.ingredients_created, 0)
+
+    def test_blend_named_items_are_nested(self):
+        with open(SAMPLE_CSV, newline='') as csvfile:
+            import_recipe_csv(csvfile, chunk_size=50)
+        self.assertFalse(Ingredient.objects.filter(name__in=Blend.objects.values('name')).exists())
+        spices = Blend.objects.get(name="2022-01-09 Purchase Spices")
+        jan22 = Blend.objects.get(name="Jan22")
+        self.assertTrue(jan22.blendingredient_set.filter(source=spices).exists())
+        # "2022-08-20 coffee brew" is read after the blend that nests it
+        coffee = Blend.objects.get(name="2022-08-20 coffee brew")
+        self.assertTrue(BlendIngredient.objects.filter(source=coffee).exists())
+        # Line 18 spells the blend "2022-02-05 Purchase black tea"
+        black_tea = Blend.objects.get(name="2022-02-05 Purchase Black Tea")
+        feb22_brew = Blend.objects.get(name="Feb22Brew")
+        self.assertTrue(feb22_brew.blendingredient_set.filter(source=black_tea).exists())
+        self.assertFalse(Blend.objects.filter(name="2022-02-05 Purchase black tea").exists())
+        self.assertGreater(BlendRollup.load().levels.max(), 0)
+
+    def test_blends_nesting_themselves_are_reported(self):
+        csvfile = io.StringIO("Name,item,amount\nA,Tulsi,3\nA,B,1\nB,A,1\n")
+        report = import_recipe_csv(csvfile)
+        self.assertEquals(sorted(report.errors), [(3, NESTING_CYCLE_MESSAGE), (4, NESTING_CYCLE_MESSAGE)])
+        self.assertEquals(report.blend_ingredients_created, 1)
+
+    def test_bad_rows_are_reported(self):
+        csvfile = io.StringIO("Name,item,amount\nJan22,Tulsi,lots\nJan22,Tulsi,3\n")
+        report = import_recipe_csv(csvfile)
+        self.assertEquals(report.errors, [(2, "'lots' is not a number")])
+        self.assertEquals(report.blend_ingredients_created, 1)
+
+class ImportPlanTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        invalidate_ingredient_index()
+        self.recipe = self.catalogue.recipe
+        self.blend = self.catalogue.blends["Simple Blend"]
+        self.media_root = tempfile.mkdtemp()
+        with open(os.path.join(self.media_root, "recipe.csv"), "w") as csvfile:
+            csvfile.write(
+                "Name,item,amount,unit,cost/unit,total cost,weight ratio,Notes\n"
+                "Simple Blend,Dandelion Root,123,g,$23.00,,,\n"
+                "Simple Blend,Dandelion Root,100,g,$23.00,,,\n"
+                "Simple Blend,Tulsi,10,g,$1.00,,,\n"
+                "New Blend,New Root,5,g,$2.00,,,\n"
+            )
+        self.recipe.file.name = "recipe.csv"
+        self.recipe.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_plan_splits_rows(self):
+        get_ingredient_index()
+        with open(os.path.join(self.media_root, "recipe.csv"), newline="") as csvfile:
+            rows = list(read_recipe_rows(csvfile))
+        with self.assertNumQueries(3):
+            plan = plan_recipe_import(rows)
+        self.assertEquals(plan.blends_to_create, ["New Blend"])
+        self.assertEquals(plan.ingredients_to_create, ["New Root"])
+        self.assertEquals([row.line for row in plan.rows_matching], [2])
+        self.assertEquals([row.line for row in plan.rows_conflicting], [3])
+        self.assertEquals([row.line for row in plan.rows_to_create], [4, 5])
+        self.assertEquals(Blend.objects.count(), 3)
+
+    def test_plan_compares_normalized_blend_names(self):
+        csvfile = io.StringIO("Name,item,amount\nsimple  blend,Tulsi,10\nNew Blend,Simple-Blend,5\nnew blend,Tulsi,1\n")
+        plan = plan_recipe_import(read_recipe_rows(csvfile))
+        self.assertEquals(plan.blends_to_create, ["New Blend"])
+        self.assertEquals(plan.ingredients_to_create, [])
+
+    def test_check_and_load_views_use_jobs(self):
+        factory = RequestFactory()
+        with self.settings(MEDIA_ROOT=self.media_root, BREW_IMPORT_JOBS_EAGER=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                views.check_recipe_file(factory.get("/check"), self.recipe.id)
+            response = views.check_recipe_file(factory.get("/check"), self.recipe.id)
+            self.assertContains(response, "Line 3: Conflicts")
+            self.assertFalse(Blend.objects.filter(name="New Blend").exists())
+            with self.captureOnCommitCallbacks(execute=True):
+                response = views.load_recipe(factory.post("/load"), self.recipe.id)
+            self.assertContains(response, "Load queued")
+            response = views.load_recipe(factory.get("/load"), self.recipe.id)
+        self.assertContains(response, "Loaded 2 blend ingredients")
+        self.assertEquals(self.blend.blendingredient_set.count(), 2)
+        self.assertTrue(Blend.objects.filter(name="New Blend").exists())
+
+
+class ImportJobTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        invalidate_ingredient_index()
+        self.media_root = tempfile.mkdtemp()
+        shutil.copy(SAMPLE_CSV, os.path.join(self.media_root, "recipe.csv"))
+        self.recipe = self.catalogue.recipe
+        self.recipe.file.name = "recipe.csv"
+        self.recipe.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_job_resumes_after_last_committed_chunk(self):
+        job = ImportJob.objects.create(recipe=self.recipe, kind=ImportJob.LOAD)
+        stored = BlendIngredient.objects.count()
+        original_commit = JobRun.commit
+
+        def crash_on_third_chunk(run, *args):
+            if run.job.chunks == 2:
+                raise RuntimeError("worker died")
+            original_commit(run, *args)
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            with mock.patch.object(JobRun, "commit", crash_on_third_chunk):
+                job = run_import_job(job.pk, chunk_size=40)
+            self.assertEquals(job.status, ImportJob.FAILED)
+            self.assertEquals(job.chunks, 2)
+            loaded = BlendIngredient.objects.count()
+
+            self.assertTrue(self.recipe.blend.exists())
+
+            # The committed chunks linked their blends, the failed job is resumed all the same
+            factory = RequestFactory()
+            with self.settings(BREW_IMPORT_JOBS_EAGER=True), self.captureOnCommitCallbacks(execute=True):
+                response = views.load_recipe(factory.post("/load"), self.recipe.id)
+            self.assertContains(response, "Load queued again")
+            self.assertEquals(ImportJob.objects.count(), 1)
+            job.refresh_from_db()
+        self.assertEquals(job.status, ImportJob.DONE)
+        self.assertEquals(job.chunks, 3)
+        totals = job.counts["totals"]
+        self.assertEquals(totals["blend_ingredients_created"], BlendIngredient.objects.count() - stored)
+        self.assertGreater(BlendIngredient.objects.count(), loaded)
+        with open(SAMPLE_CSV, newline='') as csvfile:
+            self.assertEquals(totals["rows"], len(list(read_recipe_rows(csvfile))))
+        self.assertIsNone(run_import_job(job.pk))
+
+    def test_stale_running_jobs_are_resumed(self):
+        job = ImportJob.objects.create(recipe=self.recipe, kind=ImportJob.CHECK)
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.RUNNING, updated=job.updated - datetime.timedelta(hours=1)
+        )
+        with self.settings(MEDIA_ROOT=self.media_root, BREW_IMPORT_JOBS_EAGER=True):
+            [job] = resume_import_jobs()
+        self.assertEquals(job.status, ImportJob.DONE)
+        self.assertFalse(retry_import_job(job))
+
+    def test_chunk_size_does_not_change_what_loads(self):
+        with open(os.path.join(self.media_root, "recipe.csv"), "w") as csvfile:
+            csvfile.write(
+                "Name,item,amount,unit,cost/unit\n"
+                "Chunked,Tulsi,10,g,$1.00\n"
+                "Chunked,Tulsi,lots,g,$1.00\n"
+                "Chunked,Tulsi,20,g,$1.00\n"
+                "Chunked,Licorice,some,g,$1.00\n"
+                "Simple Blend,Dandelion Root,100,g,$23.00\n"
+            )
+        results = []
+        for chunk_size in (1, 2, 100):
+            with transaction.atomic(), self.settings(MEDIA_ROOT=self.media_root):
+                job = ImportJob.objects.create(recipe=self.recipe, kind=ImportJob.LOAD)
+                job = run_import_job(job.pk, chunk_size=chunk_size)
+                amounts = sorted(BlendIngredient.objects.filter(blend__name="Chunked").values_list('amount', flat=True))
+                results.append(([line for line, message in job.errors], amounts))
+                transaction.set_rollback(True)
+        self.assertEquals(results, [([3, 5, 6], [10, 20])] * 3)
+
+    def test_status_view(self):
+        job = ImportJob.objects.create(recipe=self.recipe)
+        response = views.import_job_status(RequestFactory().get("/job"), job.pk)
+        self.assertEquals(json.loads(response.content)["status"], "queued")
+
+
+class IngredientIndexTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        invalidate_ingredient_index()
+        self.cinnamon = self.ingredients["Cinnamon"]
+        self.licorice = self.ingredients["Licorice"]
+        IngredientAlias.objects.create(name="licorice root", ingredient=self.licorice)
+
+    def test_normalize_name(self):
+        self.assertEquals(normalize_name("  Dried rinsed, Lemon-Myrtle  "), "dried rinsed lemon myrtle")
+
+    def test_resolves_exact_alias_and_similar_names(self):
+        index = get_ingredient_index()
+        self.assertEquals(index.resolve("cinnamon "), self.cinnamon.id)
+        self.assertEquals(index.resolve("cinnamon quills"), self.cinnamon.id)
+        self.assertEquals(index.resolve("Licorice Root"), self.licorice.id)
+        self.assertEquals(index.resolve("licorice root sticks"), self.licorice.id)
+        self.assertIsNone(index.resolve("green tea"))
+
+    def test_index_is_invalidated_on_save(self):
+        index = get_ingredient_index()
+        self.assertIs(get_ingredient_index(), index)
+        Ingredient.objects.create(name="Star Anise")
+        self.assertIsNot(get_ingredient_index(), index)
+        self.assertIsNotNone(get_ingredient_index().resolve("star anise pods"))
+
+    def test_different_items_are_not_merged(self):
+        index = get_ingredient_index()
+        self.assertIsNone(index.resolve("dandelion leaf"))
+        self.assertIsNone(index.resolve("organic roasted dandelion root"))
+        self.assertEquals(index.resolve("organic dandelion root"), self.ingredients["Dandelion Root"].id)
+        Ingredient.objects.create(name="ing1")
+        self.assertIsNone(get_ingredient_index().resolve("ing14"))
+
+    def test_spellings_of_a_new_name_make_one_ingredient(self):
+        csvfile = io.StringIO("Name,item,amount\nJan22,Lemon Myrtle,25\nFeb22,lemon myrtle,70\n")
+        rows = list(read_recipe_rows(csvfile))
+        self.assertEquals(plan_recipe_import(rows).ingredients_to_create, ["Lemon Myrtle"])
+        report = import_recipe_csv(io.StringIO("Name,item,amount\nJan22,Star Anise,25\nFeb22,star  anise,70\n"))
+        self.assertEquals(report.ingredients_created, 1)
+        self.assertEquals(Ingredient.objects.filter(name__iexact="star anise").count(), 1)
+        self.assertEquals(Blend.objects.get(name="Feb22").ingredients.get().name, "Star Anise")
+
+    def test_importer_uses_matches(self):
+        csvfile = io.StringIO("Name,item,amount\nJan22,cinnamon quills,25\nJan22,licorice root,70\n")
+        report = import_recipe_csv(csvfile)
+        self.assertEquals(report.ingredients_matched, 2)
+        self.assertEquals(report.ingredients_created, 0)
+        blend = Blend.objects.get(name="Jan22")
+        self.assertEquals(set(blend.ingredients.all()), {self.cinnamon, self.licorice})
+
+
+class ParserTestCase(TestCase):
+    def test_parse_values(self):
+        self.assertEquals(parse_value("$6.32", "currency"), (Decimal("6.32"), None))
+        self.assertEquals(parse_value("-$1,200.50", "currency"), (Decimal("-1200.50"), None))
+        self.assertEquals(parse_value("58.18%", "percent"), (Decimal("0.5818"), None))
+        self.assertEquals(parse_value("=29.11/440*1000", "decimal")[0].quantize(Decimal("0.01")), Decimal("66.16"))
+        self.assertEquals(parse_value("115 grams", "quantity"), (Quantity(Decimal("115"), "grams"), None))
+        self.assertEquals(parse_value("44723", "date"), (datetime.date(2022, 6, 11), None))
+        self.assertEquals(parse_value("2022-06-11", "date"), (datetime.date(2022, 6, 11), None))
+        self.assertEquals(parse_value("  ", "currency"), (None, None))
+
+    def test_bad_cells_are_reported(self):
+        self.assertEquals(parse_value("=__import__('os')", "decimal")[1], "\"=__import__('os')\" is unsupported formula")
+        self.assertEquals(parse_value("x" * 10000, "currency")[1], "'{}...' is not a currency amount".format("x" * 40))
+        column = parse_column(["1.5", "", "lots", "$2"], "currency")
+        self.assertEquals(column.values, [Decimal("1.5"), None, None, Decimal("2")])
+        self.assertEquals(column.errors, [(2, "'lots' is not a currency amount")])
+        self.assertEquals(to_fixed_point(column.values, 2), [150, None, None, 200])
+
+    def test_out_of_range_cells_are_reported(self):
+        self.assertEquals(parse_value("=1e400*10", "decimal")[1], "'=1e400*10' is not a finite number")
+        self.assertEquals(parse_value("Infinity", "decimal")[1], "'Infinity' is not a finite number")
+        self.assertEquals(parse_value("=" + "(" * 5000 + "1" + ")" * 5000, "decimal")[0], None)
+        self.assertEquals(parse_value("=" + "+".join(["1"] * 5000), "decimal")[0], None)
+        self.assertEquals(parse_value("1.2.3", "quantity")[1], "'1.2.3' is not a quantity")
+        csvfile = io.StringIO("Name,item,amount,total cost\nJan22,Tulsi,=1e400*10,\nJan22,Tulsi,100000000000,\nJan22,Tulsi,3,$1\n")
+        errors = []
+        rows = list(read_recipe_rows(csvfile, errors))
+        self.assertEquals([row.line for row in rows], [4])
+        self.assertEquals(errors, [(2, "'=1e400*10' is not a finite number"), (3, "Amount or cost is too large")])
+
+
+class WorkbookTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        invalidate_ingredient_index()
+
+    def test_parser_finds_every_table(self):
+        with open(SAMPLE_CSV, newline='') as csvfile:
+            records = list(parse_workbook(csvfile))
+        tables = {name for name, record in records}
+        self.assertEquals(tables, {"purchases", "combinations", "brews", "notes"})
+        with open(SAMPLE_CSV, newline='') as csvfile:
+            batched = list(parse_workbook(csvfile, batch_size=50))
+        purchases = [record for name, record in records if name == "purchases"]
+        self.assertEquals([record for name, record in batched if name == "purchases"], purchases)
+        self.assertEquals(len(purchases), 549)
+        brews = [record for name, record in records if name == "brews"]
+        self.assertEquals(brews[0].ingredient_name, "cacao nibs")
+        self.assertEquals(brews[0].price_per_kilogram, Decimal("14.99"))
+        echinacea = [record for record in brews if record.ingredient_name == "organic Echinacea"][0]
+        self.assertEquals(echinacea.unit, "grams")
+        self.assertEquals(echinacea.cost, Decimal("156"))
+
+    def test_import_workbook(self):
+        with open(SAMPLE_CSV, newline='') as csvfile, self.captureOnCommitCallbacks(execute=True):
+            report = import_workbook(csvfile, chunk_size=100)
+        self.assertEquals(report.tables["brews"], report.brew_ingredients_created)
+        self.assertGreater(report.tables["notes"], 0)
+        brew = Brew.objects.get(name="kombucha")
+        self.assertEquals(brew.get_composition().total_amount, 13 + 44)
+        self.assertTrue(Blend.objects.get(name="Jan22").blendingredient_set.filter(source__isnull=False).exists())
+        with open(SAMPLE_CSV, newline='') as csvfile:
+            report = import_workbook(csvfile, chunk_size=100)
+        self.assertEquals(report.brew_ingredients_created, 0)
+        self.assertEquals(report.blend_ingredients_created, 0)
+
+
+class RecipeTreeTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dandelion = cls.ingredients["Dandelion Root"]
+        cls.tulsi = cls.ingredients["Tulsi"]
+        make_recipe_catalogue(3, 2, [(cls.dandelion, 1), (cls.tulsi, 3)])
+
+    def test_tree_has_amounts_and_ratios(self):
+        recipe = load_recipe_tree(Recipe.objects.filter(name="Recipe 0"))[0]
+        self.assertEquals(len(recipe.blends), 2)
+        ingredients = recipe.blends[0].ingredient_list
+        self.assertEquals([i.name for i in ingredients], ["Dandelion Root", "Tulsi"])
+        self.assertEquals(ingredients[1].amount, 3)
+        self.assertEquals(ingredients[1].ratio, "75%")
+
+    def test_tree_loads_in_constant_queries(self):
+        with self.assertNumQueries(3):
+            recipes = load_recipe_tree()
+            for recipe in recipes:
+                for blend in recipe.blends:
+                    blend.get_ingredient_ratio(self.tulsi)
+
+    def test_views_render_tree(self):
+        request = RequestFactory().get("/recipe/")
+        with self.assertNumQueries(3):
+            response = views.recipes(request)
+        self.assertContains(response, "Blend 2.1")
+        recipe = Recipe.objects.get(name="Recipe 1")
+        response = views.recipe_detail(request, recipe.id)
+        self.assertContains(response, "75%")
+
+
+class RecipeCacheTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.dandelion = cls.ingredients["Dandelion Root"]
+        cls.blend = make_blend("Cached Blend", [(cls.dandelion, 1, 1, "g")])
+        cls.recipe, cls.other = make_recipes([("Cached", [cls.blend]), ("Other", ())])
+
+    def setUp(self):
+        get_cache().clear()
+        self.factory = RequestFactory()
+
+    def detail(self, **headers):
+        return views.recipe_detail(self.factory.get("/recipe/", **headers), self.recipe.id)
+
+    def test_warm_page_is_one_query(self):
+        self.detail()
+        with self.assertNumQueries(1):
+            response = self.detail()
+        self.assertContains(response, "Cached Blend")
+
+    def test_conditional_get(self):
+        response = self.detail()
+        self.assertEquals(response["ETag"], recipe_etag(Recipe.objects.get(pk=self.recipe.pk)))
+        self.assertEquals(self.detail(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertEquals(self.detail(HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304)
+
+    def test_changes_invalidate_affected_recipes(self):
+        other_modified = Recipe.objects.get(pk=self.other.pk).modified
+        etag = self.detail()["ETag"]
+
+        tulsi = self.ingredients["Tulsi"]
+        BlendIngredient.objects.bulk_create([
+            BlendIngredient(blend=self.blend, ingredient=tulsi, amount=3, unit="g", cost=1),
+        ])
+        response = self.detail(HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, "Tulsi")
+        self.assertContains(response, "75%")
+
+        etag = response["ETag"]
+        self.dandelion.name = "Dandelion"
+        self.dandelion.save()
+        response = self.detail(HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, "Dandelion\n")
+
+        self.blend.delete()
+        self.assertContains(self.detail(), "No blends are in Cached")
+        self.assertEquals(Recipe.objects.get(pk=self.other.pk).modified, other_modified)
+
+    def test_invalidation_deletes_cached_parts(self):
+        self.detail()
+        key = recipe_cache_key(self.recipe.pk, "blends_html")
+        self.assertIsNotNone(get_cache().get(key))
+        BlendIngredient.objects.filter(blend=self.blend).update(amount=2)
+        self.assertIsNone(get_cache().get(key))
+        self.assertContains(self.detail(), "Cached Blend")
+        self.assertIsNotNone(get_cache().get(key))
+
+    def test_culling_backends_are_reported(self):
+        self.assertEquals(check_recipe_cache(None), [])
+        caches = {"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": "/tmp"}}
+        with self.settings(CACHES=caches):
+            self.assertEquals([warning.id for warning in check_recipe_cache(None)], ["brew.W001"])
+
+
+class RecipePaginationTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.tulsi = cls.ingredients["Tulsi"]
+        cls.blend = make_blend("Paged Blend", [(cls.tulsi, 2, 3)])
+        make_recipes(("Paged {}".format(number), [cls.blend]) for number in range(6))
+
+    def setUp(self):
+        get_cache().clear()
+        self.factory = RequestFactory()
+
+    def test_pages_cover_every_recipe_once(self):
+        seen = []
+        cursor = None
+        while True:
+            page = paginate_keyset(Recipe.objects.all(), cursor, page_size=3)
+            seen.extend(recipe.name for recipe in page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEquals(seen, ["Paged {}".format(n) for n in reversed(range(6))] + ["Test Recipe"])
+
+    def test_list_views_link_next_page(self):
+        response = views.recipes(self.factory.get("/recipe/", {"page_size": 2}))
+        self.assertContains(response, "Paged 4")
+        self.assertNotContains(response, "Paged 3")
+        self.assertContains(response, "?cursor=")
+        response = views.RecipesListView.as_view()(self.factory.get("/recipes/", {"page_size": 2}))
+        self.assertContains(response, "Paged Blend")
+        self.assertContains(response, "?cursor=")
+        with self.assertRaises(Http404):
+            views.recipes(self.factory.get("/recipe/", {"cursor": "nonsense"}))
+
+    def test_api_returns_selected_fields_in_one_batch(self):
+        request = self.factory.get("/api/recipes", {
+            "page_size": 4,
+            "fields": "id,name,blends",
+            "blend_fields": "name,ingredients",
+            "ingredient_fields": "name,share",
+        })
+        with self.assertNumQueries(3):
+            response = views.recipes_api(request)
+        data = json.loads(response.content)
+        self.assertEquals(len(data["results"]), 4)
+        self.assertEquals(set(data["results"][0]), {"id", "name", "blends"})
+        self.assertEquals(
+            data["results"][0]["blends"],
+            [{"name": "Paged Blend", "ingredients": [{"name": "Tulsi", "share": "1"}]}],
+        )
+        self.assertIsNotNone(data["next"])
+
+        ids = ",".join(str(pk) for pk in Recipe.objects.values_list("pk", flat=True)[:2])
+        data = json.loads(views.recipes_api(self.factory.get("/api/recipes", {"ids": ids, "fields": "name"})).content)
+        self.assertEquals(len(data["results"]), 2)
+        response = views.recipes_api(self.factory.get("/api/recipes", {"fields": "name,secret"}))
+        self.assertEquals(response.status_code, 400)
+
+
+class ScalingTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.tea = cls.ingredients["Black Assam Tea"]
+        cls.ginger = cls.ingredients["Ginger Root"]
+        cls.cinnamon = cls.ingredients["Cinnamon"]
+        cls.spice = make_blend("April22", [
+            (cls.ginger, 30, Decimal("0.02"), "g"),
+            (cls.cinnamon, 10, Decimal("0.1"), "g"),
+        ])
+
+    def test_targets_are_solved_together(self):
+        targets = [
+            Target({self.tea: 1, self.spice: 7}, 400),
+            Target.servings({self.spice: 1}, 10, "13.8"),
+        ]
+        with self.assertNumQueries(3):
+            plan = solve(targets)
+        self.assertEquals(plan.amounts_for(0), {self.tea.pk: 50, self.ginger.pk: Decimal("262.5"), self.cinnamon.pk: Decimal("87.5")})
+        self.assertEquals(plan.amounts_for(1), {self.ginger.pk: Decimal("103.5"), self.cinnamon.pk: Decimal("34.5")})
+        self.assertEquals(plan.shortfall[self.tea.pk], 50)
+
+    def test_fitting_stock(self):
+        record_purchase(self.ginger, 183, "g")
+        record_purchase(self.cinnamon, 1, "kg")
+        plan = solve([Target({self.spice: 1}, 200), Target({self.spice: 1}, 100)], fit_stock=True)
+        self.assertAlmostEqual(plan.factor, 183 / 225)
+        self.assertEquals(plan.shortfall, {})
+        self.assertAlmostEqual(plan.stock_cover[1], 183 / 75 * 225 / 183)
+
+    def test_plans_are_written_in_bulk(self):
+        plan = solve([Target({self.tea: 1, self.spice: 7}, 400), Target({self.spice: 1}, 100)])
+        with self.assertNumQueries(6):
+            blends = plan.create_blends(["Week 1", "Week 2"])
+        self.assertEquals(blends[0].get_composition().total_amount, 400)
+        self.assertEquals(blends[1].blendingredient_set.get(ingredient=self.cinnamon).cost, Decimal("0.1"))
+        brews = plan.create_brews(["Monday", "Tuesday"])
+        self.assertEquals(Brew.objects.get(pk=brews[1].pk).total_amount, 100)
+
+    def test_planned_brews_are_booked_out_of_stock(self):
+        record_purchase(self.ginger, 1, "kg")
+        plan = solve([Target({self.spice: 1}, 100), Target({self.tea: 1, self.spice: 7}, 400)])
+        # However many rows, with the ledger's own savepoint
+        with self.assertNumQueries(11):
+            brews = plan.create_brews(["Monday", "Tuesday"])
+        entries = StockEntry.objects.filter(kind=StockEntry.CONSUMPTION, brew=brews[0])
+        self.assertEquals({entry.ingredient_id: entry.amount for entry in entries}, {self.ginger.pk: -75, self.cinnamon.pk: -25})
+        ginger = StockLevel.objects.get(ingredient=self.ginger)
+        self.assertEquals((ginger.on_hand, ginger.consumed), (1000 - 75 - 262, 75 + 262))
+
+    def test_compositions_are_in_the_total_unit(self):
+        syrup = Ingredient.objects.create(name="Syrup")
+        BlendIngredient.objects.create(blend=self.spice, ingredient=syrup, amount=60, unit='ml', cost=1)
+        plan = solve([Target({self.spice: 1}, 100)])
+        self.assertEquals(plan.amounts_for(0), {self.ginger.pk: 75, self.cinnamon.pk: 25})
+        rows = composition_rows([self.spice.pk])
+        self.assertEquals({ingredient_id: total for _, ingredient_id, total in rows}, {self.ginger.pk: 30, self.cinnamon.pk: 10})
+
+
+class BlendSimilarityTestCase(CatalogueTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.tea = cls.ingredients["Black Assam Tea"]
+        cls.ginger = cls.ingredients["Ginger Root"]
+        cls.cinnamon = cls.ingredients["Cinnamon"]
+        blends = make_blends(
+            (name, [
+                (ingredient, amount, 1, "g")
+                for ingredient, amount in ((cls.tea, tea), (cls.ginger, ginger), (cls.cinnamon, cinnamon))
+                if amount
+            ])
+            for name, tea, ginger, cinnamon in (
+                ("Jan22", 10, 40, 30),
+                ("Feb22Blend2", 10, 45, 25),
+                ("Half and half", 50, 25, 25),
+                ("Ginger only", 0, 100, 0),
+            )
+        )
+        cls.blends = {blend.name: blend for blend in blends}
+
+    def setUp(self):
+        invalidate_blend_index()
+
+    def test_nearest_by_cosine_and_l1(self):
+        index = BlendIndex.build()
+        jan22 = self.blends["Jan22"]
+        neighbours = index.nearest([jan22], k=2)[0]
+        self.assertEquals([n.blend_id for n in neighbours], [self.blends["Feb22Blend2"].pk, self.blends["Ginger only"].pk])
+        self.assertNotIn(jan22.pk, [n.blend_id for n in index.nearest([jan22], k=len(index))[0]])
+        # 1:7 tea to spice
+        nearest, = index.nearest([{self.tea: 1, self.ginger: 4, self.cinnamon: 3}], k=1, metric=L1)[0]
+        self.assertEquals(nearest.blend_id, jan22.pk)
+        self.assertAlmostEqual(nearest.distance, 0)
+        self.assertAlmostEqual(index.nearest([self.blends["Ginger only"]], k=1, metric=L1)[0][0].distance, 0.875)
+
+    def test_batches_match_single_queries(self):
+        index = BlendIndex.build()
+        blends = list(self.blends.values())
+        with mock.patch("brew.similarity.BATCH_CELLS", 1):
+            one_by_one = index.nearest(blends, k=3)
+        self.assertEquals(index.nearest(blends, k=3), one_by_one)
+
+    def test_index_follows_blend_changes(self):
+        jan22 = self.blends["Jan22"]
+        self.assertEquals(similar_blends(jan22, k=1)[0].blend_id, self.blends["Feb22Blend2"].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.blends["Half and half"].blendingredient_set.filter(ingredient=self.tea).update(amount=10)
+            self.blends["Feb22Blend2"].delete()
+        with self.assertNumQueries(1):
+            index = get_blend_index()
+        self.assertNotIn(self.blends["Feb22Blend2"], index)
+        self.assertEquals(similar_blends(jan22, k=1)[0].blend_id, self.blends["Half and half"].pk)
+        self.assertEquals(similar_blends(jan22, k=1)[0].distance, index.nearest([jan22], k=1)[0][0].distance)
+
+    def test_similar_blends_view(self):
+        request = RequestFactory().get("/blend/similar", {"k": 1, "metric": "l1"})
+        response = views.similar_blends(request, self.blends["Jan22"].pk)
+        self.assertEquals(json.loads(response.content)["results"][0]["name"], "Feb22Blend2")
+        request = RequestFactory().get("/blend/similar", {"metric": "euclid"})
+        self.assertEquals(views.similar_blends(request, self.blends["Jan22"].pk).status_code, 400)
+
+
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_generated_catalogue_is_repeatable(self):
+        catalogue = generate_catalogue(seed=1, **SCALES["tiny"])
+        self.assertEquals(len(catalogue.blend_ids), 40)
+        self.assertGreaterEqual(catalogue.blend_ingredients, 40 * 5)
+        names = list(Ingredient.objects.order_by('id').values_list('name', flat=True))
+        Ingredient.objects.all().delete()
+        generate_catalogue(seed=1, **SCALES["tiny"])
+        self.assertEquals(list(Ingredient.objects.order_by('id').values_list('name', flat=True)), names)
+
+    def test_scenarios_stay_within_query_budgets(self):
+        catalogue = generate_catalogue(seed=1, nested_share=0.5, **SCALES["tiny"])
+        with self.settings(MEDIA_ROOT=self.media_root):
+            results = BenchmarkSuite(catalogue).run(repeat=1)
+        self.assertEquals(len(results), 11)
+        self.assertEquals(find_regressions(results), [])
+        self.assertEquals(Recipe.objects.count(), 2)
+
+    def test_regressions_against_baseline(self):
+        results = [BenchmarkResult("recipes", 2.0, 5, 4)]
+        self.assertEquals(
+            find_regressions(results, {"recipes": {"seconds": 1.0, "queries": 3}}),
+            ["recipes: 5 queries, budget 4", "recipes: 5 queries, was 3", "recipes: 2.000s, was 1.000s"],
+        )
+        self.assertEquals(
+            find_regressions([BenchmarkResult("match_ingredients", 0.2, 0, 0, 0.1)]),
+            ["match_ingredients: 0.200s, budget 0.100s"],
+        )
+
+
+class InstrumentationTestCase(CatalogueTestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_fingerprint_ignores_values(self):
+        self.assertEquals(
+            fingerprint("SELECT * FROM t WHERE id = 3 AND name = 'x' AND k IN (%s, %s)"),
+            fingerprint("SELECT *  FROM t WHERE id = 42 AND name = 'y' AND k IN (%s)"),
+        )
+
+    def test_instrument_finds_repeated_queries(self):
+        brew = self.catalogue.brews["Simple Brew"]
+        ingredients = list(brew.ingredients.all())
+        with instrument("amounts") as stats:
+            for ingredient in ingredients:
+                brew.get_ingredient_amount(ingredient)
+        self.assertEquals(stats.queries, len(ingredients))
+        self.assertEquals(stats.rows, len(ingredients))
+        self.assertEquals(stats.duplicates[0][1], len(ingredients))
+        self.assertEquals(metrics.snapshot()["amounts"]["calls"], 1)
+
+    def test_middleware_names_view_and_checks_budget(self):
+        def get_response(request):
+            middleware.process_view(request, views.recipes, (), {})
+            return views.recipes(request)
+
+        middleware = QueryInstrumentationMiddleware(get_response)
+        middleware(RequestFactory().get("/recipes"))
+        snapshot = metrics.snapshot()
+        self.assertLessEqual(snapshot["brew.views.recipes"]["queries"], 3)
+        self.assertEquals(snapshot["brew.views.recipes"]["over_budget"], 0)
+
+        with self.settings(BREW_QUERY_BUDGET_ACTION="raise"):
+            with self.assertRaises(QueryBudgetExceeded):
+                with instrument("tight", budget=0):
+                    Recipe.objects.count()
+
+    def test_metrics_endpoint_is_local_only(self):
+        with instrument("count"):
+            Recipe.objects.count()
+        request = RequestFactory().get("/metrics", REMOTE_ADDR="127.0.0.1")
+        with self.settings(DEBUG=False, INTERNAL_IPS=["127.0.0.1"]):
+            response = views.metrics_snapshot(request)
+            self.assertEquals(json.loads(response.content)["count"]["queries"], 1)
+            with self.assertRaises(Http404):
+                views.metrics_snapshot(RequestFactory().get("/metrics", REMOTE_ADDR="10.0.0.1"))
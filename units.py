@@ -0,0 +1,140 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from .matching import normalize_name
+
+
+MASS = "g"
+VOLUME = "ml"
+
+Unit = namedtuple("Unit", "base factor")
+
+# Every unit is stored as an amount of its base, grams or millilitres
+UNITS = {
+    "g": Unit(MASS, Decimal(1)),
+    "gr": Unit(MASS, Decimal(1)),
+    "gram": Unit(MASS, Decimal(1)),
+    "gramme": Unit(MASS, Decimal(1)),
+    "mg": Unit(MASS, Decimal("0.001")),
+    "milligram": Unit(MASS, Decimal("0.001")),
+    "kg": Unit(MASS, Decimal(1000)),
+    "kilo": Unit(MASS, Decimal(1000)),
+    "kilogram": Unit(MASS, Decimal(1000)),
+    "oz": Unit(MASS, Decimal("28.349523125")),
+    "ounce": Unit(MASS, Decimal("28.349523125")),
+    "lb": Unit(MASS, Decimal("453.59237")),
+    "pound": Unit(MASS, Decimal("453.59237")),
+    "ml": Unit(VOLUME, Decimal(1)),
+    "millilitre": Unit(VOLUME, Decimal(1)),
+    "milliliter": Unit(VOLUME, Decimal(1)),
+    "cl": Unit(VOLUME, Decimal(10)),
+    "dl": Unit(VOLUME, Decimal(100)),
+    "l": Unit(VOLUME, Decimal(1000)),
+    "litre": Unit(VOLUME, Decimal(1000)),
+    "liter": Unit(VOLUME, Decimal(1000)),
+    "tsp": Unit(VOLUME, Decimal("4.92892159375")),
+    "teaspoon": Unit(VOLUME, Decimal("4.92892159375")),
+    "tbsp": Unit(VOLUME, Decimal("14.78676478125")),
+    "tablespoon": Unit(VOLUME, Decimal("14.78676478125")),
+    "cup": Unit(VOLUME, Decimal("236.5882365")),
+}
+
+# Grams per millilitre for ingredients without a density of their own
+DEFAULT_DENSITIES = {
+    "water": Decimal(1),
+    "filtered water": Decimal(1),
+    "spring water": Decimal(1),
+}
+
+BASE_PLACES = Decimal("0.00001")
+
+# Base units in the order a blend or brew total is measured in: by weight
+# when any of its rows can be weighed, else by volume, else in the rows'
+# own units
+TOTAL_UNITS = (MASS, VOLUME, "")
+
+
+def lookup_unit(name):
+    """The Unit for a unit name as typed, plural or not, or None if unknown"""
+    name = normalize_name(name or "").replace(" ", "")
+    if name in UNITS:
+        return UNITS[name]
+    if name.endswith("s") and name[:-1] in UNITS:
+        return UNITS[name[:-1]]
+    return None
+
+
+def is_volume(unit):
+    known = lookup_unit(unit)
+    return known is not None and known.base == VOLUME
+
+
+def total_unit(base_units):
+    """The base unit the total of rows in ``base_units`` is measured in"""
+    return next((unit for unit in TOTAL_UNITS if unit in base_units), "")
+
+
+def to_base_quantity(amount, unit, density=None):
+    """Convert an amount to (base amount, base unit).
+
+    Volumes become grams when the ingredient's density is known. Amounts
+    in unknown units, or without a unit, are kept as they are with an
+    empty base unit.
+    """
+    amount = Decimal(amount)
+    known = lookup_unit(unit)
+    if known is None:
+        return amount.quantize(BASE_PLACES), ""
+    base_amount = amount * known.factor
+    base_unit = known.base
+    if base_unit == VOLUME and density:
+        base_amount, base_unit = base_amount * Decimal(density), MASS
+    return base_amount.quantize(BASE_PLACES), base_unit
+
+
+def density_of(name, density):
+    """Grams per millilitre of an ingredient: its own density, or the default for its name"""
+    return density or DEFAULT_DENSITIES.get(normalize_name(name))
+
+
+def ingredient_densities(ingredient_ids):
+    """Map ingredient ids to grams per millilitre, in one query"""
+    from .models import Ingredient
+
+    densities = {}
+    for ingredient_id, name, density in Ingredient.objects.filter(
+        pk__in=set(ingredient_ids)
+    ).values_list('id', 'name', 'density'):
+        density = density_of(name, density)
+        if density:
+            densities[ingredient_id] = density
+    return densities
+
+
+def set_base_quantities(rows, densities=None):
+    """Fill in ``base_amount`` and ``base_unit`` of unsaved ingredient rows in one batch"""
+    rows = list(rows)
+    if densities is None:
+        volume_ids = {row.ingredient_id for row in rows if is_volume(row.unit)}
+        densities = ingredient_densities(volume_ids) if volume_ids else {}
+    for row in rows:
+        row.base_amount, row.base_unit = to_base_quantity(row.amount, row.unit, densities.get(row.ingredient_id))
+    return rows
+
+
+def refresh_ingredient_base_quantities(ingredient):
+    """Convert an ingredient's stored rows again, after its density changed"""
+    from .models import BlendIngredient, BrewIngredient
+
+    densities = ingredient_densities([ingredient.pk])
+    for model in (BlendIngredient, BrewIngredient):
+        changed = []
+        for row in model.objects.filter(ingredient=ingredient).only(
+            'pk', 'ingredient_id', 'amount', 'unit', 'base_amount', 'base_unit'
+        ):
+            base = to_base_quantity(row.amount, row.unit, densities.get(row.ingredient_id))
+            if base != (row.base_amount, row.base_unit):
+                row.base_amount, row.base_unit = base
+                changed.append(row)
+        if changed:
+            model.objects.bulk_update(changed, ['base_amount', 'base_unit'])
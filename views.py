@@ -1,168 +1,131 @@
-import csv
-from datetime import datetime
-from decimal import Decimal
-from collections import namedtuple
-
-from django.http import HttpResponse, Http404
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.template import loader
+from django.views.decorators.http import condition
 from django.views.generic import ListView
 
-from .models import BlendIngredient, Recipe, Blend, Ingredient
+from .caching import get_cached_recipe_parts, recipe_etag
+from .exporters import EXPORT_FORMATS
+from .instrumentation import metrics, query_budget
+from .jobs import queue_import_job, retry_import_job
+from .models import Blend, ImportJob, Recipe
+from .pagination import MAX_PAGE_SIZE, InvalidCursor, page_size_from, paginate_keyset
+from .similarity import COSINE, get_blend_index
+
+
+RECIPE_FIELDS = ("id", "name", "created", "modified", "blends")
+BLEND_FIELDS = ("id", "name", "total_amount", "total_cost", "ingredients")
+INGREDIENT_FIELDS = ("id", "name", "amount", "unit", "cost", "share", "ratio")
+
+
+def recipe_page(request, queryset):
+    """The page of recipes asked for by the request's cursor and page_size"""
+    try:
+        return paginate_keyset(
+            queryset, request.GET.get("cursor"), page_size_from(request.GET.get("page_size"))
+        )
+    except InvalidCursor:
+        raise Http404("page doesn't exist")
 
 
 class RecipesListView(ListView):
-    template_name = "brew/recipies_list.html"
+    template_name = "brew/recipe_list.html"
     model = Recipe
     context_object_name = "recipies"
 
+    def get_queryset(self):
+        self.page = recipe_page(self.request, super().get_queryset().prefetch_related("blend"))
+        return self.page.items
 
-def recipes(request):
-    recipes = Recipe.objects.all()
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["next_cursor"] = self.page.next_cursor
+        return context
 
+
+@query_budget(3)
+def recipes(request):
+    page = recipe_page(request, Recipe.objects.all())
+    recipes = page.items
+    blends_html = get_cached_recipe_parts(recipes, "blends_html")
     for recipe in recipes:
-        recipe_blends = recipe.blend.select_related()
+        recipe.blends_html = blends_html[recipe.pk]
 
-        if recipe_blends is not None:
-            for blend in recipe_blends:
-                blend_ingredients = blend.ingredients.select_related()
+    template = loader.get_template("brew/recipes.html")
 
-                for ingredient in blend_ingredients:
-                    ingredient.amount = BlendIngredient.objects.get(
-                        blend=recipe.blend, ingredient=ingredient
-                    ).amount
+    context = {"recipes": recipes, "next_cursor": page.next_cursor}
 
-                    ingredient.unit = BlendIngredient.objects.get(
-                        blend=recipe.blend, ingredient=ingredient
-                    ).unit
+    return HttpResponse(template.render(context, request))
 
-                    ingredient.ratio = "{0:.0%}".format(
-                        BlendIngredient.objects.get(
-                            blend=recipe.blend, ingredient=ingredient
-                        ).get_ingredient_ratio()
-                    )
 
-    template = loader.get_template("brew/recipes.html")
+def get_request_recipe(request, recipe_id):
+    """The recipe a request is about, fetched once for the view and its conditions"""
+    if getattr(request, "_recipe", None) is None:
+        request._recipe = Recipe.objects.filter(pk=recipe_id).first()
+    return request._recipe
 
-    context = {"recipes": recipes}
 
-    return HttpResponse(template.render(context, request))
+def recipe_detail_etag(request, recipe_id):
+    recipe = get_request_recipe(request, recipe_id)
+    return recipe_etag(recipe) if recipe else None
+
 
+def recipe_detail_last_modified(request, recipe_id):
+    recipe = get_request_recipe(request, recipe_id)
+    return recipe.modified if recipe else None
 
+
+@query_budget(3)
+@condition(etag_func=recipe_detail_etag, last_modified_func=recipe_detail_last_modified)
 def recipe_detail(request, recipe_id):
     """Display recipe details"""
+    recipe = get_request_recipe(request, recipe_id)
+    if recipe is None:
+        raise Http404("recipe doesn't exist")
+    blends_html = get_cached_recipe_parts([recipe], "blends_html")[recipe.pk]
+    return render(request, "brew/recipe_detail.html", {"recipe": recipe, "blends_html": blends_html})
+
+
+def export_recipe(request, recipe_id, format="csv"):
+    """Stream a recipe's blend ingredients as CSV or JSON Lines"""
+    format = request.GET.get("format", format)
+    if format not in EXPORT_FORMATS:
+        raise Http404("unknown export format")
 
     try:
         recipe = Recipe.objects.get(pk=recipe_id)
-        recipe_blends = recipe.blend.select_related()
-        if recipe_blends is not None:
-            for blend in recipe_blends:
-                blend_ingredients = blend.ingredients.select_related()
-                for ingredient in blend_ingredients:
-                    ingredient.amount = BlendIngredient.objects.get(
-                        blend=recipe.blend, ingredient=ingredient
-                    ).amount
-                    ingredient.unit = BlendIngredient.objects.get(
-                        blend=recipe.blend, ingredient=ingredient
-                    ).unit
-                    ingredient.ratio = "{0:.0%}".format(
-                        BlendIngredient.objects.get(
-                            blend=recipe.blend, ingredient=ingredient
-                        ).get_ingredient_ratio()
-                    )
-
     except Recipe.DoesNotExist:
         raise Http404("recipe doesn't exist")
-    return render(request, "brew/recipe_detail.html", {"recipe": recipe})
+
+    stream, content_type = EXPORT_FORMATS[format]
+    response = StreamingHttpResponse(stream(recipe), content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="{}.{}"'.format(
+        recipe.name, format
+    )
+    return response
+
+
+def latest_import_job(recipe, kind=None):
+    jobs = recipe.import_jobs.order_by("-created", "-id")
+    if kind is not None:
+        jobs = jobs.filter(kind=kind)
+    return jobs.first()
 
 
 def check_recipe_file(request, recipe_id):
-    """Check recipe from file prior to loading"""
-    Entry = namedtuple(
-        "Entry",
-        "blend_name blend_ingredient_name blend_ingredient_amount blend_ingredient_unit blend_ingredient_cost total_cost weight_ratio notes",
-    )
+    """Check recipe from file prior to loading, in a background job"""
     note = ""
-    data = []
-    blends = []
-    blend_ingredients = []
-    blend_dir = ""
-    ingredient_id = 0
+    job = None
 
     try:
         recipe = Recipe.objects.get(pk=recipe_id)
-        recipe_blends = recipe.blend.select_related()
-        if recipe_blends.count() == 0:
-            with open(recipe.file.path) as recipe_file_path:
-                for entry in list(csv.DictReader(recipe_file_path)):
-                    cost_per_unit = entry["cost/unit"]
-                    try:
-                        # Best to store the values in scientific notation
-                        cost_per_unit = float(cost_per_unit)
-                    except ValueError:
-                        # Can't convert string to float
-                        cost_per_unit = Decimal(cost_per_unit.strip("$"))
-
-                    total_cost = entry["total cost"]
-                    try:
-                        # Best to store the values in scientific notation
-                        total_cost = float(total_cost)
-                    except ValueError:
-                        # Can't convert string to float
-                        total_cost = Decimal(total_cost.strip("$"))
-
-                    data.append(
-                        Entry(
-                            entry["Name"],
-                            entry["item"],
-                            entry["amount"],
-                            entry["unit"],
-                            cost_per_unit,
-                            total_cost,
-                            entry["weight ratio"],
-                            entry["Notes"],
-                        )
-                    )
-
-            for entry in data:
-                # UP TO HERE
-                # Shouldn't be creating anything at this stage
-                # Should be coming up with a list of things that need to be done
-                # i.e. Need to create X number of blend entries (enumerate)
-                #       and X number of ingredients (enumerate)
-                # Also would be good to facilitate aliases or matching for ingredients
-                # If possible, would possibly be able to get average statistics for
-                # ingredient items. Also, could describe attributes, such as
-                # "cut", "organic", "fine", "leaf", "aged", "roasted", etc.
-
-                try:
-                    blend = Blend.objects.get(name=entry.blend_name)
-                except:
-                    blend = Blend(name=entry.blend_name, created=datetime.now())
-
-                # ingredient = Ingredient.objects.get(name=entry.blend_ingredient_name)
-                # blend_ingredient = BlendIngredient.objects.get(ingredient=ingredient[0], blend=blend[0], amount=entry.blend_ingredient_amount, unit=entry.blend_ingredient_unit, cost=entry.blend_ingredient_cost)
-
-                blends.append(blend)
-
-                for item in blend.ingredients.select_related():
-                    try:
-                        blend_ingredient = BlendIngredient.objects.get(
-                            blend=blend,
-                            ingredient=item,
-                            amount=entry.blend_ingredient_amount,
-                        )
-                    except:
-                        item.blend_ingredient_amount = entry.blend_ingredient_amount
-                        item.blend_ingredient_unit = entry.blend_ingredient_unit
-                        item.weight_ratio = entry.weight_ratio
-                    else:
-                        item.amount = blend_ingredient.amount
-                        item.blend_ingredient_unit = blend_ingredient.unit
-                        item.weight_ratio = "{0:.0%}".format(
-                            blend_ingredient.get_ingredient_ratio()
-                        )
-                    blend_ingredients.append(item)
+        recipe_blends = recipe.blend.all()
+        if not recipe_blends.exists():
+            job = latest_import_job(recipe, ImportJob.CHECK)
+            if job is None or "recheck" in request.GET:
+                job = queue_import_job(recipe, ImportJob.CHECK)
         else:
             note = "Recipe currently has {} present.".format(recipe_blends)
 
@@ -171,48 +134,131 @@ def check_recipe_file(request, recipe_id):
     return render(
         request,
         "brew/check_recipe.html",
-        {
-            "recipe": recipe,
-            "note": note,
-            "data": data,
-            "blends": blends,
-            "blend_ingredients": blend_ingredients,
-        },
+        {"recipe": recipe, "note": note, "job": job},
     )
 
 
 def load_recipe(request, recipe_id):
-    """Load recipe from file"""
-    Entry = namedtuple(
-        "Entry",
-        "blend_name blend_ingredient_name blend_ingredient_amount blend_ingredient_unit blend_ingredient_cost total_cost weight_ratio notes",
-    )
+    """Load recipe from file in a background job"""
     note = ""
-    data = []
 
     try:
         recipe = Recipe.objects.get(pk=recipe_id)
-        if recipe.blend is None:
-            with open(recipe.file.path) as recipe_file_path:
-                for entry in list(csv.DictReader(recipe_file_path)):
-                    data.append(
-                        Entry(
-                            entry["Blend.name"],
-                            entry["BlendIngredient.name"],
-                            entry["BlendIngredient.amount"],
-                            entry["BlendIngredient.unit"],
-                            entry["BlendIngredient.cost"],
-                            entry["total cost"],
-                            entry["weight ratio"],
-                            entry["Notes"],
-                        )
-                    )
-
-        if recipe.blend is not None:
+        job = latest_import_job(recipe)
+        can_load = not recipe.blend.exists() and not (job and job.is_active)
+        # A failed load has linked the blends of the chunks it committed, so
+        # it is resumed rather than loaded again
+        can_retry = job is not None and job.kind == ImportJob.LOAD and job.status == ImportJob.FAILED
+        if request.method == "POST" and can_retry:
+            retry_import_job(job)
+            note = "Load queued again"
+            can_load = can_retry = False
+        elif request.method == "POST" and can_load:
+            # Matching rows are already stored and conflicts need a decision first
+            job = queue_import_job(recipe, ImportJob.LOAD)
+            note = "Load queued"
+            can_load = False
+        elif recipe.blend.exists():
             note = "Recipe blend is currently present"
 
     except Recipe.DoesNotExist:
         raise Http404("recipe doesn't exist")
     return render(
-        request, "brew/load_recipe.html", {"recipe": recipe, "note": note, "data": data}
+        request,
+        "brew/load_recipe.html",
+        {"recipe": recipe, "note": note, "job": job, "can_load": can_load, "can_retry": can_retry},
     )
+
+
+def import_job_status(request, job_id):
+    """Progress of an import job as JSON, for polling"""
+    try:
+        job = ImportJob.objects.get(pk=job_id)
+    except ImportJob.DoesNotExist:
+        raise Http404("import job doesn't exist")
+    return JsonResponse(job.as_dict())
+
+
+def selected_fields(request, parameter, allowed):
+    """Fields named in a comma separated request parameter, or all of them"""
+    value = request.GET.get(parameter)
+    if not value:
+        return allowed
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        raise ValueError("Unknown {}: {}".format(parameter, ", ".join(sorted(unknown))))
+    return fields
+
+
+def select_blend_fields(blend, blend_fields, ingredient_fields):
+    selected = {field: blend[field] for field in blend_fields if field != "ingredients"}
+    if "ingredients" in blend_fields:
+        selected["ingredients"] = [
+            {field: ingredient[field] for field in ingredient_fields} for ingredient in blend["ingredients"]
+        ]
+    return selected
+
+
+@query_budget(3)
+def recipes_api(request):
+    """Recipes with their blends and ingredient ratios as JSON, many per request.
+
+    Recipes are picked by ``ids`` or paged with ``cursor`` and
+    ``page_size``. ``fields``, ``blend_fields`` and ``ingredient_fields``
+    keep only the named fields. Blend trees come from the recipe cache,
+    built in one batch for any recipes missing from it.
+    """
+    try:
+        fields = selected_fields(request, "fields", RECIPE_FIELDS)
+        blend_fields = selected_fields(request, "blend_fields", BLEND_FIELDS)
+        ingredient_fields = selected_fields(request, "ingredient_fields", INGREDIENT_FIELDS)
+        if request.GET.get("ids"):
+            ids = [int(pk) for pk in request.GET["ids"].split(",")][:MAX_PAGE_SIZE]
+            recipes, next_cursor = list(Recipe.objects.filter(pk__in=ids).order_by("id")), None
+        else:
+            recipes, next_cursor = paginate_keyset(
+                Recipe.objects.all(), request.GET.get("cursor"), page_size_from(request.GET.get("page_size"))
+            )
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    trees = get_cached_recipe_parts(recipes, "tree") if "blends" in fields else {}
+    results = []
+    for recipe in recipes:
+        result = {field: getattr(recipe, field) for field in fields if field != "blends"}
+        if "blends" in fields:
+            result["blends"] = [
+                select_blend_fields(blend, blend_fields, ingredient_fields) for blend in trees[recipe.pk]
+            ]
+        results.append(result)
+    return JsonResponse({"results": results, "next": next_cursor}, encoder=DjangoJSONEncoder)
+
+
+def similar_blends(request, blend_id):
+    """The blends closest in composition to one blend as JSON, ``k`` of them by ``metric``"""
+    try:
+        blend = Blend.objects.only('id', 'name').get(pk=blend_id)
+    except Blend.DoesNotExist:
+        raise Http404("blend doesn't exist")
+    try:
+        neighbours = get_blend_index().nearest(
+            [blend], page_size_from(request.GET.get("k"), 10), request.GET.get("metric", COSINE)
+        )[0]
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    names = dict(Blend.objects.filter(pk__in=[n.blend_id for n in neighbours]).values_list('id', 'name'))
+    return JsonResponse({
+        "blend": {"id": blend.pk, "name": blend.name},
+        "results": [
+            {"id": neighbour.blend_id, "name": names.get(neighbour.blend_id), "distance": neighbour.distance}
+            for neighbour in neighbours
+        ],
+    })
+
+
+def metrics_snapshot(request):
+    """Timings and query counts recorded by QueryInstrumentationMiddleware, for local use"""
+    if not settings.DEBUG and request.META.get("REMOTE_ADDR") not in settings.INTERNAL_IPS:
+        raise Http404("metrics are only available locally")
+    return JsonResponse(metrics.snapshot())
@@ -0,0 +1,221 @@
+import csv
+from collections import Counter, namedtuple
+
+from .importers import (
+    CHUNK_SIZE,
+    BrewImporter,
+    BrewRow,
+    ImportReport,
+    RecipeImporter,
+    cell,
+    find_columns,
+    parse_recipe_rows,
+)
+from .parsers import parse_value
+
+
+CombinationRow = namedtuple("CombinationRow", "line name ratio amount")
+NoteRow = namedtuple("NoteRow", "line label text")
+
+# Each table starts at the column where its header run begins and ends
+# where the next table starts.
+TABLES = (
+    ("purchases", ("Name", "item", "amount")),
+    ("combinations", ("Combination 1",)),
+    ("brews", ("Name", "ingredient", "weight")),
+    ("notes", (":Brew Archive",)),
+)
+
+BREW_COLUMNS = {
+    "brew_name": "Name",
+    "ingredient_name": "ingredient",
+    "amount": "weight",
+    "unit": "measurement",
+    "price_per_kilogram": "price per kilogram",
+    "cost": "brewing cost",
+    "notes": "notes",
+}
+
+
+class Table:
+    """Position of one table in the sheet's header row"""
+
+    def __init__(self, name, header, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.headers = [value.strip() for value in header[start:end]]
+
+    def column(self, header):
+        return self.start + self.headers.index(header)
+
+
+def find_tables(header):
+    """Locate each known table in the header row, in column order"""
+    header = [value.strip() for value in header]
+    starts = []
+    for name, run in TABLES:
+        for index in range(len(header) - len(run) + 1):
+            if tuple(header[index:index + len(run)]) == run:
+                starts.append((index, name))
+                break
+    starts.sort()
+    return [
+        Table(name, header, start, starts[i + 1][0] if i + 1 < len(starts) else len(header))
+        for i, (start, name) in enumerate(starts)
+    ]
+
+
+def value_at(row, index):
+    return row[index].strip() if index < len(row) else ""
+
+
+def optional_decimal(value):
+    """Read a price or cost cell, treating unreadable text as blank"""
+    return parse_value(value, "currency")[0]
+
+
+class WorkbookParser:
+    """Read every table of the recipe workbook export in one pass over the file.
+
+    Purchase rows are collected and parsed ``batch_size`` at a time with
+    parse_recipe_rows, the way read_recipe_rows reads a recipe CSV.
+    """
+
+    def __init__(self, csvfile, errors=None, batch_size=CHUNK_SIZE):
+        self.reader = csv.reader(csvfile)
+        self.errors = errors if errors is not None else []
+        self.batch_size = batch_size
+        self.purchases = []
+        self.purchase_columns = None
+        self.header = next(self.reader)
+        self.tables = find_tables(self.header)
+        self.parsers = []
+        for table in self.tables:
+            parser = getattr(self, "setup_" + table.name)(table)
+            self.parsers.append((table.name, parser))
+
+    def __iter__(self):
+        """Yield (table name, record) for every record of every table"""
+        for line, row in enumerate(self.reader, start=2):
+            for name, parser in self.parsers:
+                record = parser(line, row)
+                if record is not None:
+                    yield name, record
+            if len(self.purchases) >= self.batch_size:
+                yield from self.parse_purchases()
+        yield from self.parse_purchases()
+
+    def parse_purchases(self):
+        """Parse the collected purchase rows as one batch"""
+        rows, self.purchases = self.purchases, []
+        if rows:
+            for record in parse_recipe_rows(rows, self.purchase_columns, self.errors):
+                yield "purchases", record
+
+    def setup_purchases(self, table):
+        self.purchase_columns = find_columns(self.header, table.start, table.end)
+
+        def parse(line, row):
+            self.purchases.append((line, row))
+
+        return parse
+
+    def setup_combinations(self, table):
+        name, ratio, amount = table.start, table.start + 1, table.start + 2
+
+        def parse(line, row):
+            combination_amount = optional_decimal(value_at(row, amount))
+            if not value_at(row, name) or combination_amount is None:
+                return None
+            return CombinationRow(line, value_at(row, name), value_at(row, ratio), combination_amount)
+
+        return parse
+
+    def setup_brews(self, table):
+        columns = {field: table.column(header) for field, header in BREW_COLUMNS.items()}
+        # Some brews were typed with the unit in the unnamed column after
+        # the weight, which moves the price and cost one column to the left
+        # of their headers.
+        short_unit = columns["amount"] + 1
+        short_columns = dict(
+            columns,
+            unit=short_unit,
+            price_per_kilogram=columns["unit"],
+            cost=columns["price_per_kilogram"],
+        )
+
+        def parse(line, row):
+            brew_name = cell(row, columns, "brew_name").strip()
+            ingredient_name = cell(row, columns, "ingredient_name").strip()
+            if not brew_name or not ingredient_name:
+                return None
+            quantity, error = parse_value(cell(row, columns, "amount"), "quantity")
+            if quantity is None:
+                self.errors.append((line, error or "Missing brew weight"))
+                return None
+            layout = short_columns if value_at(row, short_unit) else columns
+            return BrewRow(
+                line,
+                brew_name,
+                ingredient_name,
+                quantity.amount,
+                cell(row, layout, "unit").strip() or quantity.unit,
+                optional_decimal(cell(row, layout, "price_per_kilogram")),
+                optional_decimal(cell(row, layout, "cost")),
+                cell(row, columns, "notes").strip(),
+            )
+
+        return parse
+
+    def setup_notes(self, table):
+        label = table.column("Notes")
+
+        def parse(line, row):
+            text = " ".join(
+                value.strip() for index, value in enumerate(row[table.start:table.end], table.start)
+                if index != label and value.strip()
+            )
+            if not text:
+                return None
+            return NoteRow(line, value_at(row, label), text)
+
+        return parse
+
+
+def parse_workbook(csvfile, errors=None, batch_size=CHUNK_SIZE):
+    """Yield (table name, record) for every record in the workbook export"""
+    return iter(WorkbookParser(csvfile, errors, batch_size))
+
+
+def import_workbook(csvfile, recipe=None, chunk_size=CHUNK_SIZE):
+    """Import the purchase and brew tables of the workbook in one pass.
+
+    Purchase rows become Blends and BlendIngredients and brew rows become
+    Brews and BrewIngredients, each written in bulk chunks. The report's
+    ``tables`` counts the records read from every table, including the
+    ones that are not stored.
+    """
+    report = ImportReport()
+    report.tables = Counter()
+    importers = {
+        "purchases": RecipeImporter(recipe, chunk_size, report),
+        "brews": BrewImporter(chunk_size, report),
+    }
+    buffers = {name: [] for name in importers}
+
+    for name, record in parse_workbook(csvfile, report.errors, chunk_size):
+        report.tables[name] += 1
+        if name not in buffers:
+            continue
+        buffers[name].append(record)
+        if len(buffers[name]) >= chunk_size:
+            importers[name].write_chunk(buffers[name])
+            buffers[name] = []
+
+    for name, rows in buffers.items():
+        if rows:
+            importers[name].write_chunk(rows)
+    for importer in importers.values():
+        importer.finish()
+    return report